@@ -0,0 +1,97 @@
+# ===============================================================================
+# Trajencode
+# Checkpoint.py
+# Manifest of the progress of a trajectory, used to resume interrupted runs
+# ===============================================================================
+
+import hashlib
+import json
+import os
+import time
+
+EXTENSION = ".ckpt.json"
+# Bytes hashed at the start and at the end of the trajectory to identify it
+HASH_BYTES = 2 ** 20
+# Seconds between periodic checkpoints when resuming without an explicit interval
+INTERVAL = 300.0
+
+
+def file_identity(path, hash_bytes=HASH_BYTES):
+    """
+    Identifies a file by its size, modification time and a hash of its first and last bytes.
+    Hashing the whole file would take as long as reading a multi-day trajectory
+    :param path: name of the file
+    :param hash_bytes: number of bytes hashed at each end of the file
+    :return: dictionary with the identity of the file
+    """
+    stat = os.stat(path)
+    sha = hashlib.sha1()
+    with open(path, "rb") as inn:
+        sha.update(inn.read(hash_bytes))
+        if stat.st_size > hash_bytes:
+            inn.seek(max(hash_bytes, stat.st_size - hash_bytes))
+            sha.update(inn.read(hash_bytes))
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime, "sha1": sha.hexdigest()}
+
+
+class Checkpoint:
+
+    def __init__(self, base, identity, params, interval=INTERVAL):
+        """
+        Progress of the outputs of one trajectory, saved in <base>.ckpt.json
+        :param base: common prefix of the output files of the trajectory
+        :param identity: identity of the input files, as returned by file_identity
+        :param params: encoder and loader parameters that change the outputs
+        :param interval: seconds between periodic checkpoints, 0 to only record finished trajectories
+        """
+        self.path = "%s%s" % (base, EXTENSION)
+        self.identity = identity
+        self.params = params
+        self.interval = interval
+        self.frames_done = 0  # trajectory frames already in the outputs
+        self.files = {}  # byte offset of every encoding output file
+        self.contacts = []  # contact accumulators saved next to the manifest
+        self.complete = False
+        self.last_save = time.perf_counter()
+
+    def load(self):
+        """
+        Reads the manifest of a previous run
+        :return: True if it exists and was written for the same input files and parameters
+        """
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "r") as inn:
+            manifest = json.load(inn)
+        if manifest["identity"] != self.identity or manifest["params"] != self.params:
+            return False
+        self.frames_done = manifest["frames_done"]
+        self.files = manifest["files"]
+        self.contacts = manifest["contacts"]
+        self.complete = manifest["complete"]
+        return True
+
+    def due(self):
+        """
+        Whether a periodic checkpoint should be written now
+        """
+        return self.interval > 0 and time.perf_counter() - self.last_save >= self.interval
+
+    def save(self, frames_done, files, contacts, complete=False):
+        """
+        Writes the manifest atomically, a crash leaves either the old or the new one
+        :param frames_done: trajectory frames already in the outputs
+        :param files: byte offset of every encoding output file
+        :param contacts: names of the contact accumulators saved with this checkpoint
+        :param complete: whether all the outputs of the trajectory are finished
+        """
+        self.frames_done = frames_done
+        self.files = files
+        self.contacts = contacts
+        self.complete = complete
+        manifest = {"identity": self.identity, "params": self.params, "frames_done": frames_done,
+                    "files": files, "contacts": contacts, "complete": complete}
+        with open(self.path + ".tmp", "w") as out:
+            json.dump(manifest, out, indent=1)
+        os.replace(self.path + ".tmp", self.path)
+        self.last_save = time.perf_counter()
@@ -0,0 +1,144 @@
+# ===============================================================================
+# Trajencode
+# DistanceStore.py
+# Condensed distance matrix, optionally stored on disk and filled block by block
+# ===============================================================================
+
+import hashlib
+import json
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from TrajSAencode.SAMetric import block_distances
+
+
+class CondensedDistances:
+
+    def __init__(self, n_frames, path=None, block_size=256):
+        """
+        Upper triangle (without the diagonal) of the distance matrix between frames, in float32,
+        using the same layout as scipy condensed matrices
+        :param n_frames: number of frames
+        :param path: file backing the matrix as a np.memmap, None to keep it in memory
+        :param block_size: number of rows computed at a time, the unit of progress when resuming
+        """
+        self.n_frames = n_frames
+        self.path = path
+        self.block_size = block_size
+        self.size = n_frames * (n_frames - 1) // 2
+        self.done = set()  # first rows of the blocks already computed
+        self.fingerprint = None
+        if path is None:
+            self.data = np.zeros(self.size, dtype=np.float32)
+        else:
+            self.data = self._open_memmap()
+
+    @property
+    def progress_file(self):
+        """
+        Name of the file recording the completed blocks next to the backing file
+        """
+        return "%s.json" % self.path
+
+    def _open_memmap(self):
+        """
+        Opens the backing file, reusing it when it holds a matrix of the same size
+        :return: np.memmap of the condensed matrix
+        """
+        nbytes = max(self.size, 1) * np.dtype(np.float32).itemsize
+        if os.path.exists(self.path) and os.path.getsize(self.path) == nbytes and os.path.exists(self.progress_file):
+            with open(self.progress_file, "r") as inn:
+                progress = json.load(inn)
+            if progress["n_frames"] == self.n_frames and progress["block_size"] == self.block_size:
+                self.done = set(progress["done"])
+                self.fingerprint = progress["fingerprint"]
+                return np.memmap(self.path, dtype=np.float32, mode="r+", shape=(max(self.size, 1),))[:self.size]
+        return np.memmap(self.path, dtype=np.float32, mode="w+", shape=(max(self.size, 1),))[:self.size]
+
+    def _save_progress(self):
+        """
+        Flushes the matrix and records which blocks are complete
+        """
+        if self.path is None:
+            return
+        self.data.flush()
+        progress = {"n_frames": self.n_frames, "block_size": self.block_size, "fingerprint": self.fingerprint,
+                    "done": sorted(self.done)}
+        with open(self.progress_file + ".tmp", "w") as out:
+            json.dump(progress, out)
+        os.replace(self.progress_file + ".tmp", self.progress_file)
+
+    def row_offset(self, i):
+        """
+        Position of the pair (i, i + 1) in the condensed array
+        :param i: row index
+        :return: int
+        """
+        return i * self.n_frames - i * (i + 1) // 2
+
+    def distance(self, i, j):
+        """
+        Distance between frames i and j
+        """
+        if i == j:
+            return 0.0
+        if i > j:
+            i, j = j, i
+        return float(self.data[self.row_offset(i) + j - i - 1])
+
+    def is_complete(self):
+        """
+        Whether every block of rows has been computed
+        """
+        return len(self.done) == len(range(0, self.n_frames, self.block_size))
+
+    @staticmethod
+    def compute_fingerprint(codes, sub_array):
+        """
+        Identifies the input of the matrix, so stored results are only reused for the same frames
+        """
+        digest = hashlib.sha1()
+        digest.update(str(codes.shape).encode())
+        digest.update(np.ascontiguousarray(codes).tobytes())
+        digest.update(np.ascontiguousarray(sub_array, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def fill(self, codes, sub_array, n_workers=1, verbose=False):
+        """
+        Computes the missing blocks of rows, saving the progress after each of them
+        :param codes: np.ndarray of letter codes, shape = (number of frames, string length)
+        :param sub_array: substitution matrix array
+        :param n_workers: number of threads computing blocks in parallel
+        :param verbose: whether to print the progress
+        """
+        fingerprint = self.compute_fingerprint(codes, sub_array)
+        if fingerprint != self.fingerprint:
+            # Stored blocks belong to other frames, start again
+            self.done = set()
+            self.fingerprint = fingerprint
+        starts = [start for start in range(0, self.n_frames, self.block_size) if start not in self.done]
+
+        def fill_rows(start):
+            end = min(start + self.block_size, self.n_frames)
+            dis = block_distances(codes[start:end], codes[start:], sub_array)
+            for i in range(start, end):
+                offset = self.row_offset(i)
+                self.data[offset:offset + self.n_frames - i - 1] = dis[i - start, i - start + 1:]
+            return start
+
+        if n_workers > 1:
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                results = executor.map(fill_rows, starts)
+                for start in results:
+                    self.done.add(start)
+                    self._save_progress()
+                    if verbose:
+                        print("Finished %s" % (min(start + self.block_size, self.n_frames) - 1))
+        else:
+            for start in starts:
+                fill_rows(start)
+                self.done.add(start)
+                self._save_progress()
+                if verbose:
+                    print("Finished %s" % (min(start + self.block_size, self.n_frames) - 1))
+        self._save_progress()
@@ -0,0 +1,49 @@
+# ===============================================================================
+# Trajencode
+# FragmentLibrary.py
+# Fragment library prepared once for the C encoder
+# ===============================================================================
+
+import numpy as np
+from _encodeframe import ffi
+
+
+class FragmentLibrary:
+
+    def __init__(self, sa_dict, scale=0.1):
+        """
+        Holds the library of fragments centred at the origin together with their invariants,
+        so the C encoder only has to process the MD windows
+        :param sa_dict: library of fragments to use
+        :param scale: factor applied to the library coordinates (Angstroms to nm by default)
+        """
+        self.keys = sorted(sa_dict.keys())
+        self.n_fragments = len(self.keys)
+        self.fragment_size = int(len(sa_dict[self.keys[0]]) / 3)
+        coordinates = np.array([sa_dict[key] for key in self.keys], dtype=np.float64)
+        coordinates = coordinates.reshape(self.n_fragments, self.fragment_size, 3) * scale
+        # Centred coordinates, stored contiguously as (n_fragments * fragment_size, 3)
+        centred = coordinates - coordinates.mean(axis=1, keepdims=True)
+        self.centred = np.ascontiguousarray(centred.reshape(-1, 3), dtype=np.float32)
+        # Inner product of every centred fragment, computed from the stored coordinates
+        self.inner = np.ascontiguousarray(
+            np.sum(self.centred.astype(np.float64).reshape(self.n_fragments, -1) ** 2, axis=1))
+        # Distances between the atoms i < j of every fragment, used to bound the RMSD before computing it
+        fragments = self.centred.astype(np.float64).reshape(self.n_fragments, self.fragment_size, 3)
+        first, second = np.triu_indices(self.fragment_size, k=1)
+        self.distances = np.ascontiguousarray(
+            np.sqrt(np.sum((fragments[:, first] - fragments[:, second]) ** 2, axis=-1)).ravel())
+        self.c_library = self._c_library()
+
+    def _c_library(self):
+        """
+        Generates the C structure pointing to the prepared arrays
+        :return: cdata fragment_library pointer
+        """
+        c_library = ffi.new("fragment_library *")
+        c_library.n_fragments = self.n_fragments
+        c_library.f_size = self.fragment_size
+        c_library.centred = ffi.cast("float(*)[3]", ffi.from_buffer(self.centred))
+        c_library.inner = ffi.cast("double *", ffi.from_buffer(self.inner))
+        c_library.distances = ffi.cast("double *", ffi.from_buffer(self.distances))
+        return c_library
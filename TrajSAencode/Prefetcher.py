@@ -0,0 +1,89 @@
+# ===============================================================================
+# Trajencode
+# Prefetcher.py
+# Background reading of the next chunks of a trajectory, overlapped with the encoding
+# ===============================================================================
+
+import queue
+import threading
+from TrajSAencode.Profiler import NULL_PROFILER
+
+# Seconds between checks of the stop signal while the queue is full
+POLL_INTERVAL = 0.1
+
+
+class _Failure:
+    """
+    Exception raised by the reading thread, re-raised in the consumer
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+
+_END = object()
+
+
+class Prefetcher:
+
+    def __init__(self, iterable, depth=2, profiler=None):
+        """
+        Iterates over an iterable on a background thread, keeping at most depth items ready in a queue.
+        Items are yielded in the same order, and the errors of the reader are raised by the consumer.
+        Reading mdtraj files and the C encoder both release the GIL for most of their work, so a thread
+        is enough to overlap them
+        :param iterable: iterable of the items to read, e.g. the chunks of md.iterload
+        :param depth: maximum number of items waiting in the queue, at most depth + 2 items are alive
+                      (the queue, the one being read and the one being processed)
+        :param profiler: StageProfiler timing the waits of the consumer, None to disable it
+        """
+        if depth < 1:
+            raise ValueError("The prefetch depth must be at least 1")
+        self.iterable = iterable
+        self.depth = depth
+        self.profiler = profiler if profiler is not None else NULL_PROFILER
+
+    def _read(self, items, stop):
+        """
+        Body of the reading thread, puts every item and finally the end marker or the error in the queue
+        """
+        try:
+            for item in self.iterable:
+                if not self._put(items, item, stop):
+                    return
+            self._put(items, _END, stop)
+        except BaseException as error:
+            self._put(items, _Failure(error), stop)
+
+    @staticmethod
+    def _put(items, item, stop):
+        """
+        Waits for a free slot of the queue, giving up when the consumer has stopped
+        :return: False if the consumer stopped before the item could be queued
+        """
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        items = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read, args=(items, stop), daemon=True)
+        reader.start()
+        try:
+            while True:
+                with self.profiler.stage("wait"):
+                    item = items.get()
+                if item is _END:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            # Release the reader when the consumer stops early or fails
+            stop.set()
+            reader.join()
@@ -0,0 +1,146 @@
+# ===============================================================================
+# Trajencode
+# Profiler.py
+# Opt-in timers of the stages of the encoding pipeline and throughput counters
+# ===============================================================================
+
+import json
+import sys
+import threading
+import time
+
+
+class _StageTimer:
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageProfiler:
+
+    def __init__(self, interval=0.0, stream=None, label=None):
+        """
+        Accumulates the time spent in every stage and the frames and residues processed.
+        Stages run by the encoding threads are summed over the threads
+        :param interval: seconds between the JSON stats lines written by tick, 0 to only produce the summary
+        :param stream: file receiving the stats lines, stderr by default
+        :param label: name added to the stats lines, e.g. the file being processed
+        """
+        self.interval = interval
+        self.label = label
+        self.stream = stream if stream is not None else sys.stderr
+        self.seconds = {}
+        self.calls = {}
+        self.frames = 0
+        self.residues = 0
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        """
+        Context manager timing a stage
+        :param name: name of the stage
+        """
+        return _StageTimer(self, name)
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def count(self, frames, residues):
+        """
+        Adds processed trajectory frames and residues (summed over the frames)
+        """
+        self.frames += frames
+        self.residues += residues
+
+    def tick(self):
+        """
+        Writes a stats line when the interval has elapsed
+        """
+        if self.interval > 0 and time.perf_counter() - self.last_report >= self.interval:
+            self.report()
+
+    def report(self):
+        """
+        Writes the current summary as a single JSON line
+        """
+        self.last_report = time.perf_counter()
+        self.stream.write(json.dumps(self.summary()) + "\n")
+        self.stream.flush()
+
+    def merge(self, summary):
+        """
+        Adds the stages and counters of the summary of another profiler, e.g. of a worker process
+        :param summary: dictionary returned by summary
+        """
+        for name, stage in summary["stages"].items():
+            with self.lock:
+                self.seconds[name] = self.seconds.get(name, 0.0) + stage["seconds"]
+                self.calls[name] = self.calls.get(name, 0) + stage["calls"]
+        self.count(summary["frames"], summary["residues"])
+
+    def summary(self):
+        """
+        Current state of the counters
+        :return: dictionary with the elapsed time, the throughput and the time of every stage
+        """
+        elapsed = time.perf_counter() - self.start
+        with self.lock:
+            stages = {name: {"seconds": seconds, "calls": self.calls[name],
+                             "fraction": seconds / elapsed if elapsed > 0 else 0.0}
+                      for name, seconds in self.seconds.items()}
+        return {"label": self.label, "elapsed": elapsed, "frames": self.frames, "residues": self.residues,
+                "frames_per_s": self.frames / elapsed if elapsed > 0 else 0.0,
+                "residues_per_s": self.residues / elapsed if elapsed > 0 else 0.0, "stages": stages}
+
+    def save(self, path):
+        """
+        Writes the summary as JSON
+        :param path: name of the output file
+        """
+        with open(path, "w") as out:
+            json.dump(self.summary(), out, indent=1)
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class NullProfiler:
+    """
+    Profiler doing nothing, used when the instrumentation is disabled
+    """
+    _timer = _NullTimer()
+
+    def stage(self, name):
+        return self._timer
+
+    def add(self, name, seconds):
+        pass
+
+    def count(self, frames, residues):
+        pass
+
+    def tick(self):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
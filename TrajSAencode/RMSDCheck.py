@@ -0,0 +1,49 @@
+# ===============================================================================
+# Trajencode
+# RMSDCheck.py
+# Cross-checks the closed-form QCP RMSD against the GSL Kabsch RMSD
+# ===============================================================================
+
+import numpy as np
+from _kabsch.lib import wrmsd_kabsch, qcp_rmsd
+from cffi import FFI
+
+# Largest absolute RMSD difference accepted between both engines
+RMSD_TOLERANCE = 1e-4
+
+
+def check_rmsd_methods(sa_dict, tolerance=RMSD_TOLERANCE, n_perturbed=200, noise=0.5, seed=0):
+    """
+    Compares both RMSD engines on every pair of library fragments and on randomly perturbed copies of them
+    :param sa_dict: library of fragments to use
+    :param tolerance: largest absolute difference allowed, in the units of the library
+    :param n_perturbed: number of perturbed fragment pairs to compare
+    :param noise: standard deviation of the perturbation added to the coordinates
+    :param seed: seed of the random generator
+    :return: largest absolute difference found
+    """
+    ffi = FFI()
+    rng = np.random.default_rng(seed)
+    fragments = [np.array(sa_dict[key], dtype=np.float32).reshape(-1, 3) for key in sorted(sa_dict.keys())]
+    fragment_size = fragments[0].shape[0]
+    pairs = [(fragment1, fragment2) for fragment1 in fragments for fragment2 in fragments]
+    for _ in range(n_perturbed):
+        i, j = rng.integers(len(fragments), size=2)
+        fragment1 = fragments[i] + rng.normal(scale=noise, size=fragments[i].shape).astype(np.float32)
+        fragment2 = fragments[j] + rng.normal(scale=noise, size=fragments[j].shape).astype(np.float32)
+        pairs.append((fragment1, fragment2))
+
+    max_diff = 0.0
+    for fragment1, fragment2 in pairs:
+        c_fragment1 = ffi.cast("float(*)[3]", ffi.from_buffer(fragment1))
+        c_fragment2 = ffi.cast("float(*)[3]", ffi.from_buffer(fragment2))
+        diff = abs(wrmsd_kabsch(fragment_size, c_fragment1, c_fragment2) - qcp_rmsd(fragment_size, c_fragment1, c_fragment2))
+        max_diff = max(max_diff, diff)
+    if max_diff > tolerance:
+        raise ValueError("QCP and GSL RMSD differ by %s, above the tolerance of %s" % (max_diff, tolerance))
+    return max_diff
+
+
+if __name__ == "__main__":
+    from TrajSAencode.SAlib import SADICT
+    print("Largest RMSD difference between QCP and GSL: %s" % check_rmsd_methods(SADICT))
@@ -0,0 +1,137 @@
+# ===============================================================================
+# Trajencode
+# SAClustering.py
+# Clustering of encoded frames without computing all the pairwise distances
+# ===============================================================================
+
+import numpy as np
+from TrajSAencode.SAMetric import block_distances, distance_matrix
+
+
+def frame_distances(frame, codes, sub_array):
+    """
+    Distances between one encoded frame and a set of encoded frames
+    :param frame: np.ndarray of letter codes, shape = (string length,)
+    :param codes: np.ndarray of letter codes, shape = (number of frames, string length)
+    :param sub_array: substitution matrix array
+    :return: np.ndarray of distances, shape = (number of frames,)
+    """
+    return sub_array[frame[np.newaxis, :], codes].sum(axis=1)
+
+
+def leader_clustering(codes, sub_array, threshold, block_size=1024):
+    """
+    Single pass leader clustering: a frame joins the closest leader within the threshold,
+    otherwise it becomes the leader of a new cluster
+    :param codes: np.ndarray of letter codes, shape = (number of frames, string length)
+    :param sub_array: substitution matrix array
+    :param threshold: largest distance between a frame and the leader of its cluster
+    :param block_size: number of frames compared at once against the known leaders
+    :return: np.ndarray of labels and list of the frame indexes of the leaders
+    """
+    n_frames = codes.shape[0]
+    labels = np.zeros(n_frames, dtype=np.int64)
+    leaders = []
+    for start in range(0, n_frames, block_size):
+        end = min(start + block_size, n_frames)
+        block = codes[start:end]
+        n_known = len(leaders)
+        # Compare the whole block against the leaders found before it
+        if n_known > 0:
+            dis = block_distances(block, codes[leaders], sub_array)
+            closest = np.argmin(dis, axis=1)
+            closest_dis = dis[np.arange(end - start), closest]
+        for i in range(end - start):
+            best, best_dis = -1, None
+            if n_known > 0 and closest_dis[i] <= threshold:
+                best, best_dis = closest[i], closest_dis[i]
+            # Leaders created inside this block
+            if len(leaders) > n_known:
+                new_dis = frame_distances(block[i], codes[leaders[n_known:]], sub_array)
+                new_closest = int(np.argmin(new_dis))
+                if new_dis[new_closest] <= threshold and (best_dis is None or new_dis[new_closest] < best_dis):
+                    best = n_known + new_closest
+            if best < 0:
+                best = len(leaders)
+                leaders.append(start + i)
+            labels[start + i] = best
+    return labels, leaders
+
+
+def assign_to_medoids(codes, medoids, sub_array, block_size=4096):
+    """
+    Assigns every frame to its closest medoid
+    :param codes: np.ndarray of letter codes, shape = (number of frames, string length)
+    :param medoids: list of frame indexes of the medoids
+    :param sub_array: substitution matrix array
+    :param block_size: number of frames compared at once
+    :return: np.ndarray of labels and total distance of the frames to their medoids
+    """
+    labels = np.zeros(codes.shape[0], dtype=np.int64)
+    cost = 0.0
+    for start in range(0, codes.shape[0], block_size):
+        dis = block_distances(codes[start:start + block_size], codes[medoids], sub_array)
+        labels[start:start + block_size] = np.argmin(dis, axis=1)
+        cost += np.min(dis, axis=1).sum()
+    return labels, cost
+
+
+def k_medoids(dis, n_clusters, rng, max_iter=100):
+    """
+    k-medoids on a precomputed distance matrix, k-medoids++ initialisation and alternating updates
+    :param dis: square np.ndarray of distances
+    :param n_clusters: number of clusters
+    :param rng: np.random.Generator
+    :param max_iter: largest number of updates
+    :return: list of the indexes of the medoids
+    """
+    n_frames = dis.shape[0]
+    medoids = [int(rng.integers(n_frames))]
+    for _ in range(1, n_clusters):
+        closest = dis[:, medoids].min(axis=1)
+        if closest.sum() > 0:
+            medoids.append(int(rng.choice(n_frames, p=closest / closest.sum())))
+        else:
+            medoids.append(int(rng.choice(np.setdiff1d(np.arange(n_frames), medoids))))
+    for _ in range(max_iter):
+        labels = np.argmin(dis[:, medoids], axis=1)
+        new_medoids = []
+        for c, medoid in enumerate(medoids):
+            members = np.flatnonzero(labels == c)
+            if len(members) == 0:
+                new_medoids.append(medoid)
+                continue
+            new_medoids.append(int(members[np.argmin(dis[np.ix_(members, members)].sum(axis=1))]))
+        if new_medoids == medoids:
+            break
+        medoids = new_medoids
+    return medoids
+
+
+def clara(codes, sub_array, n_clusters, n_samples=5, sample_size=None, seed=0):
+    """
+    CLARA: k-medoids on random samples of frames, keeping the medoids with the lowest cost on all the frames
+    :param codes: np.ndarray of letter codes, shape = (number of frames, string length)
+    :param sub_array: substitution matrix array
+    :param n_clusters: number of clusters
+    :param n_samples: number of random samples
+    :param sample_size: number of frames per sample, 40 + 2 * n_clusters by default
+    :param seed: seed of the random generator
+    :return: np.ndarray of labels and list of the frame indexes of the medoids
+    """
+    n_frames = codes.shape[0]
+    if n_frames <= n_clusters:
+        return np.arange(n_frames), list(range(n_frames))
+    if sample_size is None:
+        sample_size = 40 + 2 * n_clusters
+    sample_size = min(max(sample_size, n_clusters), n_frames)
+    rng = np.random.default_rng(seed)
+    best_labels, best_medoids, best_cost = None, None, None
+    for _ in range(n_samples):
+        sample = np.sort(rng.choice(n_frames, size=sample_size, replace=False))
+        dis = distance_matrix(codes[sample], sub_array)
+        medoids = [int(sample[m]) for m in k_medoids(dis, n_clusters, rng)]
+        labels, cost = assign_to_medoids(codes, medoids, sub_array)
+        if best_cost is None or cost < best_cost:
+            best_labels, best_medoids, best_cost = labels, medoids, cost
+    return best_labels, best_medoids
@@ -1,27 +1,62 @@
+import threading
 import numpy as np
-from _encodeframe.lib import encode_frame
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from numpy.lib.stride_tricks import sliding_window_view
+from _encodeframe.lib import encode_frames, encode_windows, certify_windows, RMSD_GSL, RMSD_QCP
 from cffi import FFI
+from TrajSAencode.FragmentLibrary import FragmentLibrary
+from TrajSAencode.SAFormat import SABinaryWriter, EXTENSION
+from TrajSAencode.Profiler import NULL_PROFILER
+
+# RMSD engines available in the C encoder
+RMSD_METHODS = {"gsl": RMSD_GSL, "qcp": RMSD_QCP}
+# Output formats: text .sasta, binary .sab or both
+OUTPUT_FORMATS = ["sasta", "sab", "both"]
+# Default buffer of the output files, large enough to hold many frames between writes
+BUFFER_SIZE = 2 ** 20
 
 
 class SAEncoder:
 
-    def __init__(self, sa_dict):
+    def __init__(self, sa_dict, rmsd_method="gsl", output_format="sasta", buffer_size=BUFFER_SIZE, cache=None,
+                 prune=False, profiler=None):
         """
         Encodes trajectories using a library of fragments
         :param sa_dict: library of fragments to use
+        :param rmsd_method: RMSD engine, "gsl" for the GSL Kabsch or "qcp" for the closed-form quaternion method
+        :param output_format: "sasta" for text files, "sab" for binary files or "both"
+        :param buffer_size: size in bytes of the write buffer of every output file
+        :param cache: WindowCache remembering the fragment of windows already encoded, None to search every window
+        :param prune: skip the fragments whose RMSD lower bound exceeds the best RMSD found, same result
+                      as the exhaustive search
+        :param profiler: StageProfiler timing the encoding, mapping and writing, None to disable it
         """
-
+        if rmsd_method not in RMSD_METHODS:
+            raise ValueError("Unknown RMSD method %s, options: %s" % (rmsd_method, ", ".join(RMSD_METHODS)))
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError("Unknown output format %s, options: %s" % (output_format, ", ".join(OUTPUT_FORMATS)))
+        self.output_format = output_format
         self.sa_dict = sa_dict
-        self.fragment_size = int(len(self.sa_dict[list(self.sa_dict.keys())[0]]) / 3)
-        # Convert the sa library to a format compatible with the C wrapper
-        self.sa_library = np.ndarray(shape=(len(self.sa_dict) * self.fragment_size, 3),
-                                     buffer=np.array([self.sa_dict[key] for key in sorted(self.sa_dict.keys())], dtype=np.float32),
-                                     dtype=np.float32)
-        self.sa_library /= 10
+        self.rmsd_method = rmsd_method
+        # Prepare the library once: centred fragments and their invariants for the C encoder
+        self.library = FragmentLibrary(self.sa_dict)
+        self.fragment_size = self.library.fragment_size
         # Generate a mapping of the SA fragment name to its index
         self.sa_code_map = self._generate_samap()
+        # Lookup table from fragment index to its letter, to map whole blocks at once
+        self.sa_code_lut = np.frombuffer("".join(self.library.keys).encode("ascii"), dtype=np.uint8)
+        self.buffer_size = buffer_size
+        self.cache = cache
+        self.prune = prune
+        # Windows searched and RMSD evaluations avoided by the pruned search
+        self.windows_searched = 0
+        self.skipped_evaluations = 0
+        self.stats_lock = threading.Lock()
+        self.profiler = profiler if profiler is not None else NULL_PROFILER
         self.output_file = {}
         self.output_file_name = ""
+        self.binary_file = {}
         self.ffi = FFI()
 
 
@@ -31,35 +66,159 @@ class SAEncoder:
         :return:
         """
         samap = {}
-        for i, key in enumerate(self.sa_dict.keys()):
+        for i, key in enumerate(self.library.keys):
             samap[i] = key
         return samap
 
-    def _c_encode(self, frame):
+    def encode_frames(self, xyz_block):
         """
-        Encodes the given frame, into a string of SA fragments
-        :param frame: trajectory frame, (np.ndarray, shape = (number of residues,3))
-        :return: string of the encoded frame
+        Encodes a block of frames with a single call to the C encoder
+        :param xyz_block: block of frames, (np.ndarray, shape = (number of frames, number of residues, 3))
+        :return: np.ndarray of fragment indexes, shape = (number of frames, number of windows)
         """
+        xyz_block = np.ascontiguousarray(xyz_block, dtype=np.float32)
+        if xyz_block.ndim == 2:
+            xyz_block = xyz_block[np.newaxis]
         # Variables needed for the C function
-        protein_length = int(frame.shape[0])
+        n_frames, protein_length = int(xyz_block.shape[0]), int(xyz_block.shape[1])
         n_windows = protein_length - self.fragment_size + 1
-        n_fragments = int(len(self.sa_dict))
-        encoding = np.zeros(n_windows, dtype=np.int32)
-        mdframe = self.ffi.cast("float(*)[3]", frame.ctypes.data)
-        fragments = self.ffi.cast("float(*)[3]", self.sa_library.ctypes.data)
+        encoding = np.zeros((n_frames, n_windows), dtype=np.int32)
+        if n_frames == 0 or n_windows <= 0:
+            return encoding
+        if self.cache is not None:
+            # Windows of shape (number of frames, number of windows, fragment size, 3)
+            windows = np.moveaxis(sliding_window_view(xyz_block, self.fragment_size, axis=1), -1, 2)
+            return self.cache.encode(windows.reshape(-1, self.fragment_size, 3),
+                                     self.encode_windows, self.certify_windows).reshape(n_frames, n_windows)
+        mdframes = self.ffi.cast("float(*)[3]", xyz_block.ctypes.data)
         c_encoding = self.ffi.cast("int *", self.ffi.from_buffer(encoding, require_writable=True))
-        # Call to the C function that does the encoding
-        encode_frame(n_windows, n_fragments, self.fragment_size, mdframe, fragments, c_encoding)
-        # Convert the list of indexes to SA fragment names
-        econded_string = self._map_encoding(c_encoding, n_windows)
-        return econded_string
-
-    def _map_encoding(self, encoded_prot, n_windows):
-        encoded_string = ""
-        for i in range(n_windows):
-            encoded_string += self.sa_code_map[encoded_prot[i]]
-        return encoded_string
+        # Call to the C function that encodes the whole block
+        skipped = self._skipped_counter()
+        with self.profiler.stage("encode"):
+            encode_frames(n_frames, protein_length, self.library.c_library, mdframes, c_encoding,
+                          RMSD_METHODS[self.rmsd_method], skipped)
+        self._count_search(n_frames * n_windows, skipped)
+        return encoding
+
+    def encode_windows(self, windows, return_second=False):
+        """
+        Encodes independent windows with a single call to the C encoder
+        :param windows: np.ndarray of shape (number of windows, fragment size, 3)
+        :param return_second: also return, for every window, a lower bound of its RMSD to the other fragments
+        :return: np.ndarray of fragment indexes, one per window, and the np.ndarray of bounds with return_second
+        """
+        windows = np.ascontiguousarray(windows, dtype=np.float32)
+        encoding = np.zeros(windows.shape[0], dtype=np.int32)
+        second = np.zeros(windows.shape[0], dtype=np.float64)
+        if windows.shape[0] > 0:
+            c_windows = self.ffi.cast("float(*)[3]", windows.ctypes.data)
+            c_encoding = self.ffi.cast("int *", self.ffi.from_buffer(encoding, require_writable=True))
+            c_second = self.ffi.cast("double *", self.ffi.from_buffer(second, require_writable=True)) \
+                if return_second else self.ffi.NULL
+            skipped = self._skipped_counter()
+            with self.profiler.stage("encode"):
+                encode_windows(windows.shape[0], self.library.c_library, c_windows, c_encoding,
+                               RMSD_METHODS[self.rmsd_method], skipped, c_second)
+            self._count_search(windows.shape[0], skipped)
+        if return_second:
+            return encoding, second
+        return encoding
+
+    def certify_windows(self, windows, codes, floors=None):
+        """
+        Checks candidate fragments of independent windows without searching the library: a candidate is certified
+        when its RMSD to the window is below a lower bound of the RMSD to every other fragment, the larger of the
+        floor of the window and the RMSD lower bounds of the pruned search
+        :param windows: np.ndarray of shape (number of windows, fragment size, 3)
+        :param codes: np.ndarray of the candidate fragment index of every window
+        :param floors: np.ndarray of lower bounds of the RMSD of every window to the other fragments, None if unknown
+        :return: np.ndarray of bool, True where the candidate is the fragment the search returns
+        """
+        windows = np.ascontiguousarray(windows, dtype=np.float32)
+        codes = np.ascontiguousarray(codes, dtype=np.int32)
+        if floors is None:
+            floors = np.zeros(windows.shape[0], dtype=np.float64)
+        floors = np.ascontiguousarray(floors, dtype=np.float64)
+        certified = np.zeros(windows.shape[0], dtype=np.int32)
+        if windows.shape[0] == 0:
+            return certified.astype(bool)
+        c_windows = self.ffi.cast("float(*)[3]", windows.ctypes.data)
+        c_codes = self.ffi.cast("int *", self.ffi.from_buffer(codes))
+        c_floors = self.ffi.cast("double *", self.ffi.from_buffer(floors))
+        c_certified = self.ffi.cast("int *", self.ffi.from_buffer(certified, require_writable=True))
+        with self.profiler.stage("encode"):
+            certify_windows(windows.shape[0], self.library.c_library, c_windows, c_codes, c_floors, c_certified,
+                            RMSD_METHODS[self.rmsd_method])
+        return certified.astype(bool)
+
+    def _skipped_counter(self):
+        """
+        Counter passed to the C encoder, a NULL pointer selects the exhaustive search
+        """
+        if self.prune:
+            return self.ffi.new("unsigned long long *")
+        return self.ffi.NULL
+
+    def _count_search(self, n_windows, skipped):
+        with self.stats_lock:
+            self.windows_searched += n_windows
+            if skipped != self.ffi.NULL:
+                self.skipped_evaluations += skipped[0]
+
+    def search_stats(self):
+        """
+        Statistics of the library search
+        :return: dictionary with the windows searched, the RMSD evaluations done and skipped by the pruning
+        """
+        total = self.windows_searched * self.library.n_fragments
+        return {"windows": self.windows_searched, "evaluations": total - self.skipped_evaluations,
+                "skipped": self.skipped_evaluations,
+                "skipped_fraction": self.skipped_evaluations / total if total > 0 else 0.0}
+
+    def _map_block(self, encoding, names):
+        """
+        Converts a block of encoded frames to the bytes of their fasta entries
+        :param encoding: np.ndarray of fragment indexes, shape = (number of frames, number of windows)
+        :param names: fasta names of the frames in the block
+        :return: bytes with a header line and a sequence line per frame
+        """
+        n_frames, n_windows = encoding.shape
+        sequences = np.empty((n_frames, n_windows + 1), dtype=np.uint8)
+        sequences[:, :n_windows] = self.sa_code_lut[encoding]
+        sequences[:, n_windows] = ord("\n")
+        sequences = sequences.tobytes()
+        row = n_windows + 1
+        headers = ("\n".join(names) + "\n").encode("ascii").splitlines(keepends=True)
+        return b"".join([part for i, header in enumerate(headers)
+                         for part in (header, sequences[i * row:(i + 1) * row])])
+
+    @staticmethod
+    def group_names(names):
+        """
+        Splits a block of fasta names into runs of consecutive frames that go to the same file
+        :param names: fasta names of the frames in the block
+        :return: generator of (file base name, start, end)
+        """
+        bases = [name.split(">")[1].split("|")[0] for name in names]
+        start = 0
+        for end in range(1, len(names) + 1):
+            if end < len(names) and bases[end] == bases[start]:
+                continue
+            yield bases[start], start, end
+            start = end
+
+    def _set_output(self, base):
+        """
+        Selects the output file for the given file base name, opening it if needed
+        :param base: fasta name without the frame number, as returned by group_names
+        :return:
+        """
+        # If the file or chain has changed, switch to its file, opening it the first time
+        if "%s.sasta" % base != self.output_file_name:
+            self.output_file_name = "%s.sasta" % base
+            if self.output_file_name not in self.output_file and self.output_format != "sab":
+                self.output_file[self.output_file_name] = open(self.output_file_name, "wb",
+                                                               buffering=self.buffer_size)
 
     def encode_protein(self, frame, name):
         """
@@ -68,19 +227,108 @@ class SAEncoder:
         :param name: fasta name of the frame to encode
         :return:
         """
-        # If the file or chain has changed, close the file and open a new one
-        if "%s.sasta" % name.split(">")[1].split("|")[0] != self.output_file_name:
-            self.output_file_name = "%s.sasta" % name.split(">")[1].split("|")[0]
-            if self.output_file_name not in self.output_file:
-                self.output_file[self.output_file_name] = open(self.output_file_name, "w")
-        # Encode the protein frame
-        encoded_string = self._c_encode(frame)
-        self.output_file[self.output_file_name].write(name)
-        self.output_file[self.output_file_name].write("\n")
-        self.output_file[self.output_file_name].write(encoded_string)
-        self.output_file[self.output_file_name].write("\n")
+        self.write_encoding(self.encode_frames(frame), [name])
+
+    def encode_chunk(self, xyz_block, names):
+        """
+        Encodes a block of frames at once and writes them to the output files
+        :param xyz_block: block of frames, (np.ndarray, shape = (number of frames, number of residues,3))
+        :param names: fasta names of the frames in the block
+        :return:
+        """
+        self.write_encoding(self.encode_frames(xyz_block), names)
+
+    def write_encoding(self, encoding, names):
+        """
+        Writes a block of encoded frames to the output files
+        :param encoding: np.ndarray of fragment indexes, shape = (number of frames, number of windows)
+        :param names: fasta names of the frames in the block
+        :return:
+        """
+        # One write per run of consecutive frames of the same file
+        for base, start, end in self.group_names(names):
+            self._set_output(base)
+            if self.output_format != "sab":
+                with self.profiler.stage("map"):
+                    block = self._map_block(encoding[start:end], names[start:end])
+                with self.profiler.stage("write"):
+                    self.output_file[self.output_file_name].write(block)
+            if self.output_format != "sasta":
+                with self.profiler.stage("write"):
+                    self._write_binary(base, encoding[start:end], names[start:end])
+
+    def _write_binary(self, base, encoding, names):
+        """
+        Appends a block of encoded frames of the same file to its binary file
+        :param base: fasta name without the frame number
+        :param encoding: np.ndarray of fragment indexes, shape = (number of frames, number of windows)
+        :param names: fasta names of the frames in the block
+        """
+        file_name = "%s%s" % (base, EXTENSION)
+        if file_name not in self.binary_file:
+            self.binary_file[file_name] = SABinaryWriter(file_name, "".join(self.library.keys),
+                                                         buffering=self.buffer_size)
+        self.binary_file[file_name].write(encoding, [name.split("|")[1] for name in names])
+
+    def encode_parallel(self, chunks, n_workers=1):
+        """
+        Encodes blocks of frames on a pool of threads. The C encoder releases the GIL,
+        so the blocks are encoded concurrently and yielded back in their original order
+        :param chunks: iterable of (xyz_block, names), as yielded by TrajLoader.chunks
+        :param n_workers: number of threads encoding at the same time
+        :return: generator of (xyz_block, names, encoding)
+        """
+        if n_workers <= 1:
+            for xyz_block, names in chunks:
+                yield xyz_block, names, self.encode_frames(xyz_block)
+            return
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            # Keep a bounded number of blocks in flight to limit memory usage
+            pending = deque()
+            for xyz_block, names in chunks:
+                pending.append((xyz_block, names, executor.submit(self.encode_frames, xyz_block)))
+                if len(pending) >= 2 * n_workers:
+                    xyz_block, names, future = pending.popleft()
+                    yield xyz_block, names, future.result()
+            while pending:
+                xyz_block, names, future = pending.popleft()
+                yield xyz_block, names, future.result()
+
+    def flush_output(self):
+        """
+        Flushes every open output file, so they can be recorded in a checkpoint
+        :return: dictionary with the size in bytes of every output file
+        """
+        offsets = {}
+        for key in self.output_file:
+            self.output_file[key].flush()
+            offsets[key] = self.output_file[key].tell()
+        for key in self.binary_file:
+            offsets[key] = self.binary_file[key].flush()
+        return offsets
+
+    def resume_output(self, offsets, frame_numbers):
+        """
+        Reopens the output files of an interrupted run to append to them,
+        dropping anything written after the checkpoint
+        :param offsets: size in bytes of every output file at the checkpoint, as returned by flush_output
+        :param frame_numbers: frame numbers already written to every file
+        :return:
+        """
+        for key, offset in offsets.items():
+            if key.endswith(EXTENSION):
+                self.binary_file[key] = SABinaryWriter(key, "".join(self.library.keys), buffering=self.buffer_size,
+                                                       resume=(offset, frame_numbers))
+            else:
+                with open(key, "r+b") as out:
+                    out.truncate(offset)
+                self.output_file[key] = open(key, "ab", buffering=self.buffer_size)
 
     def close_output(self):
         for key in self.output_file:
             self.output_file[key].close()
+        for key in self.binary_file:
+            self.binary_file[key].close()
         self.output_file = {}
+        self.binary_file = {}
+        self.output_file_name = ""
@@ -0,0 +1,150 @@
+# ===============================================================================
+# Trajencode
+# SAFormat.py
+# Binary companion of the .sasta format: contiguous uint8 codes with a frame index
+# ===============================================================================
+
+import os
+import struct
+import numpy as np
+from TrajSAencode.SAMetric import decode_strings
+
+# Layout of the file:
+#   header (HEADER_SIZE bytes): magic, number of frames, number of windows, offset of the codes,
+#                               offset of the frame index, length of the alphabet and the alphabet
+#   codes: uint8 matrix (number of frames, number of windows), C order
+#   frame index: int64 frame number of every row
+MAGIC = b"TSAENC01"
+HEADER_FORMAT = "<8sQQQQI64s"
+HEADER_SIZE = 128
+EXTENSION = ".sab"
+
+
+def _pack_header(n_frames, n_windows, index_offset, alphabet):
+    header = struct.pack(HEADER_FORMAT, MAGIC, n_frames, n_windows, HEADER_SIZE, index_offset, len(alphabet),
+                         alphabet.encode("ascii"))
+    return header.ljust(HEADER_SIZE, b"\0")
+
+
+class SABinaryWriter:
+
+    def __init__(self, path, alphabet, buffering=-1, resume=None):
+        """
+        Writes encoded frames to a binary .sab file
+        :param path: name of the output file
+        :param alphabet: string with the letter of every code, in code order
+        :param buffering: buffer size of the output file, -1 for the default
+        :param resume: (byte offset, frame numbers) of the frames already written by an interrupted run,
+                       anything after the offset is dropped and new frames are appended
+        """
+        if len(alphabet) > 64:
+            raise ValueError("Alphabets of more than 64 letters are not supported by the binary format")
+        self.path = path
+        self.alphabet = alphabet
+        self.n_frames = 0
+        self.n_windows = None
+        self.frame_numbers = []
+        if resume is not None and len(resume[1]) > 0:
+            offset, frame_numbers = resume
+            self.frame_numbers = [int(number) for number in frame_numbers]
+            self.n_frames = len(self.frame_numbers)
+            self.n_windows = (offset - HEADER_SIZE) // self.n_frames
+            self.handler = open(path, "r+b", buffering=buffering)
+            self.handler.truncate(offset)
+            self.handler.seek(offset)
+            return
+        self.handler = open(path, "wb", buffering=buffering)
+        # Placeholder header, completed on close
+        self.handler.write(_pack_header(0, 0, HEADER_SIZE, alphabet))
+
+    def write(self, codes, frame_numbers):
+        """
+        Appends a block of encoded frames
+        :param codes: np.ndarray of codes, shape = (number of frames, number of windows)
+        :param frame_numbers: frame number of every row
+        """
+        codes = np.asarray(codes)
+        if codes.ndim == 1:
+            codes = codes[np.newaxis]
+        if self.n_windows is None:
+            self.n_windows = codes.shape[1]
+        elif codes.shape[1] != self.n_windows:
+            raise ValueError("All the frames of a binary file must have the same number of windows")
+        self.handler.write(np.ascontiguousarray(codes, dtype=np.uint8).tobytes())
+        self.frame_numbers.extend(int(number) for number in frame_numbers)
+        self.n_frames += codes.shape[0]
+
+    def flush(self):
+        """
+        Flushes the frames written so far
+        :return: size in bytes of the header and the codes
+        """
+        self.handler.flush()
+        return self.handler.tell()
+
+    def close(self):
+        """
+        Writes the frame index and the final header
+        """
+        index_offset = HEADER_SIZE + self.n_frames * (self.n_windows or 0)
+        self.handler.write(np.array(self.frame_numbers, dtype=np.int64).tobytes())
+        self.handler.seek(0)
+        self.handler.write(_pack_header(self.n_frames, self.n_windows or 0, index_offset, self.alphabet))
+        self.handler.close()
+
+
+class SABinaryReader:
+
+    def __init__(self, path):
+        """
+        Memory maps a binary .sab file, frames are only read from disk when accessed
+        :param path: name of the binary file
+        """
+        self.path = path
+        with open(path, "rb") as inn:
+            header = inn.read(HEADER_SIZE)
+        magic, n_frames, n_windows, codes_offset, index_offset, alphabet_len, alphabet = \
+            struct.unpack(HEADER_FORMAT, header[:struct.calcsize(HEADER_FORMAT)])
+        if magic != MAGIC:
+            raise ValueError("%s is not a binary SA file" % path)
+        self.n_frames = n_frames
+        self.n_windows = n_windows
+        self.alphabet = alphabet[:alphabet_len].decode("ascii")
+        if n_frames > 0:
+            self.codes = np.memmap(path, dtype=np.uint8, mode="r", offset=codes_offset, shape=(n_frames, n_windows))
+            self.frame_index = np.memmap(path, dtype=np.int64, mode="r", offset=index_offset, shape=(n_frames,))
+        else:
+            self.codes = np.zeros((0, n_windows), dtype=np.uint8)
+            self.frame_index = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return self.n_frames
+
+    def __getitem__(self, item):
+        return self.codes[item]
+
+    def frame_range(self, first, last):
+        """
+        Codes of the frames numbered from first to last (both included), without reading the rest of the file.
+        Frame numbers are stored in increasing order, as the encoder writes them
+        :param first: first frame number
+        :param last: last frame number
+        :return: np.ndarray view of the codes
+        """
+        start = np.searchsorted(self.frame_index, first, side="left")
+        stop = np.searchsorted(self.frame_index, last, side="right")
+        return self.codes[start:stop]
+
+    def strings(self, start=0, stop=None):
+        """
+        Decodes a range of rows back into SA strings
+        :return: list of SA strings
+        """
+        return decode_strings(self.codes[start:stop], self.alphabet)
+
+
+def binary_name(sasta_name):
+    """
+    Name of the binary companion of a .sasta file
+    """
+    return "%s%s" % (os.path.splitext(sasta_name)[0], EXTENSION)
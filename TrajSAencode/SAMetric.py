@@ -0,0 +1,187 @@
+# ===============================================================================
+# Trajencode
+# SAMetric.py
+# Vectorized distances between SA strings using a substitution matrix
+# ===============================================================================
+
+import numpy as np
+from _kabsch.lib import wrmsd_kabsch, qcp_rmsd
+from cffi import FFI
+from concurrent.futures import ThreadPoolExecutor
+
+# RMSD engines available to build the substitution matrix
+RMSD_FUNCTIONS = {"gsl": wrmsd_kabsch, "qcp": qcp_rmsd}
+
+
+def substitution_matrix(sa_dict, fragment_size, rmsd_function):
+    """
+    Substitution cost of every pair of letters, the RMSD between their fragments
+    :param sa_dict: dictionary of letter to fragment coordinates
+    :param fragment_size: number of atoms of every fragment
+    :param rmsd_function: RMSD function from RMSD_FUNCTIONS
+    :return: dictionary of (letter, letter) to substitution cost
+    """
+    ffi = FFI()
+    sub_matrix = {}
+    keys = sorted(sa_dict.keys())
+    for i in range(len(keys)):
+        for j in range(i, len(keys)):
+            if i == j:
+                sub_matrix.setdefault((keys[i], keys[j]), 0.0)
+            else:
+                fragment1 = np.array(sa_dict[keys[i]], dtype=np.float32)
+                c_fragment1 = ffi.cast("float(*)[3]", fragment1.ctypes.data)
+                fragment2 = np.array(sa_dict[keys[j]], dtype=np.float32)
+                c_fragment2 = ffi.cast("float(*)[3]", fragment2.ctypes.data)
+                rmsd = rmsd_function(fragment_size, c_fragment1, c_fragment2)
+                sub_matrix.setdefault((keys[i], keys[j]), rmsd)
+                sub_matrix.setdefault((keys[j], keys[i]), rmsd)
+    return sub_matrix
+
+
+def sub_matrix_array(sub_matrix, keys):
+    """
+    Converts a substitution matrix dictionary into an array
+    :param sub_matrix: dictionary of (letter, letter) to substitution cost
+    :param keys: list of letters, its order gives the codes
+    :return: np.ndarray of shape (number of letters, number of letters)
+    """
+    sub_array = np.zeros((len(keys), len(keys)), dtype=np.float64)
+    for i, key1 in enumerate(keys):
+        for j, key2 in enumerate(keys):
+            sub_array[i, j] = sub_matrix[(key1, key2)]
+    return sub_array
+
+
+def encode_strings(strings, keys):
+    """
+    Converts SA strings of the same length into a matrix of letter codes
+    :param strings: list of SA strings
+    :param keys: list of letters, its order gives the codes
+    :return: np.ndarray of uint8, shape = (number of strings, string length)
+    """
+    if len(strings) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    length = len(strings[0])
+    if any(len(string) != length for string in strings):
+        raise ValueError("All the SA strings must have the same length")
+    lookup = np.full(256, 255, dtype=np.uint8)
+    for i, key in enumerate(keys):
+        lookup[ord(key)] = i
+    codes = lookup[np.frombuffer("".join(strings).encode("ascii"), dtype=np.uint8)].reshape(len(strings), length)
+    if np.any(codes == 255):
+        raise ValueError("SA strings contain letters missing from the alphabet")
+    return codes
+
+
+def decode_strings(codes, keys):
+    """
+    Converts a matrix of letter codes back into SA strings
+    :param codes: np.ndarray of letter codes, shape = (number of strings, string length)
+    :param keys: list of letters, its order gives the codes
+    :return: list of SA strings
+    """
+    lookup = np.frombuffer("".join(keys).encode("ascii"), dtype=np.uint8)
+    letters = lookup[np.asarray(codes)]
+    return [row.tobytes().decode("ascii") for row in letters]
+
+
+def block_distances(codes1, codes2, sub_array):
+    """
+    Distances between two blocks of encoded frames. The costs are added position by position,
+    in the same order as a sequential sum over the string, so results are bit-identical to it
+    :param codes1: np.ndarray of letter codes, shape = (n1, string length)
+    :param codes2: np.ndarray of letter codes, shape = (n2, string length)
+    :param sub_array: substitution matrix array
+    :return: np.ndarray of distances, shape = (n1, n2)
+    """
+    dis = np.zeros((codes1.shape[0], codes2.shape[0]), dtype=np.float64)
+    for k in range(codes1.shape[1]):
+        dis += sub_array[codes1[:, k]][:, codes2[:, k]]
+    return dis
+
+
+def distance_matrix(codes, sub_array, out=None, block_size=256, n_workers=1, verbose=False):
+    """
+    Computes all the pairwise distances between encoded frames, one block of rows at a time
+    :param codes: np.ndarray of letter codes, shape = (number of frames, string length)
+    :param sub_array: substitution matrix array
+    :param out: square array to fill, allocated when None
+    :param block_size: number of frames per block
+    :param n_workers: number of threads computing blocks of rows in parallel
+    :param verbose: whether to print the progress
+    :return: square np.ndarray of distances
+    """
+    n_frames = codes.shape[0]
+    if out is None:
+        out = np.zeros((n_frames, n_frames), dtype=np.float64)
+    starts = list(range(0, n_frames, block_size))
+
+    def fill_rows(start):
+        # Upper triangle of the block of rows, mirrored into the lower triangle
+        end = min(start + block_size, n_frames)
+        dis = block_distances(codes[start:end], codes[start:], sub_array)
+        out[start:end, start:] = dis
+        out[start:, start:end] = dis.T
+        return end
+
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            for end in executor.map(fill_rows, starts):
+                if verbose:
+                    print("Finished %s" % (end - 1))
+    else:
+        for start in starts:
+            end = fill_rows(start)
+            if verbose:
+                print("Finished %s" % (end - 1))
+    return out
+
+
+def profile_counts(codes, n_letters):
+    """
+    Position specific letter counts of a set of encoded frames
+    :param codes: np.ndarray of letter codes, shape = (number of frames, string length)
+    :param n_letters: number of letters in the alphabet
+    :return: np.ndarray of counts, shape = (string length, number of letters)
+    """
+    counts = np.zeros((codes.shape[1], n_letters), dtype=np.int64)
+    positions = np.broadcast_to(np.arange(codes.shape[1]), codes.shape)
+    np.add.at(counts, (positions.ravel(), codes.ravel()), 1)
+    return counts
+
+
+def profile_tables(profiles, sizes, sub_array):
+    """
+    Average substitution cost of every letter at every position against each profile.
+    As the distance is a sum of per position costs, the average distance of a frame to
+    the members of a cluster is the sum of these costs over the letters of the frame
+    :param profiles: np.ndarray of counts, shape = (number of clusters, string length, number of letters)
+    :param sizes: number of frames behind every profile
+    :param sub_array: substitution matrix array
+    :return: np.ndarray of costs, shape = (string length, number of letters, number of clusters)
+    """
+    sizes = np.asarray(sizes, dtype=np.float64)
+    tables = np.einsum("cpb,ab->pac", profiles, sub_array)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tables = np.where(sizes > 0, tables / sizes, np.inf)
+    return tables
+
+
+def profile_distances(codes, tables, clusters=None):
+    """
+    Average distance of encoded frames to the members of every profile. The costs are added position by
+    position, in the same order as block_distances, so only one (frames, clusters) array is allocated
+    :param codes: np.ndarray of letter codes, shape = (number of frames, string length)
+    :param tables: costs from profile_tables, shape = (string length, number of letters, number of clusters)
+    :param clusters: indexes of the profiles to score, all of them when None
+    :return: np.ndarray of distances, shape = (number of frames, number of clusters scored)
+    """
+    n_clusters = tables.shape[2] if clusters is None else len(clusters)
+    dis = np.zeros((codes.shape[0], n_clusters), dtype=np.float64)
+    for k in range(codes.shape[1]):
+        if clusters is None:
+            dis += tables[k, codes[:, k]]
+        else:
+            dis += tables[k][np.ix_(codes[:, k], clusters)]
+    return dis
@@ -0,0 +1,259 @@
+# ===============================================================================
+# Trajencode
+# StreamCluster.py
+# Online clustering of encoded frames as they leave the encoder, with bounded memory
+# ===============================================================================
+
+import json
+import os
+import numpy as np
+from TrajSAencode.SAMetric import profile_tables, profile_distances, decode_strings
+from TrajSAencode.SAEncoder import SAEncoder
+
+# Outputs of every clustered chain: frame labels and summary of the clusters
+LABELS_EXTENSION = ".clusters"
+SUMMARY_EXTENSION = ".clusters.json"
+
+
+class OnlineClusters:
+
+    def __init__(self, sub_array, threshold, max_clusters=256, merge_interval=0, merge_threshold=None):
+        """
+        Clusters encoded frames of the same length one at a time. A frame joins the cluster with the lowest
+        average sub_matrix distance to its members when it is within the threshold, otherwise it starts a new
+        cluster. Clusters are only kept as position specific letter counts (their profile), so memory grows with
+        the number of clusters and not with the number of frames
+        :param sub_array: substitution matrix array
+        :param threshold: largest average distance between a frame and the members of its cluster
+        :param max_clusters: largest number of clusters, frames are added to the closest one when they are all used
+        :param merge_interval: frames between merges of the clusters closer than merge_threshold, 0 to never merge
+        :param merge_threshold: largest average linkage distance of the merged clusters, threshold by default
+        """
+        if max_clusters < 1:
+            raise ValueError("At least one cluster is needed")
+        self.sub_array = sub_array
+        self.threshold = threshold
+        self.max_clusters = max_clusters
+        self.merge_interval = merge_interval
+        self.merge_threshold = merge_threshold if merge_threshold is not None else threshold
+        self.counts = None  # letter counts of every slot, shape = (max clusters, length, number of letters)
+        self.tables = None  # costs from profile_tables, shape = (length, number of letters, max clusters)
+        self.sizes = np.zeros(max_clusters, dtype=np.int64)
+        self.ids = np.full(max_clusters, -1, dtype=np.int64)  # cluster held by every slot, -1 when free
+        self.parents = {}  # cluster absorbed by a merge and the cluster it went into
+        self.next_id = 0
+        self.n_frames = 0
+        self.forced = 0  # frames beyond the threshold added to a cluster because all the slots were used
+        self.merges = 0
+        self.since_merge = 0
+
+    def _allocate(self, length):
+        n_letters = self.sub_array.shape[0]
+        self.counts = np.zeros((self.max_clusters, length, n_letters), dtype=np.int32)
+        self.tables = np.full((length, n_letters, self.max_clusters), np.inf)
+
+    def _update_tables(self, slots):
+        slots = sorted(slots)
+        if slots:
+            self.tables[:, :, slots] = profile_tables(self.counts[slots], self.sizes[slots], self.sub_array)
+
+    def _frame_distances(self, frame, slots):
+        """
+        Average distance of one frame to the members of some clusters, from their current tables.
+        cumsum adds the positions one after the other like profile_distances, so both give the same bits
+        """
+        return np.cumsum(self.tables[np.arange(len(frame)), frame][:, slots], axis=0)[-1]
+
+    def add(self, codes):
+        """
+        Assigns a block of encoded frames, in order, to the clusters
+        :param codes: np.ndarray of letter codes, shape = (number of frames, string length)
+        :return: np.ndarray of the cluster id of every frame, ids of merged clusters are resolved by labels
+        """
+        if self.counts is None:
+            self._allocate(codes.shape[1])
+        elif codes.shape[1] != self.counts.shape[1]:
+            raise ValueError("All the SA strings of a cluster must have the same length")
+        labels = np.zeros(codes.shape[0], dtype=np.int64)
+        positions = np.arange(codes.shape[1])
+        # Distances to the clusters used before the block, the free slots stay at inf.
+        # Only the clusters changed inside the block are scored again, frame by frame
+        dis = np.full((codes.shape[0], self.max_clusters), np.inf)
+        occupied = np.flatnonzero(self.sizes > 0)
+        if len(occupied) > 0:
+            dis[:, occupied] = profile_distances(codes, self.tables, occupied)
+        changed = set()
+        for i, frame in enumerate(codes):
+            if changed:
+                slots = sorted(changed)
+                dis[i, slots] = self._frame_distances(frame, slots)
+            best = int(np.argmin(dis[i]))
+            if dis[i, best] > self.threshold:
+                free = np.flatnonzero(self.ids < 0)
+                if len(free) > 0:
+                    best = int(free[0])
+                    self.ids[best] = self.next_id
+                    self.next_id += 1
+                else:
+                    self.forced += 1
+            self.counts[best, positions, frame] += 1
+            self.sizes[best] += 1
+            self._update_tables([best])
+            changed.add(best)
+            labels[i] = self.ids[best]
+            self.n_frames += 1
+            self.since_merge += 1
+            # Merges happen after the same frames whatever the size of the blocks
+            if self.merge_interval > 0 and self.since_merge >= self.merge_interval:
+                kept, dropped = self._merge()
+                changed.update(kept)
+                changed.difference_update(dropped)
+                dis[i + 1:, dropped] = np.inf
+        return labels
+
+    def merge(self):
+        """
+        Merges the pairs of clusters whose average linkage distance is within merge_threshold,
+        closest pairs first and every cluster at most once per call
+        :return: number of merges
+        """
+        kept, _ = self._merge()
+        return len(kept)
+
+    def _merge(self):
+        """
+        Merges the close clusters, see merge
+        :return: list of the slots that received a cluster and list of the slots freed by the merges
+        """
+        self.since_merge = 0
+        slots = np.flatnonzero(self.sizes > 0)
+        if len(slots) < 2:
+            return [], []
+        length, n_letters = self.counts.shape[1:]
+        frequencies = self.counts[slots].reshape(len(slots), -1) / self.sizes[slots][:, np.newaxis]
+        # Average distance between the members of every pair of clusters
+        between = frequencies @ self.tables[:, :, slots].reshape(length * n_letters, len(slots))
+        first, second = np.triu_indices(len(slots), k=1)
+        close = np.flatnonzero(between[first, second] <= self.merge_threshold)
+        close = close[np.argsort(between[first[close], second[close]], kind="stable")]
+        used = set()
+        kept = []
+        dropped = []
+        for pair in close:
+            keep, drop = int(slots[first[pair]]), int(slots[second[pair]])
+            if keep in used or drop in used:
+                continue
+            used.update((keep, drop))
+            # The oldest cluster keeps its id
+            if self.ids[drop] < self.ids[keep]:
+                keep, drop = drop, keep
+            self.counts[keep] += self.counts[drop]
+            self.sizes[keep] += self.sizes[drop]
+            self.parents[int(self.ids[drop])] = int(self.ids[keep])
+            self.counts[drop] = 0
+            self.sizes[drop] = 0
+            self.ids[drop] = -1
+            self.tables[:, :, drop] = np.inf
+            kept.append(keep)
+            dropped.append(drop)
+        self._update_tables(kept)
+        self.merges += len(kept)
+        return kept, dropped
+
+    def _root(self, cluster):
+        while cluster in self.parents:
+            cluster = self.parents[cluster]
+        return cluster
+
+    def labels(self):
+        """
+        Final label of every cluster id handed out by add, merged clusters share the label of their survivor.
+        Labels start at 0 and follow the order in which the surviving clusters were created
+        :return: np.ndarray indexed by cluster id
+        """
+        alive = {cluster: label for label, cluster in enumerate(sorted(int(c) for c in self.ids if c >= 0))}
+        return np.array([alive[self._root(cluster)] for cluster in range(self.next_id)], dtype=np.int64)
+
+    def summary(self, keys):
+        """
+        Description of the clusters
+        :param keys: letters of the alphabet, in the order of the codes
+        :return: dictionary with the counters and, for every cluster, its size, its consensus string
+                 (most frequent letter of every position) and the average distance between its members
+        """
+        clusters = []
+        slots = sorted((int(slot) for slot in np.flatnonzero(self.ids >= 0)), key=lambda slot: self.ids[slot])
+        if slots:
+            consensus = decode_strings(np.argmax(self.counts[slots], axis=2), keys)
+        for label, slot in enumerate(slots):
+            frequencies = self.counts[slot] / self.sizes[slot]
+            clusters.append({"label": label, "size": int(self.sizes[slot]), "consensus": consensus[label],
+                             "spread": float(np.sum(frequencies * self.tables[:, :, slot]))})
+        return {"frames": self.n_frames, "threshold": self.threshold, "max_clusters": self.max_clusters,
+                "merge_threshold": self.merge_threshold if self.merge_interval > 0 else None,
+                "merges": self.merges, "forced": self.forced, "n_clusters": len(clusters), "clusters": clusters}
+
+
+class StreamClustering:
+
+    def __init__(self, sub_array, keys, library_keys, threshold, max_clusters=256, merge_interval=0,
+                 merge_threshold=None):
+        """
+        Clusters the frames of every chain while they are encoded. The label of every frame is appended to a
+        temporary file and rewritten with the final labels when the chain is finished, so no frame is kept
+        in memory
+        :param sub_array: substitution matrix array
+        :param keys: letters of the alphabet in the order of sub_array
+        :param library_keys: letters in the order of the fragment indexes returned by the encoder
+        :param threshold: largest average distance between a frame and the members of its cluster
+        :param max_clusters: largest number of clusters of every chain
+        :param merge_interval: frames between merges of close clusters, 0 to never merge
+        :param merge_threshold: largest average linkage distance of the merged clusters, threshold by default
+        """
+        self.sub_array = sub_array
+        self.keys = list(keys)
+        # Fragment index of the encoder to letter code of the substitution matrix
+        self.code_lut = np.array([self.keys.index(key) for key in library_keys], dtype=np.uint8)
+        self.options = {"threshold": threshold, "max_clusters": max_clusters, "merge_interval": merge_interval,
+                        "merge_threshold": merge_threshold}
+        self.clusters = {}  # online clusters of every chain being processed
+        self.label_files = {}
+
+    def add(self, encoding, names):
+        """
+        Clusters a block of encoded frames
+        :param encoding: np.ndarray of fragment indexes, shape = (number of frames, number of windows)
+        :param names: fasta names of the frames in the block
+        """
+        # Runs of consecutive frames of the same chain, split as the encoder writes them
+        for base, start, end in SAEncoder.group_names(names):
+            if base not in self.clusters:
+                self.clusters[base] = OnlineClusters(self.sub_array, **self.options)
+                self.label_files[base] = open("%s%s.tmp" % (base, LABELS_EXTENSION), "w")
+            labels = self.clusters[base].add(self.code_lut[encoding[start:end]])
+            self.label_files[base].write("".join("%s\t%s\n" % (name.split("|")[1], label)
+                                                 for name, label in zip(names[start:end], labels)))
+
+    def finish(self):
+        """
+        Writes the labels and the summary of every chain clustered so far and releases them
+        :return: dictionary with the summary of every chain
+        """
+        summaries = {}
+        for base, clusters in self.clusters.items():
+            if clusters.merge_interval > 0:
+                clusters.merge()
+            self.label_files[base].close()
+            labels = clusters.labels()
+            temporary = "%s%s.tmp" % (base, LABELS_EXTENSION)
+            with open(temporary, "r") as inn, open("%s%s" % (base, LABELS_EXTENSION), "w") as out:
+                for line in inn:
+                    frame, cluster = line.split()
+                    out.write("%s\t%s\n" % (frame, labels[int(cluster)]))
+            os.remove(temporary)
+            summaries[base] = clusters.summary(self.keys)
+            with open("%s%s" % (base, SUMMARY_EXTENSION), "w") as out:
+                json.dump(summaries[base], out, indent=1)
+        self.clusters = {}
+        self.label_files = {}
+        return summaries
@@ -0,0 +1,145 @@
+# ===============================================================================
+# Trajencode
+# TrajAPI.py
+# In-memory encoding and contact counting of trajectories, without writing any file
+# ===============================================================================
+
+import numpy as np
+from TrajSAencode.SAEncoder import SAEncoder
+from TrajSAencode.SAlib import SADICT
+from TrajSAencode.TrajLoader import TrajLoader
+from TrajSAencode.TrajProcessor import ContactAccumulator, sliding_max
+
+
+def encoded_blocks(traj_loader, sa_encoder=None, n_workers=1):
+    """
+    Reads a trajectory and encodes it block by block
+    :param traj_loader: TrajLoader of the file to process
+    :param sa_encoder: SAEncoder of the blocks, None to only read them
+    :param n_workers: number of threads encoding chunks in parallel
+    :return: generator of (xyz_block, names, encoding), encoding is None without encoder
+    """
+    if traj_loader.chunk_size > 1 or n_workers > 1:
+        # Encode whole chunks with a single call to the C encoder, spread over the workers
+        if sa_encoder is not None:
+            return sa_encoder.encode_parallel(traj_loader.chunks(), n_workers)
+        return ((xyz_block, names, None) for xyz_block, names in traj_loader.chunks())
+    # Single frames, encoded one by one as blocks of one frame
+    frames = ((frame[np.newaxis], [name]) for frame, name in traj_loader.frames())
+    if sa_encoder is not None:
+        return ((frame, names, sa_encoder.encode_frames(frame)) for frame, names in frames)
+    return ((frame, names, None) for frame, names in frames)
+
+
+class ChainEncoding:
+
+    def __init__(self, codes, contacts, frames, keys):
+        """
+        Encoding and contacts of one chain
+        :param codes: np.ndarray of fragment indexes, shape = (number of frames, number of windows)
+        :param contacts: np.ndarray with the frames in which every pair of fragments is in contact,
+                         shape = (number of windows, number of windows), None when not computed
+        :param frames: number of frames
+        :param keys: letters of the fragments, in the order of the indexes
+        """
+        self.codes = codes
+        self.contacts = contacts
+        self.frames = frames
+        self.keys = keys
+
+    def strings(self):
+        """
+        SA strings of the frames
+        :return: list of strings
+        """
+        lookup = np.frombuffer("".join(self.keys).encode("ascii"), dtype=np.uint8)
+        return [row.tobytes().decode("ascii") for row in lookup[self.codes]]
+
+
+class TrajEncoder:
+
+    def __init__(self, sa_dict=SADICT, rmsd_method="gsl", cutoff=None, contact_method="dense", cache=None,
+                 prune=False, n_workers=1, block_size=1024):
+        """
+        Encodes coordinates held in memory and returns arrays, nothing is read from or written to disk.
+        The fragment library is prepared once, so the same instance can be reused for many calls
+        :param sa_dict: library of fragments to use
+        :param rmsd_method: RMSD engine, "gsl" or "qcp"
+        :param cutoff: contact cutoff in nm, None to skip the contact counts
+        :param contact_method: contact counting method, "dense" or "grid"
+        :param cache: WindowCache shared by all the calls, None to search every window
+        :param prune: prune the library search with RMSD lower bounds, same result as the exhaustive search
+        :param n_workers: number of threads encoding blocks of frames in parallel
+        :param block_size: number of frames encoded with a single call to the C encoder
+        """
+        if contact_method not in ["dense", "grid"]:
+            raise ValueError("Unknown contact method %s, options: dense, grid" % contact_method)
+        if block_size < 1:
+            raise ValueError("Blocks must hold at least one frame")
+        self.sa_encoder = SAEncoder(sa_dict, rmsd_method=rmsd_method, cache=cache, prune=prune)
+        self.keys = self.sa_encoder.library.keys
+        self.fragment_size = self.sa_encoder.fragment_size
+        self.cutoff = cutoff
+        self.contact_method = contact_method
+        self.n_workers = n_workers
+        self.block_size = block_size
+
+    def blocks(self, traj_loader):
+        """
+        Encodes a trajectory read by a TrajLoader block by block, to process files larger than memory
+        :param traj_loader: TrajLoader of the file
+        :return: generator of (xyz_block, names, encoding), see encoded_blocks
+        """
+        return encoded_blocks(traj_loader, self.sa_encoder, self.n_workers)
+
+    def encode_chain(self, xyz):
+        """
+        Encodes the frames of a chain
+        :param xyz: np.ndarray of shape (number of frames, number of residues, 3) or (number of residues, 3), in nm
+        :return: ChainEncoding
+        """
+        xyz = np.asarray(xyz)
+        if xyz.ndim == 2:
+            xyz = xyz[np.newaxis]
+        n_frames = xyz.shape[0]
+        blocks = (np.ascontiguousarray(xyz[start:start + self.block_size], dtype=np.float32)
+                  for start in range(0, n_frames, self.block_size))
+        encodings = [encoding for _, _, encoding in
+                     self.sa_encoder.encode_parallel(((block, None) for block in blocks), self.n_workers)]
+        n_windows = max(xyz.shape[1] - self.fragment_size + 1, 0)
+        codes = np.concatenate(encodings) if encodings else np.zeros((0, n_windows), dtype=np.int32)
+        contacts = None
+        if self.cutoff is not None:
+            accumulator = ContactAccumulator(xyz.shape[1], self.cutoff, self.contact_method)
+            accumulator.add(xyz)
+            contacts = sliding_max(accumulator.counts, self.fragment_size)
+        return ChainEncoding(codes, contacts, n_frames, self.keys)
+
+    def encode(self, xyz, chains=None):
+        """
+        Encodes every chain of a block of frames
+        :param xyz: np.ndarray of shape (number of frames, number of atoms, 3), in nm
+        :param chains: list with the atom indexes of the C alphas of every chain, all the atoms as a single chain
+                       by default
+        :return: list of ChainEncoding, one per chain
+        """
+        xyz = np.asarray(xyz)
+        if xyz.ndim == 2:
+            xyz = xyz[np.newaxis]
+        if chains is None:
+            chains = [np.arange(xyz.shape[1])]
+        return [self.encode_chain(xyz[:, TrajLoader.chain_selector(chain)]) for chain in chains]
+
+    def encode_trajectory(self, traj, split_chains=True):
+        """
+        Encodes the C alphas of an mdtraj trajectory
+        :param traj: md.Trajectory
+        :param split_chains: whether the chains should be encoded separately, found as in TrajLoader
+        :return: list of ChainEncoding, one per chain
+        """
+        ca_indexes = traj.topology.select("name CA")
+        if split_chains:
+            chains = [ca_indexes[chain] for chain in TrajLoader.find_chains(traj.topology.subset(ca_indexes))]
+        else:
+            chains = [ca_indexes]
+        return self.encode(traj.xyz, chains)
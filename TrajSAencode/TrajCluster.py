@@ -1,50 +1,106 @@
 import numpy as np
-from _kabsch.lib import wrmsd_kabsch
-from cffi import FFI
+from scipy.cluster.hierarchy import linkage, fcluster
 from sklearn.cluster import AgglomerativeClustering
+from TrajSAencode.SAMetric import RMSD_FUNCTIONS, substitution_matrix, sub_matrix_array, encode_strings, \
+    decode_strings, distance_matrix, profile_counts, profile_tables, profile_distances
+from TrajSAencode.SAFormat import SABinaryReader, SABinaryWriter, EXTENSION, HEADER_SIZE
+from TrajSAencode.DistanceStore import CondensedDistances
+from TrajSAencode.SAClustering import leader_clustering, clara
+
+# Largest number of frames clustered with average linkage. scipy converts the float32 condensed matrix to
+# float64 and keeps working copies of it, about 8 * N^2 bytes in memory (20 GB at 50000 frames) besides
+# the 2 * N^2 bytes of the store. Larger trajectories are clustered with the leader or CLARA methods
+LINKAGE_MAX_FRAMES = 50000
+
+
+class ClusterLabels:
+    def __init__(self, labels):
+        """
+        Cluster assignment exposing labels_ like the sklearn estimators, so save_clusters can write it
+        :param labels: cluster index of every frame, starting at 0
+        """
+        self.labels_ = np.asarray(labels)
 
 
 class TrajCluster:
-    def __init__(self, sa_dict, fragment_size, nclusters, max_dist):
+    def __init__(self, sa_dict, fragment_size, nclusters, max_dist, rmsd_method="gsl"):
+        if rmsd_method not in RMSD_FUNCTIONS:
+            raise ValueError("Unknown RMSD method %s, options: %s" % (rmsd_method, ", ".join(RMSD_FUNCTIONS)))
         self.sa_dict = sa_dict
+        self.rmsd_function = RMSD_FUNCTIONS[rmsd_method]
+        self.keys = sorted(self.sa_dict.keys())
         self.sub_matrix = {}
+        self.sub_array = None
         self.dis_matrix = []
+        self.condensed = None
         self.fragment_size = fragment_size
-        self.ffi = FFI()
         self.create_sub_matrix()
         self.sa_traj = []
+        self.sa_codes = None  # frames read from binary files, used instead of sa_traj when set
         self.clustering = None
+        self.representatives = []
         self.max_dist = max_dist
         self.nclusters = nclusters
 
     def create_sub_matrix(self):
-        self.sub_matrix = {}
-        keys = [key for key in sorted(self.sa_dict.keys())]
-        for i in range(len(keys)):
-            for j in range(i, len(keys)):
-                if i == j:
-                    self.sub_matrix.setdefault((keys[i], keys[j]), 0.0)
-                else:
-                    fragment1 = np.array(self.sa_dict[keys[i]], dtype=np.float32)
-                    c_fragment1 = self.ffi.cast("float(*)[3]", fragment1.ctypes.data)
-                    fragment2 = np.array(self.sa_dict[keys[j]], dtype=np.float32)
-                    c_fragment2 = self.ffi.cast("float(*)[3]", fragment2.ctypes.data)
-                    rmsd = wrmsd_kabsch(self.fragment_size, c_fragment1, c_fragment2)
-                    self.sub_matrix.setdefault((keys[i], keys[j]), rmsd)
-                    self.sub_matrix.setdefault((keys[j], keys[i]), rmsd)
+        self.sub_matrix = substitution_matrix(self.sa_dict, self.fragment_size, self.rmsd_function)
+        self.sub_array = sub_matrix_array(self.sub_matrix, self.keys)
 
     def read_sasta(self, file):
+        if file.endswith(EXTENSION):
+            codes = self.read_codes(file)
+            if self.sa_codes is None and len(self.sa_traj) == 0:
+                # Keep the memory map, frames are only read from disk when used
+                self.sa_codes = codes
+            else:
+                self.sa_codes = np.concatenate([self.encode_traj(), codes])
+                self.sa_traj = []
+            return
         with open(file, "r") as inn:
             for line in inn:
                 line = line.rstrip()
                 if not line.startswith(">"):
                     self.sa_traj.append(line)
+        if self.sa_codes is not None:
+            # Frames from binary files are already codes, keep all of them in the same form
+            self.sa_codes = np.concatenate([self.sa_codes, encode_strings(self.sa_traj, self.keys)])
+            self.sa_traj = []
+
+    def read_codes(self, file):
+        """
+        Reads a binary .sab file as a code matrix following the order of self.keys
+        :param file: name of the binary file
+        :return: np.ndarray (memory mapped when the alphabets match) of letter codes
+        """
+        reader = SABinaryReader(file)
+        if reader.alphabet == "".join(self.keys):
+            return reader.codes
+        # Translate the codes of the file alphabet to the codes of self.keys
+        translation = np.array([self.keys.index(letter) for letter in reader.alphabet], dtype=np.uint8)
+        return translation[reader.codes]
 
     def clean_sasta(self):
         self.sa_traj = []
+        self.sa_codes = None
+
+    def n_frames(self):
+        """
+        Number of frames loaded
+        """
+        return len(self.sa_codes) if self.sa_codes is not None else len(self.sa_traj)
+
+    def frame_strings(self, block_size=4096):
+        """
+        Generator of the SA strings of the loaded frames
+        """
+        if self.sa_codes is None:
+            yield from self.sa_traj
+            return
+        for start in range(0, len(self.sa_codes), block_size):
+            yield from decode_strings(self.sa_codes[start:start + block_size], self.keys)
 
     def init_sim_mat(self):
-        self.dis_matrix = np.zeros(shape=(len(self.sa_traj), len(self.sa_traj)))
+        self.dis_matrix = np.zeros(shape=(self.n_frames(), self.n_frames()))
 
     def compare_frames(self, frame1, frame2):
         dis = 0.0
@@ -52,13 +108,100 @@ class TrajCluster:
             dis += self.sub_matrix[(frame1[k], frame2[k])]
         return dis
 
-    def compute_similarity(self):
-        for i, frame1 in enumerate(self.sa_traj):
-            for j in range(i, len(self.sa_traj)):
-                dis = self.compare_frames(frame1, self.sa_traj[j])
-                self.dis_matrix[i][j] = dis
-                self.dis_matrix[j][i] = dis
-            print("Finished %s" % i)
+    def encode_traj(self):
+        """
+        Converts the SA strings into a matrix of letter codes
+        :return: np.ndarray of uint8, shape = (number of frames, string length)
+        """
+        if self.sa_codes is not None:
+            return self.sa_codes
+        return encode_strings(self.sa_traj, self.keys)
+
+    def compute_similarity(self, block_size=256, n_workers=1):
+        """
+        Fills the distance matrix with vectorized blocks of frames
+        :param block_size: number of frames per block
+        :param n_workers: number of threads computing blocks in parallel
+        """
+        distance_matrix(self.encode_traj(), self.sub_array, out=self.dis_matrix, block_size=block_size,
+                        n_workers=n_workers, verbose=True)
+
+    def check_linkage_size(self, n_frames, max_frames=LINKAGE_MAX_FRAMES):
+        """
+        Refuses trajectories too large for average linkage, before any distance is computed
+        """
+        if n_frames > max_frames:
+            raise ValueError("%s frames is more than the %s frames average linkage can cluster in memory, "
+                             "use cluster_leader, cluster_clara or cluster_frames" % (n_frames, max_frames))
+
+    def init_condensed(self, path=None, block_size=256, max_frames=LINKAGE_MAX_FRAMES):
+        """
+        Prepares a condensed float32 distance matrix instead of the dense one
+        :param path: file backing the matrix, reused to resume or skip the computation; None keeps it in memory
+        :param block_size: number of rows computed at a time
+        :param max_frames: largest number of frames accepted, see LINKAGE_MAX_FRAMES
+        """
+        self.check_linkage_size(self.n_frames(), max_frames)
+        self.condensed = CondensedDistances(self.n_frames(), path=path, block_size=block_size)
+
+    def compute_condensed(self, n_workers=1):
+        """
+        Fills the blocks of the condensed matrix that are not stored yet
+        :param n_workers: number of threads computing blocks in parallel
+        """
+        self.condensed.fill(self.encode_traj(), self.sub_array, n_workers=n_workers, verbose=True)
+
+    def cluster_condensed(self, max_frames=LINKAGE_MAX_FRAMES):
+        """
+        Average linkage clustering directly on the condensed matrix, cut at max_dist or at nclusters
+        :param max_frames: largest number of frames accepted, see LINKAGE_MAX_FRAMES
+        """
+        self.check_linkage_size(self.condensed.n_frames, max_frames)
+        tree = linkage(self.condensed.data, method="average")
+        if self.max_dist is not None:
+            labels = fcluster(tree, t=self.max_dist, criterion="distance")
+        else:
+            labels = fcluster(tree, t=self.nclusters, criterion="maxclust")
+        self.clustering = ClusterLabels(labels - 1)
+
+    def cluster_leader(self, block_size=1024):
+        """
+        Leader clustering with max_dist as threshold, without computing all the pairwise distances
+        :param block_size: number of frames compared at once against the known leaders
+        """
+        labels, self.representatives = leader_clustering(self.encode_traj(), self.sub_array, self.max_dist,
+                                                         block_size=block_size)
+        self.clustering = ClusterLabels(labels)
+
+    def cluster_clara(self, n_samples=5, sample_size=None, seed=0):
+        """
+        k-medoids on samples of the trajectory (CLARA) with nclusters clusters
+        :param n_samples: number of random samples
+        :param sample_size: number of frames per sample, 40 + 2 * nclusters by default
+        :param seed: seed of the random generator
+        """
+        if self.nclusters is None:
+            raise ValueError("CLARA clustering needs the number of clusters")
+        labels, self.representatives = clara(self.encode_traj(), self.sub_array, self.nclusters,
+                                             n_samples=n_samples, sample_size=sample_size, seed=seed)
+        self.clustering = ClusterLabels(labels)
+
+    def cluster_frames(self, path=None, n_workers=1, max_frames=LINKAGE_MAX_FRAMES):
+        """
+        Average linkage on the condensed matrix when it fits in memory, otherwise leader clustering
+        (with max_dist) or CLARA (with nclusters), which never build the full matrix
+        :param path: file backing the condensed matrix, None keeps it in memory
+        :param n_workers: number of threads computing the distances
+        :param max_frames: largest number of frames clustered with average linkage
+        """
+        if self.n_frames() <= max_frames:
+            self.init_condensed(path=path, max_frames=max_frames)
+            self.compute_condensed(n_workers=n_workers)
+            self.cluster_condensed(max_frames=max_frames)
+        elif self.max_dist is not None:
+            self.cluster_leader()
+        else:
+            self.cluster_clara()
 
     def cluster_traj(self):
         self.clustering = AgglomerativeClustering(n_clusters=self.nclusters,
@@ -71,7 +214,7 @@ class TrajCluster:
         nclusters = max(self.clustering.labels_) + 1
         for i in range(nclusters):
             files[i] = open("clust_%s_%s.sasta" % (name, i), "w")
-        for i, frame in enumerate(self.sa_traj):
+        for i, frame in enumerate(self.frame_strings()):
             clust = self.clustering.labels_[i]
             files[clust].write(">CLUST\n")
             files[clust].write("%s\n" % frame)
@@ -89,46 +232,83 @@ class TrajCluster:
         c_file_h.close()
         return mem
 
-    def expand_clusters(self, cluster_files):
-        clust_dict = {}
-        # Load cluster data
+    def cluster_profiles(self, cluster_files):
+        """
+        Summarises every cluster file into a position specific letter count profile
+        :param cluster_files: list of cluster files
+        :return: np.ndarray of profiles, shape = (number of clusters, string length, number of letters),
+                 and list with the number of frames of every cluster
+        """
+        profiles = []
+        sizes = []
         for f in cluster_files:
-            clust_dict[f] = {}
-            clust_dict[f]["handler"] = open(f, "a")
-            clust_dict[f]["data"] = self.read_clust_file(f)
-        # Compare each frame with cluster data
-        for i,frame in enumerate(self.sa_traj):
-            min_clust = None
-            min_val = 0.0
-            for key in clust_dict:
-                distances = []
-                for frame2 in clust_dict[key]["data"]:
-                    distances.append(self.compare_frames(frame, frame2))
-                avg_dis = sum(distances)/len(distances)
-                if (min_clust is not None and avg_dis < min_val) or min_clust is None:
-                    min_val = avg_dis
-                    min_clust = clust_dict[key]["handler"]
-            # Add new element to cluster
-            min_clust.write(">CLUST\n")
-            min_clust.write("%s\n" % frame)
-            print("Finished frame %s" % i)
-        #close files
-        for key in clust_dict:
-            clust_dict[key]["handler"].close()
+            if f.endswith(EXTENSION):
+                codes = self.read_codes(f)
+            else:
+                codes = encode_strings(self.read_clust_file(f), self.keys)
+            profiles.append(profile_counts(codes, len(self.keys)))
+            sizes.append(codes.shape[0])
+        lengths = set(profile.shape[0] for profile, size in zip(profiles, sizes) if size > 0)
+        if len(lengths) == 0:
+            raise ValueError("All the cluster files are empty")
+        if len(lengths) > 1:
+            raise ValueError("Cluster files contain SA strings of different lengths: %s" % sorted(lengths))
+        length = lengths.pop()
+        # Empty clusters have no positions, give them an empty profile of the right length
+        profiles = [profile if size > 0 else np.zeros((length, len(self.keys)), dtype=np.int64)
+                    for profile, size in zip(profiles, sizes)]
+        return np.array(profiles), sizes
 
+    def expand_clusters(self, cluster_files, block_size=4096):
+        """
+        Adds every loaded frame to the cluster with the lowest average distance to its members
+        :param cluster_files: list of cluster files, the new frames are appended to them
+        :param block_size: number of frames scored at once
+        """
+        profiles, sizes = self.cluster_profiles(cluster_files)
+        tables = profile_tables(profiles, sizes, self.sub_array)
+        codes = self.encode_traj()
+        if self.n_frames() > 0 and codes.shape[1] != profiles.shape[1]:
+            raise ValueError("The SA strings have %s letters and the clusters %s" % (codes.shape[1], profiles.shape[1]))
+        labels = np.zeros(self.n_frames(), dtype=np.int64)
+        for start in range(0, self.n_frames(), block_size):
+            # argmin keeps the first cluster on ties, as the scan over the files did
+            labels[start:start + block_size] = np.argmin(profile_distances(codes[start:start + block_size], tables),
+                                                         axis=1)
+        # Binary cluster files get their new members appended to the code matrix
+        for clust, f in enumerate(cluster_files):
+            if f.endswith(EXTENSION):
+                self.append_codes(f, codes[labels == clust])
+        # Add new elements to the text clusters
+        handlers = {clust: open(f, "a") for clust, f in enumerate(cluster_files) if not f.endswith(EXTENSION)}
+        for frame, clust in zip(self.frame_strings(), labels):
+            if clust in handlers:
+                handlers[clust].write(">CLUST\n")
+                handlers[clust].write("%s\n" % frame)
+        #close files
+        for handler in handlers.values():
+            handler.close()
+        print("Finished %s frames" % self.n_frames())
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-  
-
+    def append_codes(self, file, codes):
+        """
+        Appends frames to a binary .sab file, numbering them after its last frame
+        :param file: name of the binary file
+        :param codes: np.ndarray of letter codes following the order of self.keys
+        """
+        if len(codes) == 0:
+            return
+        reader = SABinaryReader(file)
+        alphabet = reader.alphabet
+        frame_numbers = np.array(reader.frame_index)
+        offset = HEADER_SIZE + reader.n_frames * reader.n_windows
+        # Release the memory map before the frame index is overwritten
+        del reader
+        missing = set(self.keys[code] for code in np.unique(codes)) - set(alphabet)
+        if missing:
+            raise ValueError("Letters %s are missing from the alphabet of %s" % ("".join(sorted(missing)), file))
+        translation = np.array([alphabet.find(key) for key in self.keys], dtype=np.uint8)
+        first = int(frame_numbers[-1]) + 1 if len(frame_numbers) > 0 else 1
+        writer = SABinaryWriter(file, alphabet, resume=(offset, frame_numbers))
+        writer.write(translation[codes], range(first, first + len(codes)))
+        writer.close()
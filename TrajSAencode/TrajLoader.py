@@ -5,12 +5,16 @@
 # ===============================================================================
 
 import mdtraj as md
+import numpy as np
 import os
+from TrajSAencode.Profiler import NULL_PROFILER
+from TrajSAencode.Prefetcher import Prefetcher
 
 
 class TrajLoader:
 
-    def __init__(self, topology, mdtrajectory, split_chains=False, chunk_size=1, start_f=0, skip=0, stride=None):
+    def __init__(self, topology, mdtrajectory, split_chains=False, chunk_size=1, start_f=0, skip=0, stride=None,
+                 shared_topology=None, profiler=None, prefetch=0):
         """
         Holds the trajectory and extracts the C alphas and chains from it
         :param topology: name of the pdb to use as topology file
@@ -20,6 +24,10 @@ class TrajLoader:
         :param start_f: The starting frame number to put in the name of the output fasta string
         :param skip : number of frames to skip from the trajectory
         :param stride : Only read every stride-th frame
+        :param shared_topology: topology already parsed by TrajLoader.load_topology, to avoid reading it again
+        :param profiler: StageProfiler timing the reading and slicing of the trajectory, None to disable it
+        :param prefetch: number of chunks read ahead on a background thread while the previous ones are
+                         processed, 0 to read them when they are needed
         """
         self.topology_file = topology
         self.mdtrajectory = mdtrajectory
@@ -28,31 +36,56 @@ class TrajLoader:
         self.start_f = start_f
         self.skip = skip
         self.stride = stride
-        self.topology, self.ca_indexes = self.read_topology()  # mdtraj object and list of CA indexes
+        self.profiler = profiler if profiler is not None else NULL_PROFILER
+        self.prefetch = prefetch
+        if shared_topology is None:
+            shared_topology = self.load_topology(self.topology_file)
+        # mdtraj object, list of CA indexes and the full mdtraj topology
+        self.topology, self.ca_indexes, self.full_topology = shared_topology
         if split_chains:
             self.chains = self.get_chains()  # list of chains with their CA indexes
         else:
             self.chains = [self.ca_indexes]
+        # Positions of every chain in the C alpha coordinates, computed once to slice the raw xyz of the chunks
+        self.chain_selectors = self.get_chain_selectors()
+
+    @staticmethod
+    def load_topology(topology):
+        """
+        Reads the topology and extracts the C alpha indexes, the result can be shared between loaders
+        :param topology: name of the pdb to use as topology file
+        :return: mdtraj trajectory of the C alphas, list of indexes and full mdtraj topology
+        """
+        traj_top = md.load(topology)
+        ca_indexes = traj_top.topology.select("name CA")
+        return traj_top.atom_slice(ca_indexes), ca_indexes, traj_top.topology
 
     def read_topology(self):
         """
         Reads the topology and extracts the C alpha indexes
         :return: mdtraj trajectory and list of indexes
         """
-        traj_top = md.load(self.topology_file)
-        ca_indexes = traj_top.topology.select("name CA")
-        return traj_top.atom_slice(ca_indexes), ca_indexes
+        return self.load_topology(self.topology_file)[:2]
 
     def get_chains(self):
         """
         Extracts the chains by looking at the residue sequence number
         :return: list of chains
         """
+        return self.find_chains(self.topology.topology)
+
+    @staticmethod
+    def find_chains(topology):
+        """
+        Splits the residues into chains, a new chain starts when the residue sequence number decreases
+        :param topology: mdtraj topology of the C alphas
+        :return: list of chains with the index of the first atom of every residue
+        """
         chain = []
         old_resnum = -1
         chains = []
 
-        for residue in self.topology.topology.residues:
+        for residue in topology.residues:
 
             if residue.resSeq < old_resnum:
                 chains.append(chain)
@@ -63,31 +96,130 @@ class TrajLoader:
         chains.append(chain)
         return chains
 
-    def frames(self):
+    def get_chain_selectors(self):
         """
-        Generator that yields the next frame and the name fasta name to put in the encoding
-        :return:
+        Converts the chains to indexes of the C alpha coordinates read from the trajectory
+        :return: list of slices or np.ndarray of indexes, one per chain
+        """
+        if self.split_chains:
+            return [self.chain_selector(chain) for chain in self.chains]
+        # The trajectory is read with only the C alphas, so the single chain is all of them
+        return [slice(0, self.topology.n_atoms)]
+
+    @staticmethod
+    def chain_selector(chain):
+        """
+        Index of a chain into the coordinates. Chains made of consecutive atoms are stored as slices,
+        which are cheaper to copy than index arrays
+        :param chain: list of atom indexes
+        :return: slice or np.ndarray of indexes
+        """
+        chain = np.asarray(chain, dtype=np.intp)
+        if len(chain) > 0 and np.all(np.diff(chain) == 1):
+            return slice(int(chain[0]), int(chain[-1]) + 1)
+        return chain
+
+    def _read_chunks(self, traj):
+        """
+        Iterates over the chunks of the trajectory, timing the reading
+        """
+        traj = iter(traj)
+        while True:
+            with self.profiler.stage("load"):
+                chunk = next(traj, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    def _raw_chunks(self):
         """
+        Iterates over the C alpha coordinates of the chunks of the trajectory
+        :return: np.ndarray of shape (number of frames, number of C alphas, 3) and number of the chunk first frame
+        """
+        stride = self.stride or 1
         # Check if topology file = md trajectory file. This means that the input is a pdb
         if self.topology_file == self.mdtrajectory:
-            traj = self.topology
+            traj = [self.topology]
+            stride = 1
+        elif self.skip > 0 and stride > 1:
+            # md.iterload never ends when skip and stride are combined (e.g. when resuming a strided run),
+            # so read every frame after the skipped ones and stride the chunks here. Chunks hold a multiple
+            # of stride frames, so every chunk starts on a strided frame
+            traj = md.iterload(self.mdtrajectory, chunk=self.chunk_size * stride, top=self.full_topology,
+                               atom_indices=self.ca_indexes, skip=self.skip)
         else:
-            traj = md.iterload(self.mdtrajectory, chunk=self.chunk_size, top=self.topology_file,
+            traj = md.iterload(self.mdtrajectory, chunk=self.chunk_size, top=self.full_topology,
                                atom_indices=self.ca_indexes, skip=self.skip, stride=self.stride)
+            stride = 1
+
+        chunks = self._read_chunks(traj)
+        if self.prefetch > 0:
+            chunks = Prefetcher(chunks, self.prefetch, profiler=self.profiler)
 
-        # Iterate over the trajectory
         n_frames = self.start_f
+        for chunk in chunks:
+            xyz = chunk.xyz[::stride]
+            yield xyz, n_frames
+            n_frames += xyz.shape[0]
+
+    def chain_blocks(self, xyz):
+        """
+        Splits the coordinates of a chunk into its chains
+        :param xyz: np.ndarray of shape (number of frames, number of C alphas, 3)
+        :return: list of contiguous float32 np.ndarray of shape (number of frames, chain residues, 3)
+        """
+        with self.profiler.stage("slice"):
+            return [np.ascontiguousarray(xyz[:, selector], dtype=np.float32) for selector in self.chain_selectors]
 
-        for chunk in traj:
+    def frames(self):
+        """
+        Generator that yields the next frame and the name fasta name to put in the encoding
+        :return: np.ndarray of shape (number of residues, 3) and fasta name
+        """
+        for xyz, n_frames in self._raw_chunks():
             # Iterate over the number of chains
-            for i, chain in enumerate(self.chains):
-                sliced_traj = chunk.atom_slice(chain)
-                sliced_frames = n_frames
+            for i, block in enumerate(self.chain_blocks(xyz)):
                 # Iterate over the frames for that chain
-                for frame in sliced_traj:
-                    sliced_frames += 1
-                    yield frame.xyz[0], self.generate_name(i+1, sliced_frames)
-            n_frames += self.chunk_size
+                for j, frame in enumerate(block):
+                    yield frame, self.generate_name(i+1, n_frames + j + 1)
+
+    def chunks(self, whole=False):
+        """
+        Generator that yields every chain of the next chunk as a block of frames, with their fasta names
+        :param whole: yield the whole chunk at once instead of chain by chain, the chains can then be
+                      extracted with chain_blocks
+        :return: np.ndarray of shape (number of frames, number of residues, 3) and list of fasta names.
+                 With whole, np.ndarray of shape (number of frames, number of C alphas, 3) and one list of
+                 fasta names per chain
+        """
+        for xyz, n_frames in self._raw_chunks():
+            names = [[self.generate_name(i+1, n_frames + j + 1) for j in range(xyz.shape[0])]
+                     for i in range(len(self.chain_selectors))]
+            if whole:
+                yield np.ascontiguousarray(xyz, dtype=np.float32), names
+            else:
+                # Iterate over the number of chains
+                for block, chain_names in zip(self.chain_blocks(xyz), names):
+                    yield block, chain_names
+
+    def output_base(self):
+        """
+        Common prefix of the names of the outputs of this trajectory
+        :return: string
+        """
+        return self.output_name(self.topology_file, self.mdtrajectory)
+
+    @staticmethod
+    def output_name(topology_file, mdtrajectory):
+        """
+        Common prefix of the names of the outputs of a trajectory, without its folder and extension
+        :param topology_file: name of the pdb used as topology file
+        :param mdtrajectory: name of the MD trajectory file
+        :return: string
+        """
+        top_name = os.path.split(topology_file)[1].split(".")[0]
+        traj_name = os.path.split(mdtrajectory)[1].split(".")[0]
+        return "%s.%s" % (top_name, traj_name)
 
     def generate_name(self, chain_num, frame_num):
         """
@@ -96,9 +228,7 @@ class TrajLoader:
         :param frame_num: The number of the frame
         :return: Fasta string
         """
-        top_name = os.path.split(self.topology_file)[1].split(".")[0]
-        traj_name = os.path.split(self.mdtrajectory)[1].split(".")[0]
-        return ">%s.%s.chain%s|%s" % (top_name, traj_name, chain_num, frame_num)
+        return ">%s.chain%s|%s" % (self.output_base(), chain_num, frame_num)
 
 
 
@@ -1,17 +1,109 @@
+import os
 import numpy as np
 import mdtraj as md
 
+
+class ContactAccumulator:
+
+    def __init__(self, n_residues, cutoff, method="dense", max_block_bytes=2 ** 26):
+        """
+        Counts, for every pair of residues of a chain, the frames in which they are within the cutoff
+        :param n_residues: number of residues of the chain
+        :param cutoff: distance cutoff in nm
+        :param method: "dense" computes the full distance matrix, "grid" uses a neighbour list for large systems
+        :param max_block_bytes: memory allowed for the temporary distance arrays of the dense method
+        """
+        if method not in ["dense", "grid"]:
+            raise ValueError("Unknown contact method %s, options: dense, grid" % method)
+        self.n_residues = n_residues
+        self.cutoff = cutoff
+        self.method = method
+        self.max_block_bytes = max_block_bytes
+        self.counts = np.zeros((n_residues, n_residues), dtype=np.int64)
+        self.frames = 0
+
+    def add(self, xyz):
+        """
+        Adds the contacts of one frame or of a block of frames
+        :param xyz: np.ndarray of shape (number of residues, 3) or (number of frames, number of residues, 3)
+        """
+        xyz = np.asarray(xyz)
+        if xyz.ndim == 2:
+            xyz = xyz[np.newaxis]
+        if self.method == "grid":
+            for frame in xyz:
+                self._add_grid(frame)
+        else:
+            # Several frames at once, as long as the temporary arrays fit in max_block_bytes
+            step = max(1, self.max_block_bytes // (12 * self.n_residues * self.n_residues))
+            for start in range(0, xyz.shape[0], step):
+                self._add_dense(xyz[start:start + step])
+        self.frames += xyz.shape[0]
+
+    def _add_dense(self, xyz):
+        diff = xyz[:, :, np.newaxis, :] - xyz[:, np.newaxis, :, :]
+        distances = np.sqrt(np.sum(diff * diff, axis=-1))
+        self.counts += np.sum(distances <= self.cutoff, axis=0)
+
+    def _add_grid(self, frame):
+        # scipy is only needed by the grid method, encoding and dense counting work without it
+        from scipy.spatial import cKDTree
+        pairs = cKDTree(frame).query_pairs(self.cutoff, output_type="ndarray")
+        np.add.at(self.counts, (pairs[:, 0], pairs[:, 1]), 1)
+        np.add.at(self.counts, (pairs[:, 1], pairs[:, 0]), 1)
+        # Every residue is in contact with itself
+        self.counts[np.diag_indices(self.n_residues)] += 1
+
+
+def sliding_max(counts, size):
+    """
+    Maximum over every size x size window of a square matrix
+    :param counts: np.ndarray of shape (n, n)
+    :param size: window size
+    :return: np.ndarray of shape (n - size + 1, n - size + 1)
+    """
+    n_windows = counts.shape[0] - size + 1
+    # Chains shorter than a fragment have no fragments
+    if n_windows <= 0:
+        return np.zeros((0, 0), dtype=counts.dtype)
+    # The maximum is separable: first along the columns, then along the rows
+    columns = counts[:, :n_windows].copy()
+    for j in range(1, size):
+        np.maximum(columns, counts[:, j:j + n_windows], out=columns)
+    windows = columns[:n_windows].copy()
+    for i in range(1, size):
+        np.maximum(windows, columns[i:i + n_windows], out=windows)
+    return windows
+
+
 class TrajProcessor:
 
-    def __init__(self, sa_dict, cutoff):
+    def __init__(self, sa_dict, cutoff, method="dense"):
         """
-        Extracts distances 
+        Extracts distances
+        :param sa_dict: library of fragments to use
+        :param cutoff: distance cutoff in nm
+        :param method: contact counting method, "dense" or "grid" (neighbour list for large systems)
         """
         self.sa_dict = sa_dict
         self.cutoff = cutoff
+        self.method = method
         self.fragment_size = int(len(self.sa_dict[list(self.sa_dict.keys())[0]]) / 3)
         self.output_file = {}
         self.output_file_name = ""
+        self.fragment_counts = {}
+
+    def _set_output(self, name, n_residues):
+        """
+        Selects the accumulator for the given fasta name, creating it if needed
+        :param name: fasta name of the frame
+        :param n_residues: number of residues of the chain
+        """
+        # If the file or chain has changed, switch to its accumulator
+        if "%s_distances.out" % name.split(">")[1].split("|")[0] != self.output_file_name:
+            self.output_file_name = "%s_distances.out" % name.split(">")[1].split("|")[0]
+            if self.output_file_name not in self.output_file:
+                self.output_file[self.output_file_name] = ContactAccumulator(n_residues, self.cutoff, self.method)
 
     def compute_distances(self, frame, name):
         """
@@ -20,60 +112,119 @@ class TrajProcessor:
         :param name: fasta name of the frame to encode
         :return:
         """
-        # If the file or chain has changed, close the file and open a new one
-        if "%s_distances.out" % name.split(">")[1].split("|")[0] != self.output_file_name:
-            self.output_file_name = "%s_distances.out" % name.split(">")[1].split("|")[0]
-            if self.output_file_name not in self.output_file:
-                self.output_file[self.output_file_name] = {} #open(self.output_file_name, "w")
-        # Compute all distances from this frame
-        for i,atom in enumerate(frame):
-            ones = np.ones(len(frame))
-            distances = np.linalg.norm(frame - atom, axis=1)
-            ones[distances > self.cutoff] = 0.0
-            if not i in self.output_file[self.output_file_name]:
-                self.output_file[self.output_file_name][i] = ones
-            else:
-                self.output_file[self.output_file_name][i] += ones
-        # also count frames
-        if not "frames" in self.output_file[self.output_file_name]:
-            self.output_file[self.output_file_name]["frames"] = 1
-        else:
-            self.output_file[self.output_file_name]["frames"] += 1
+        self._set_output(name, len(frame))
+        # Count all the contacts of this frame
+        self.output_file[self.output_file_name].add(frame)
+
+    def compute_distances_block(self, xyz_block, name):
+        """
+        Counts the contacts of a block of frames of the same chain
+        :param xyz_block: block of frames, (np.ndarray, shape = (number of frames, number of residues,3))
+        :param name: fasta name of any frame of the block
+        :return:
+        """
+        self._set_output(name, xyz_block.shape[1])
+        self.output_file[self.output_file_name].add(xyz_block)
 
     def convert_to_fragments(self):
         """
         Turns distance count between CA's to counts between SA fragments
         Two fragments are considered in contact if at least one of its parts is in contact
-        """ 
+        """
         for key in self.output_file:
-            # key 1 is the file name and key 2 is the residues
-            # number of fragments we expect
-            num_fragments = len(self.output_file[key][0]) - (self.fragment_size - 1)
-            for key2 in self.output_file[key]:
-                new_array = []
-                if key2 == "frames":
-                    continue
-                if key2 >= num_fragments:
-                    continue
-                for i in range(0, num_fragments):
-                    # number of times it was close enough
-                    value = np.max(self.output_file[key][key2][i:i+self.fragment_size])
-                    new_array.append(value)
-                self.output_file[key][key2] = new_array
+            self.fragment_counts[key] = sliding_max(self.output_file[key].counts, self.fragment_size)
 
+    def contact_counts(self):
+        """
+        Counts of every accumulator as they would be saved, fragment counts once converted
+        :return: dictionary of output file name to np.ndarray of counts and number of frames
+        """
+        return {key: (self.fragment_counts.get(key, self.output_file[key].counts), self.output_file[key].frames)
+                for key in self.output_file}
 
-    def save_output(self):
+    def save_output(self, binary=False):
         """
         Saves results to output file
+        :param binary: write a compact .npz file with the counts and the number of frames instead of text
         """
-        for key in self.output_file:
+        for key, (counts, frames) in self.contact_counts().items():
+            if binary:
+                np.savez_compressed("%s.npz" % key.rsplit(".out", 1)[0], counts=counts, frames=frames)
+                continue
             with open(key, "w") as out:
-                for key2 in self.output_file[key]:
-                    if key2 == "frames":
-                        out.write("frames : %s\n" % self.output_file[key][key2])
-                        continue
-                    out.write("%s:[ " % key2)
-                    for element in self.output_file[key][key2]:
-                        out.write("%s " % element)
-                    out.write("]\n")
+                for i, row in enumerate(counts):
+                    out.write("%s:[ %s ]\n" % (i, " ".join(map(str, row.astype(np.float64).tolist()))))
+                out.write("frames : %s\n" % frames)
+
+    @staticmethod
+    def load_output(file):
+        """
+        Reads an output file written by save_output, either text or .npz
+        :param file: name of the output file
+        :return: np.ndarray of counts and number of frames
+        """
+        if file.endswith(".npz"):
+            with np.load(file) as data:
+                return data["counts"], int(data["frames"])
+        rows = []
+        frames = 0
+        with open(file, "r") as inn:
+            for line in inn:
+                if line.startswith("frames"):
+                    frames = int(line.split(":")[1])
+                    continue
+                values = line.split("[")[1].split("]")[0].split()
+                rows.append([int(float(value)) for value in values])
+        return np.array(rows, dtype=np.int64), frames
+
+    @staticmethod
+    def checkpoint_name(key):
+        """
+        Name of the file holding the raw counts of an accumulator between checkpoints
+        """
+        return "%s.ckpt.npz" % key.rsplit(".out", 1)[0]
 
+    def save_checkpoint(self):
+        """
+        Saves the raw counts of every accumulator, so an interrupted run can be resumed
+        :return: list of the accumulators saved
+        """
+        for key in self.output_file:
+            name = self.checkpoint_name(key)
+            with open(name + ".tmp", "wb") as out:
+                np.savez(out, counts=self.output_file[key].counts, frames=self.output_file[key].frames)
+            os.replace(name + ".tmp", name)
+        return list(self.output_file)
+
+    def load_checkpoint(self, keys):
+        """
+        Restores the accumulators saved by save_checkpoint
+        :param keys: names of the accumulators to restore
+        :return: number of frames counted by every accumulator
+        """
+        frames = []
+        for key in keys:
+            with np.load(self.checkpoint_name(key)) as data:
+                accumulator = ContactAccumulator(data["counts"].shape[0], self.cutoff, self.method)
+                accumulator.counts[...] = data["counts"]
+                accumulator.frames = int(data["frames"])
+            self.output_file[key] = accumulator
+            frames.append(accumulator.frames)
+        return frames
+
+    def remove_checkpoint(self, keys):
+        """
+        Deletes the files written by save_checkpoint once the outputs are complete
+        :param keys: names of the accumulators
+        """
+        for key in keys:
+            if os.path.exists(self.checkpoint_name(key)):
+                os.remove(self.checkpoint_name(key))
+
+    def close_output(self):
+        """
+        Forgets the accumulated counts once they have been saved
+        """
+        self.output_file = {}
+        self.output_file_name = ""
+        self.fragment_counts = {}
@@ -0,0 +1,376 @@
+# ===============================================================================
+# Trajencode
+# TrajScheduler.py
+# Processing of trajectories and distribution of input files over a pool of workers
+# ===============================================================================
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from TrajSAencode.TrajLoader import TrajLoader
+from TrajSAencode.SAEncoder import SAEncoder, BUFFER_SIZE
+from TrajSAencode.SAlib import SADICT
+from TrajSAencode.TrajProcessor import TrajProcessor
+from TrajSAencode.Checkpoint import Checkpoint, file_identity
+from TrajSAencode.WindowCache import WindowCache
+from TrajSAencode.Profiler import StageProfiler, NULL_PROFILER
+from TrajSAencode.SAMetric import RMSD_FUNCTIONS, substitution_matrix, sub_matrix_array
+from TrajSAencode.StreamCluster import StreamClustering
+from TrajSAencode.TrajAPI import encoded_blocks
+
+
+def _save_checkpoint(checkpoint, frames_done, sa_encoder, traj_pros):
+    """
+    Flushes the outputs and records them in the checkpoint manifest
+    """
+    files = sa_encoder.flush_output() if sa_encoder is not None else {}
+    contacts = traj_pros.save_checkpoint() if traj_pros is not None else []
+    checkpoint.save(frames_done, files, contacts)
+
+
+def _update_checkpoint(checkpoint, chain_counts, names, n_chains, resumed, sa_encoder, traj_pros):
+    """
+    Counts the frames written for every chain and saves a checkpoint when it is due
+    """
+    chain = names[0].split("|")[0]
+    chain_counts[chain] = chain_counts.get(chain, 0) + len(names)
+    # The outputs are only consistent when every chain has the same number of frames
+    if checkpoint.due() and len(chain_counts) == n_chains and len(set(chain_counts.values())) == 1:
+        _save_checkpoint(checkpoint, resumed + chain_counts[chain], sa_encoder, traj_pros)
+
+
+def stream_clustering(sa_encoder, threshold, max_clusters=256, merge_interval=0, merge_threshold=None):
+    """
+    Creates the online clustering of the frames encoded by an encoder, with the substitution matrix of its
+    alphabet and RMSD engine
+    :param sa_encoder: SAEncoder whose encodings are clustered
+    :return: StreamClustering, see its arguments
+    """
+    keys = sorted(sa_encoder.sa_dict.keys())
+    sub_matrix = substitution_matrix(sa_encoder.sa_dict, sa_encoder.fragment_size,
+                                     RMSD_FUNCTIONS[sa_encoder.rmsd_method])
+    return StreamClustering(sub_matrix_array(sub_matrix, keys), keys, sa_encoder.library.keys, threshold,
+                            max_clusters=max_clusters, merge_interval=merge_interval,
+                            merge_threshold=merge_threshold)
+
+
+def process_trajectory(traj_loader, sa_encoder=None, traj_pros=None, n_workers=1, verbose=True, checkpoint=None,
+                       profiler=None, clustering=None):
+    """
+    Encodes and/or computes the distances of every frame yielded by a loader
+    :param traj_loader: TrajLoader of the file to process
+    :param sa_encoder: SAEncoder writing the encodings, None to skip the encoding
+    :param traj_pros: TrajProcessor accumulating the distances, None to skip the distances
+    :param n_workers: number of threads encoding chunks in parallel
+    :param verbose: whether to print the progress
+    :param checkpoint: Checkpoint saved periodically while processing, None to disable it
+    :param profiler: StageProfiler counting the frames and timing the distances, None to disable it
+    :param clustering: StreamClustering receiving the encoded frames, None to skip the clustering
+    :return: number of trajectory frames processed
+    """
+    profiler = profiler if profiler is not None else NULL_PROFILER
+    n_chains = len(traj_loader.chains)
+    chain_frames = 0
+    nframes = 0
+    chain_counts = {}
+    resumed = checkpoint.frames_done if checkpoint is not None else 0
+    blocks = encoded_blocks(traj_loader, sa_encoder, n_workers)
+    for xyz_block, names, encoding in blocks:
+        if len(names) == 0:
+            continue
+        if sa_encoder is not None:
+            sa_encoder.write_encoding(encoding, names)
+            if clustering is not None:
+                with profiler.stage("cluster"):
+                    clustering.add(encoding, names)
+        if traj_pros is not None:
+            with profiler.stage("distances"):
+                traj_pros.compute_distances_block(xyz_block, names[0])
+        if checkpoint is not None:
+            with profiler.stage("checkpoint"):
+                _update_checkpoint(checkpoint, chain_counts, names, n_chains, resumed, sa_encoder, traj_pros)
+        # Trajectory frames are complete once every chain has been processed
+        chain_frames += len(names)
+        profiler.count(chain_frames // n_chains - nframes, len(names) * xyz_block.shape[-2])
+        nframes = chain_frames // n_chains
+        profiler.tick()
+        if verbose:
+            print("Processed Frames: %s" % nframes, end="\r")
+    return nframes
+
+
+def format_cache_stats(stats):
+    """
+    One line summary of the statistics of a WindowCache
+    """
+    return "%s hits, %s misses, %s evictions, %s rejected (hit rate %.1f%%)" % (
+        stats["hits"], stats["misses"], stats["evictions"], stats["rejected"], 100 * stats["hit_rate"])
+
+
+def format_search_stats(stats):
+    """
+    One line summary of the RMSD evaluations skipped by the pruned library search
+    """
+    return "%s of %s RMSD evaluations skipped (%.1f%%)" % (stats["skipped"], stats["skipped"] + stats["evaluations"],
+                                                           100 * stats["skipped_fraction"])
+
+
+def checkpoint_params(traj_loader, sa_encoder=None, traj_pros=None, binary=False):
+    """
+    Parameters that change the outputs of a trajectory, a checkpoint is only resumed when they match
+    :return: dictionary of parameters
+    """
+    params = {"split_chains": traj_loader.split_chains, "start_f": traj_loader.start_f, "skip": traj_loader.skip,
+              "stride": traj_loader.stride or 1, "encode": None, "distance": None}
+    if sa_encoder is not None:
+        params["encode"] = {"rmsd_method": sa_encoder.rmsd_method, "output_format": sa_encoder.output_format,
+                            "alphabet": "".join(sa_encoder.library.keys)}
+    if traj_pros is not None:
+        params["distance"] = {"cutoff": traj_pros.cutoff, "method": traj_pros.method, "binary": binary}
+    return params
+
+
+def _resume_outputs(traj_loader, checkpoint, sa_encoder, traj_pros):
+    """
+    Reopens the outputs recorded in a checkpoint and moves the loader past the frames already processed
+    :return: True if the outputs could be restored, False to start the trajectory again
+    """
+    # A pdb is a single frame, there is nothing to seek
+    if traj_loader.topology_file == traj_loader.mdtrajectory or checkpoint.frames_done == 0:
+        return False
+    for key, offset in checkpoint.files.items():
+        if sa_encoder is None or not os.path.exists(key) or os.path.getsize(key) < offset:
+            return False
+    if traj_pros is not None:
+        if any(not os.path.exists(traj_pros.checkpoint_name(key)) for key in checkpoint.contacts):
+            return False
+        # Counts saved after the manifest was last written belong to a newer, unrecorded checkpoint
+        if any(frames != checkpoint.frames_done for frames in traj_pros.load_checkpoint(checkpoint.contacts)):
+            traj_pros.close_output()
+            return False
+    if sa_encoder is not None:
+        frame_numbers = range(traj_loader.start_f + 1, traj_loader.start_f + checkpoint.frames_done + 1)
+        sa_encoder.resume_output(checkpoint.files, frame_numbers)
+    traj_loader.skip += checkpoint.frames_done * (traj_loader.stride or 1)
+    traj_loader.start_f += checkpoint.frames_done
+    return True
+
+
+def check_output_names(files, topology=None):
+    """
+    Checks that every input file has its own outputs. The outputs of a file are written when it is complete,
+    so two files sharing the prefix of their outputs (same file name in different folders or with different
+    extensions) would overwrite each other
+    :param files: list of trajectories, or of pdbs when no topology is given
+    :param topology: topology shared by all the trajectories, None when every file is a pdb
+    """
+    owners = {}
+    for traj in files:
+        base = TrajLoader.output_name(topology if topology is not None else traj, traj)
+        if base in owners:
+            raise ValueError("%s and %s would both write the outputs %s.*, rename one of them"
+                             % (owners[base], traj, base))
+        owners[base] = traj
+
+
+def finish_outputs(sa_encoder=None, traj_pros=None, binary=False):
+    """
+    Writes and closes the outputs once the trajectories feeding them are complete
+    :param sa_encoder: SAEncoder with open encoding files, None if not encoding
+    :param traj_pros: TrajProcessor with contact counts, None if not computing distances
+    :param binary: save the distance counts as .npz files instead of text
+    """
+    if sa_encoder is not None:
+        sa_encoder.close_output()
+    if traj_pros is not None:
+        traj_pros.convert_to_fragments()
+        traj_pros.save_output(binary=binary)
+        traj_pros.close_output()
+
+
+def process_file(traj_loader, sa_encoder=None, traj_pros=None, n_workers=1, binary=False, resume=False,
+                 checkpoint_interval=None, verbose=True, profiler=None, clustering=None):
+    """
+    Processes a whole trajectory and writes its outputs, keeping a checkpoint manifest to resume interrupted runs
+    :param traj_loader: TrajLoader of the file to process
+    :param sa_encoder: SAEncoder writing the encodings, None to skip the encoding
+    :param traj_pros: TrajProcessor accumulating the distances, None to skip the distances
+    :param n_workers: number of threads encoding chunks in parallel
+    :param binary: save the distance counts as .npz files instead of text
+    :param resume: continue from the checkpoint of a previous run, skipping trajectories already complete
+    :param checkpoint_interval: seconds between checkpoints, 0 to only record complete trajectories,
+                                None to disable the manifest
+    :param verbose: whether to print the progress
+    :param profiler: StageProfiler counting the frames and timing the distances and outputs, None to disable it
+    :param clustering: StreamClustering of the encoded frames, its state is not checkpointed so interrupted
+                       trajectories are processed again from the start
+    :return: number of trajectory frames processed, None if the trajectory was already complete
+    """
+    checkpoint = None
+    if checkpoint_interval is not None:
+        identity = {"trajectory": file_identity(traj_loader.mdtrajectory),
+                    "topology": file_identity(traj_loader.topology_file)}
+        checkpoint = Checkpoint(traj_loader.output_base(), identity,
+                                checkpoint_params(traj_loader, sa_encoder, traj_pros, binary), checkpoint_interval)
+        if resume and checkpoint.load():
+            if checkpoint.complete:
+                return None
+            if clustering is None and _resume_outputs(traj_loader, checkpoint, sa_encoder, traj_pros):
+                if verbose:
+                    print("Resuming from frame %s" % checkpoint.frames_done)
+            else:
+                checkpoint.frames_done = 0
+    resumed = checkpoint.frames_done if checkpoint is not None else 0
+    nframes = process_trajectory(traj_loader, sa_encoder, traj_pros, n_workers=n_workers, verbose=verbose,
+                                 checkpoint=checkpoint, profiler=profiler, clustering=clustering)
+    contacts = list(traj_pros.output_file) if traj_pros is not None else []
+    with (profiler if profiler is not None else NULL_PROFILER).stage("finish"):
+        finish_outputs(sa_encoder, traj_pros, binary)
+        if clustering is not None:
+            clustering.finish()
+    if checkpoint is not None:
+        checkpoint.save(resumed + nframes, {}, [], complete=True)
+        if traj_pros is not None:
+            traj_pros.remove_checkpoint(contacts)
+    return nframes
+
+
+# State of every worker process, created once by _init_worker
+_worker = {}
+
+
+def _init_worker(options, shared_topology):
+    """
+    Creates the encoder and the distance processor of a worker process
+    :param options: dictionary with the TrajScheduler options
+    :param shared_topology: topology parsed once by the parent process, None for lists of pdbs
+    """
+    _worker["options"] = options
+    _worker["shared_topology"] = shared_topology
+    _worker["sa_encoder"] = None
+    _worker["traj_pros"] = None
+    _worker["clustering"] = None
+    if options["mode"] in ["all", "encode"]:
+        # Every worker keeps its own cache, shared by all the files it processes
+        cache = None
+        if options["cache_size"] > 0:
+            cache = WindowCache(options["cache_size"], mode=options["cache_mode"],
+                                resolution=options["cache_resolution"])
+        _worker["sa_encoder"] = SAEncoder(SADICT, rmsd_method=options["rmsd_method"],
+                                          output_format=options["output_format"],
+                                          buffer_size=options["buffer_size"], cache=cache,
+                                          prune=options["prune"])
+        if options["cluster"] is not None:
+            _worker["clustering"] = stream_clustering(_worker["sa_encoder"], **options["cluster"])
+    if options["mode"] in ["all", "distance"]:
+        _worker["traj_pros"] = TrajProcessor(SADICT, options["cutoff"], method=options["contact_method"])
+
+
+def _process_file(traj):
+    """
+    Processes a single input file inside a worker and flushes its outputs
+    :param traj: name of the trajectory or pdb file
+    :return: dictionary with the name of the file, the number of frames (None if it was already complete),
+             the seconds spent, the statistics of the window cache and of the library search of the worker
+             and the profile of the file (None when they are disabled)
+    """
+    options = _worker["options"]
+    sa_encoder = _worker["sa_encoder"]
+    traj_pros = _worker["traj_pros"]
+    start = time.perf_counter()
+    topology = options["topology"] if options["topology"] is not None else traj
+    profiler = StageProfiler(options["stats_interval"], label=traj) if options["profile"] else None
+    if sa_encoder is not None:
+        sa_encoder.profiler = profiler if profiler is not None else NULL_PROFILER
+    traj_loader = TrajLoader(topology, traj, shared_topology=_worker["shared_topology"], profiler=profiler,
+                             **options["loader"])
+    # Outputs of this file are written when it is complete, independently of the other files
+    nframes = process_file(traj_loader, sa_encoder, traj_pros, n_workers=options["n_threads"],
+                           binary=options["binary"], resume=options["resume"],
+                           checkpoint_interval=options["checkpoint_interval"], verbose=False, profiler=profiler,
+                           clustering=_worker["clustering"])
+    return {"file": traj, "frames": nframes, "seconds": time.perf_counter() - start,
+            "cache": sa_encoder.cache.stats() if sa_encoder is not None and sa_encoder.cache is not None else None,
+            "search": sa_encoder.search_stats() if sa_encoder is not None else None,
+            "profile": profiler.summary() if profiler is not None else None}
+
+
+class TrajScheduler:
+
+    def __init__(self, files, topology=None, n_workers=1, mode="all", cutoff=1.0, rmsd_method="gsl", n_threads=1,
+                 contact_method="dense", binary=False, output_format="sasta", buffer_size=BUFFER_SIZE, resume=False,
+                 checkpoint_interval=None, cache_size=0, cache_mode="strict", cache_resolution=0.01, prune=False,
+                 profile=False, stats_interval=0.0, cluster=None, **loader_options):
+        """
+        Distributes input files over a pool of worker processes
+        :param files: list of trajectories, or of pdbs when no topology is given
+        :param topology: topology shared by all the trajectories, None when every file is a pdb
+        :param n_workers: number of worker processes
+        :param mode: Way to process the files: encode, distance or all
+        :param cutoff: cutoff used to compute the distances, in nm
+        :param rmsd_method: RMSD engine used by the encoder
+        :param n_threads: number of threads encoding chunks inside every worker
+        :param contact_method: contact counting method of TrajProcessor, "dense" or "grid"
+        :param binary: save the distance counts as .npz files instead of text
+        :param output_format: encoding output, "sasta" text files, "sab" binary files or "both"
+        :param buffer_size: size in bytes of the write buffer of the encoding output files
+        :param resume: continue every file from its checkpoint, skipping the files already complete
+        :param checkpoint_interval: seconds between checkpoints of every file, None to disable them
+        :param cache_size: windows kept in the cache of encoded windows of every worker, 0 to disable it
+        :param cache_mode: how the cache keys the windows, see WindowCache
+        :param cache_resolution: rounding of the approximate cache keys, in nm
+        :param prune: prune the library search with RMSD lower bounds, same result as the exhaustive search
+        :param profile: time the stages of every file and gather them in self.profiler
+        :param stats_interval: seconds between the JSON stats lines written by the workers, 0 to disable them
+        :param cluster: arguments of stream_clustering to cluster the frames while encoding, None to disable it
+        :param loader_options: extra arguments for TrajLoader (split_chains, chunk_size, start_f, skip, stride,
+                               prefetch)
+        """
+        check_output_names(files, topology)
+        self.files = files
+        self.topology = topology
+        self.n_workers = n_workers
+        self.options = {"mode": mode, "cutoff": cutoff, "rmsd_method": rmsd_method, "n_threads": n_threads,
+                        "contact_method": contact_method, "binary": binary, "output_format": output_format,
+                        "buffer_size": buffer_size, "resume": resume, "checkpoint_interval": checkpoint_interval,
+                        "cache_size": cache_size, "cache_mode": cache_mode, "cache_resolution": cache_resolution,
+                        "prune": prune, "profile": profile or stats_interval > 0, "stats_interval": stats_interval,
+                        "cluster": cluster, "topology": topology, "loader": loader_options}
+        # Stages and counters of all the files, gathered from the workers
+        self.profiler = StageProfiler() if self.options["profile"] else None
+
+    def schedule(self):
+        """
+        Orders the files from the largest to the smallest, so the big files start first
+        and the small ones fill the gaps at the end
+        :return: list of file names
+        """
+        return sorted(self.files, key=os.path.getsize, reverse=True)
+
+    def run(self):
+        """
+        Processes all the files and reports the throughput of each one as it finishes
+        :return: list of (file name, number of frames, seconds)
+        """
+        # Parse the shared topology only once, the workers receive a copy
+        shared_topology = TrajLoader.load_topology(self.topology) if self.topology is not None else None
+        results = []
+        with ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_worker,
+                                 initargs=(self.options, shared_topology)) as executor:
+            futures = [executor.submit(_process_file, traj) for traj in self.schedule()]
+            for future in as_completed(futures):
+                result = future.result()
+                traj, nframes, seconds = result["file"], result["frames"], result["seconds"]
+                results.append((traj, nframes, seconds))
+                if nframes is None:
+                    print("Skipped %s: already encoded" % traj)
+                    continue
+                print("Finished %s: %s frames in %.2f s (%.2f frames/s)" %
+                      (traj, nframes, seconds, nframes / seconds if seconds > 0 else 0.0))
+                if result["cache"] is not None:
+                    print("Window cache of the worker: %s" % format_cache_stats(result["cache"]))
+                if self.options["prune"] and result["search"] is not None:
+                    print("Pruned search of the worker: %s" % format_search_stats(result["search"]))
+                if self.profiler is not None:
+                    self.profiler.merge(result["profile"])
+        return results
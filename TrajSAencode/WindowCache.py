@@ -0,0 +1,144 @@
+# ===============================================================================
+# Trajencode
+# WindowCache.py
+# LRU cache of encoded windows, to skip the library search for repeated geometries
+# ===============================================================================
+
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# How windows are keyed: "geometry" uses the centred coordinates and "distance" the internal CA distances, both
+# rounded to the resolution. "strict" keys as "geometry" but only uses a cached fragment when it is certified to be
+# the closest one for the window, so it always gives the output of the full search: every entry keeps the window
+# that was searched and a lower bound of its RMSD to the other fragments, and as the RMSD is a distance, moving the
+# window by d lowers that bound by at most d. Windows that fail the certification are searched
+CACHE_MODES = ["strict", "geometry", "distance"]
+
+
+class WindowCache:
+
+    def __init__(self, max_size=2 ** 16, mode="strict", resolution=0.01):
+        """
+        Remembers the fragment assigned to recently seen windows, evicting the least recently used ones
+        :param max_size: maximum number of windows kept
+        :param mode: "strict", "geometry" or "distance", see CACHE_MODES
+        :param resolution: rounding of the coordinates or distances of the keys, in nm
+        """
+        if mode not in CACHE_MODES:
+            raise ValueError("Unknown cache mode %s, options: %s" % (mode, ", ".join(CACHE_MODES)))
+        if max_size < 1:
+            raise ValueError("The cache must hold at least one window")
+        self.max_size = max_size
+        self.mode = mode
+        self.resolution = resolution
+        # Fragment of every key, with the centred window searched and its bound to the other fragments when strict
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejected = 0  # cached fragments of the strict mode that failed the certification and were searched
+        # Blocks can be encoded from several threads at once
+        self.lock = threading.Lock()
+
+    def keys(self, windows):
+        """
+        Computes the key of every window
+        :param windows: np.ndarray of shape (number of windows, fragment size, 3)
+        :return: list of bytes
+        """
+        if self.mode in ["strict", "geometry"]:
+            values = np.rint(self._centre(windows) / self.resolution).astype(np.int32)
+        else:
+            first, second = np.triu_indices(windows.shape[1], k=1)
+            distances = np.sqrt(np.sum((windows[:, first] - windows[:, second]) ** 2, axis=-1))
+            values = np.rint(distances / self.resolution).astype(np.int32)
+        values = np.ascontiguousarray(values.reshape(values.shape[0], -1))
+        return values.view(np.dtype((np.void, values.shape[1] * values.itemsize))).ravel().tolist()
+
+    @staticmethod
+    def _centre(windows):
+        return windows - windows.mean(axis=1, keepdims=True, dtype=np.float64)
+
+    def encode(self, windows, search, certify=None):
+        """
+        Encodes a block of windows, searching the library only for the windows not in the cache.
+        Repeated windows of the block are searched once. In strict mode every window given a fragment without
+        being searched is certified first, and searched when the certification fails
+        :param windows: np.ndarray of shape (number of windows, fragment size, 3)
+        :param search: function encoding an array of windows, returns their fragment indexes. In strict mode it is
+                       called with return_second=True and also returns a lower bound of the RMSD of every window to
+                       the other fragments, see SAEncoder.encode_windows
+        :param certify: function of an array of windows, their candidate fragment indexes and lower bounds of their
+                        RMSD to the other fragments, returns whether every candidate is the fragment the search
+                        would return, see SAEncoder.certify_windows. Needed by the strict mode
+        :return: np.ndarray of fragment indexes, one per window
+        """
+        strict = self.mode == "strict"
+        if strict and certify is None:
+            raise ValueError("The strict cache mode needs a certification function")
+        keys = self.keys(windows)
+        encoding = np.empty(len(keys), dtype=np.int32)
+        pending = OrderedDict()  # key of every missing window and the positions where it appears
+        reused = []  # positions given a fragment without searching them and the entry they got it from
+        with self.lock:
+            for i, key in enumerate(keys):
+                entry = self.entries.get(key)
+                if entry is None:
+                    pending.setdefault(key, []).append(i)
+                else:
+                    self.entries.move_to_end(key)
+                    reused.append((i, entry))
+        centred = self._centre(windows) if strict else None
+        updates = []
+        if pending:
+            first = [positions[0] for positions in pending.values()]
+            if strict:
+                codes, second = search(windows[first], return_second=True)
+                # Copies, views would keep the whole block alive in the cache
+                entries = [(int(code), centred[i].copy(), bound) for i, code, bound in zip(first, codes, second)]
+            else:
+                codes = search(windows[first])
+                entries = [int(code) for code in codes]
+            for (key, positions), code, entry in zip(pending.items(), codes, entries):
+                encoding[positions[0]] = code
+                updates.append((key, entry))
+                reused.extend((i, entry) for i in positions[1:])
+        rejected = []
+        if reused:
+            positions = np.array([i for i, _ in reused])
+            if strict:
+                encoding[positions] = [entry[0] for _, entry in reused]
+                # Upper bound of the RMSD between every window and the searched one, without superposition
+                shift = np.sqrt(np.sum((centred[positions] - np.array([entry[1] for _, entry in reused])) ** 2,
+                                       axis=(1, 2)) / windows.shape[1])
+                floors = np.array([entry[2] for _, entry in reused]) - shift
+                rejected = positions[~certify(windows[positions], encoding[positions], floors)]
+            else:
+                encoding[positions] = [entry for _, entry in reused]
+        if len(rejected) > 0:
+            # Windows whose key is shared with a different geometry, the cache keeps the latest one searched
+            codes, second = search(windows[rejected], return_second=True)
+            encoding[rejected] = codes
+            updates.extend((keys[i], (int(code), centred[i].copy(), bound))
+                           for i, code, bound in zip(rejected, codes, second))
+        with self.lock:
+            self.hits += len(keys) - len(pending) - len(rejected)
+            self.misses += len(pending) + len(rejected)
+            self.rejected += len(rejected)
+            for key, entry in updates:
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return encoding
+
+    def stats(self):
+        """
+        Usage statistics of the cache
+        :return: dictionary with the hits, misses, evictions, rejected certifications, hit rate and size
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "rejected": self.rejected,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0, "size": len(self.entries)}
@@ -6,50 +6,288 @@
 
 #include "encodeframe.h"
 #include "kabsch.h"
+#include "qcprmsd.h"
+#include <math.h>
 #include <stdio.h>
+#include <stdlib.h>
 
-void encode_frame(unsigned int n_windows, unsigned int n_fragments, unsigned int f_size, float (*MDframe)[3],
- float (*Fragments)[3], int *Encoding)
+/* Margin of the pruned search, larger than the rounding error of the rmsd engines */
+#define PRUNE_EPS 1e-6
+
+/*
+* Centres a window at the origin and returns its inner product (sum of squared norms).
+*/
+static double centre_window(unsigned int f_size, float (*MD_fragment)[3], double (*MD_centred)[3])
+{
+  double centroid[3] = {0., 0., 0.};
+  double inner = 0.;
+  unsigned int j;
+  for (j = 0; j < f_size; j++){
+      centroid[0] += MD_fragment[j][0];
+      centroid[1] += MD_fragment[j][1];
+      centroid[2] += MD_fragment[j][2];
+  }
+  centroid[0] /= f_size;
+  centroid[1] /= f_size;
+  centroid[2] /= f_size;
+  for (j = 0; j < f_size; j++){
+      MD_centred[j][0] = MD_fragment[j][0] - centroid[0];
+      MD_centred[j][1] = MD_fragment[j][1] - centroid[1];
+      MD_centred[j][2] = MD_fragment[j][2] - centroid[2];
+      inner += MD_centred[j][0] * MD_centred[j][0] + MD_centred[j][1] * MD_centred[j][1] +
+               MD_centred[j][2] * MD_centred[j][2];
+  }
+  return inner;
+}
+
+/*
+* RMSD between a centred window and the library fragment k with the selected engine.
+* Both engines use the centred coordinates and inner products, so only the window is processed per call.
+* Workspace is the eigen workspace of the GSL engine, unused by QCP.
+*/
+static double fragment_rmsd(const fragment_library *Library, unsigned int k, double (*MD_centred)[3], double inner,
+ int rmsd_method, kabsch_workspace *Workspace)
+{
+  unsigned int f_size = Library->f_size;
+  if (rmsd_method == RMSD_QCP){
+      return qcp_rmsd_centred(f_size, MD_centred, inner, Library->centred + k * f_size, Library->inner[k]);
+  }
+  return kabsch_rmsd_centred(f_size, MD_centred, inner, Library->centred + k * f_size, Library->inner[k], Workspace);
+}
+
+/*
+* Workspace of the selected engine, allocated once per call of the public functions.
+*/
+static kabsch_workspace *alloc_workspace(int rmsd_method)
+{
+  return rmsd_method == RMSD_QCP ? NULL : kabsch_workspace_alloc();
+}
+
+static void free_workspace(kabsch_workspace *Workspace)
+{
+  if (Workspace != NULL){
+      kabsch_workspace_free(Workspace);
+  }
+}
+
+/* Lower bound of the rmsd to a library fragment */
+typedef struct {
+  double lower;
+  unsigned int index;
+} fragment_bound;
+
+/*
+* Orders the bounds increasingly, equal bounds keep the index order.
+*/
+static int compare_bounds(const void *a, const void *b)
+{
+  const fragment_bound *first = (const fragment_bound *) a;
+  const fragment_bound *second = (const fragment_bound *) b;
+  if (first->lower != second->lower){
+      return first->lower < second->lower ? -1 : 1;
+  }
+  return (first->index > second->index) - (first->index < second->index);
+}
+
+/*
+* Lower bound of the RMSD between a window and every library fragment. Both bounds hold for any superposition:
+*   RMSD >= |sqrt(G_A) - sqrt(G_B)| / sqrt(N), as the optimal overlap is at most sqrt(G_A * G_B)
+*   N^2 * RMSD^2 >= sum over i<j of (dA_ij - dB_ij)^2: with e_i the residuals of the superposition,
+*   |dA_ij - dB_ij| <= |e_i - e_j| by the triangle inequality, and as both sets are centred the residuals
+*   sum to zero, so sum over i<j of |e_i - e_j|^2 = N * sum of |e_i|^2 = N^2 * RMSD^2
+*/
+static void rmsd_lower_bounds(const fragment_library *Library, double (*MD_centred)[3], double inner,
+ fragment_bound *bounds)
+{
+  unsigned int n_fragments = Library->n_fragments;
+  unsigned int f_size = Library->f_size;
+  unsigned int n_pairs = f_size * (f_size - 1) / 2;
+  double distances[n_pairs + 1];
+  double norm = sqrt(inner);
+  unsigned int i,j,k,p;
+  for (i = 0, p = 0; i < f_size; i++){
+      for (j = i + 1; j < f_size; j++, p++){
+          double dx = MD_centred[i][0] - MD_centred[j][0];
+          double dy = MD_centred[i][1] - MD_centred[j][1];
+          double dz = MD_centred[i][2] - MD_centred[j][2];
+          distances[p] = sqrt(dx * dx + dy * dy + dz * dz);
+      }
+  }
+  for (k = 0; k < n_fragments; k++){
+      double size_bound = norm - sqrt(Library->inner[k]);
+      size_bound = size_bound * size_bound / f_size;
+      double distance_bound = 0.;
+      const double *fragment_distances = Library->distances + k * n_pairs;
+      for (p = 0; p < n_pairs; p++){
+          double difference = distances[p] - fragment_distances[p];
+          distance_bound += difference * difference;
+      }
+      distance_bound /= (double) f_size * f_size;
+      bounds[k].lower = sqrt(size_bound > distance_bound ? size_bound : distance_bound);
+      bounds[k].index = k;
+  }
+}
+
+/*
+* Returns the index of the library fragment closest to a single window of f_size atoms.
+* When Skipped is not NULL the fragments are visited by increasing lower bound and the search stops
+* once the bound exceeds the best RMSD found, adding the number of RMSD evaluations avoided to Skipped.
+* Ties are resolved towards the lowest index, as in the exhaustive search.
+* When Second is not NULL it receives a lower bound of the rmsd to every other fragment: the second lowest rmsd,
+* or the lowest bound of the skipped fragments when it is smaller.
+*/
+static int encode_window(const fragment_library *Library, float (*MD_fragment)[3], int rmsd_method,
+ unsigned long long *Skipped, double *Second, kabsch_workspace *Workspace)
+{
+  unsigned int n_fragments = Library->n_fragments;
+  unsigned int f_size = Library->f_size;
+  double MD_centred[f_size][3];
+  double inner = centre_window(f_size, MD_fragment, MD_centred);
+  unsigned int k,m;
+
+  if (Skipped == NULL){
+      // Exhaustive search, the first fragment with the lowest rmsd wins
+      double min_rmsd = fragment_rmsd(Library, 0, MD_centred, inner, rmsd_method, Workspace);
+      double second_rmsd = INFINITY;
+      unsigned int min_index = 0;
+      for (k = 1; k < n_fragments; k++){
+          double rmsd = fragment_rmsd(Library, k, MD_centred, inner, rmsd_method, Workspace);
+          if (rmsd < min_rmsd){
+              second_rmsd = min_rmsd;
+              min_rmsd = rmsd;
+              min_index = k;
+          } else if (rmsd < second_rmsd){
+              second_rmsd = rmsd;
+          }
+      }
+      if (Second != NULL){
+          *Second = second_rmsd;
+      }
+      return min_index;
+  }
+
+  // Visit the fragments by increasing lower bound
+  fragment_bound bounds[n_fragments];
+  rmsd_lower_bounds(Library, MD_centred, inner, bounds);
+  qsort(bounds, n_fragments, sizeof(fragment_bound), compare_bounds);
+  double min_rmsd = INFINITY;
+  double second_rmsd = INFINITY;
+  unsigned int min_index = 0;
+  for (m = 0; m < n_fragments; m++){
+      k = bounds[m].index;
+      // The margin keeps the search exact despite the rounding of the rmsd engines
+      if (bounds[m].lower > min_rmsd + PRUNE_EPS){
+          *Skipped += n_fragments - m;
+          // The remaining bounds are larger, the first one bounds all the skipped fragments
+          if (bounds[m].lower < second_rmsd){
+              second_rmsd = bounds[m].lower;
+          }
+          break;
+      }
+      double rmsd = fragment_rmsd(Library, k, MD_centred, inner, rmsd_method, Workspace);
+      if (rmsd < min_rmsd || (rmsd == min_rmsd && k < min_index)){
+          second_rmsd = min_rmsd;
+          min_rmsd = rmsd;
+          min_index = k;
+      } else if (rmsd < second_rmsd){
+          second_rmsd = rmsd;
+      }
+  }
+  if (Second != NULL){
+      *Second = second_rmsd;
+  }
+  return min_index;
+}
+
+/*
+* Encodes the sliding windows of one frame with a workspace owned by the caller.
+*/
+static void encode_frame_windows(unsigned int n_windows, const fragment_library *Library, float (*MDframe)[3],
+ int *Encoding, int rmsd_method, unsigned long long *Skipped, kabsch_workspace *Workspace)
 {
-  // allocating memory
-  float MD_fragment[f_size][3];
-  float fragment[f_size][3];
-  double rmsd[n_fragments];
   // Iterate over the MD frame using an sliding windows of size = f_size
-  unsigned int i,j,k,l,m;
-  unsigned int f_count = 0;
+  unsigned int i;
+  for (i = 0; i < n_windows; i++){
+     // Store the index of the lowest rmsd fragment
+     Encoding[i] = encode_window(Library, MDframe + i, rmsd_method, Skipped, NULL, Workspace);
+  }
+}
+
+void encode_frame(unsigned int n_windows, const fragment_library *Library, float (*MDframe)[3], int *Encoding,
+ int rmsd_method, unsigned long long *Skipped)
+{
+  kabsch_workspace *Workspace = alloc_workspace(rmsd_method);
+  encode_frame_windows(n_windows, Library, MDframe, Encoding, rmsd_method, Skipped, Workspace);
+  free_workspace(Workspace);
+};
+
+/*
+* Encodes independent windows stored contiguously as (n_windows, f_size, 3),
+* used to encode only the windows missing from a cache. When Second is not NULL it receives, for every window,
+* a lower bound of its rmsd to the fragments other than the one returned.
+*/
+void encode_windows(unsigned int n_windows, const fragment_library *Library, float (*Windows)[3], int *Encoding,
+ int rmsd_method, unsigned long long *Skipped, double *Second)
+{
+  kabsch_workspace *Workspace = alloc_workspace(rmsd_method);
+  unsigned int i;
   for (i = 0; i < n_windows; i++){
-     // Initialize the MD fragment to process
-     for (j = 0; j < f_size; j++){
-         MD_fragment[j][0] = MDframe[j + f_count][0];
-         MD_fragment[j][1] = MDframe[j + f_count][1];
-         MD_fragment[j][2] = MDframe[j + f_count][2];
+     Encoding[i] = encode_window(Library, Windows + i * Library->f_size, rmsd_method, Skipped,
+                                 Second != NULL ? Second + i : NULL, Workspace);
+  }
+  free_workspace(Workspace);
+};
+
+/*
+* Checks whether a candidate fragment is the one the search would return for every window, without a search:
+* Certified[i] is 1 when the rmsd of window i to fragment Encoding[i] is below a lower bound of the rmsd to
+* every other fragment, so it is the unique minimum, and 0 otherwise. The bound of every fragment is the larger
+* of Floor[i], a lower bound known by the caller for all the other fragments, and rmsd_lower_bounds.
+* Used to validate cached codes.
+*/
+void certify_windows(unsigned int n_windows, const fragment_library *Library, float (*Windows)[3],
+ const int *Encoding, const double *Floor, int *Certified, int rmsd_method)
+{
+  unsigned int n_fragments = Library->n_fragments;
+  unsigned int f_size = Library->f_size;
+  double MD_centred[f_size][3];
+  fragment_bound bounds[n_fragments];
+  kabsch_workspace *Workspace = alloc_workspace(rmsd_method);
+  unsigned int i,k;
+  for (i = 0; i < n_windows; i++){
+     float (*MD_fragment)[3] = Windows + i * f_size;
+     double inner = centre_window(f_size, MD_fragment, MD_centred);
+     unsigned int candidate = (unsigned int) Encoding[i];
+     double rmsd = fragment_rmsd(Library, candidate, MD_centred, inner, rmsd_method, Workspace);
+     Certified[i] = 1;
+     // The margin covers the rounding of the rmsd engines, as in the pruned search
+     if (Floor[i] > rmsd + PRUNE_EPS){
+         continue;
      }
-     f_count += 1;
-     // Iterate over the fragment library
+     rmsd_lower_bounds(Library, MD_centred, inner, bounds);
      for (k = 0; k < n_fragments; k++){
-         // Initialize fragment
-         for (l = 0; l < f_size; l++){
-             fragment[l][0] = Fragments[l + k * f_size][0];
-             fragment[l][1] = Fragments[l + k * f_size][1];
-             fragment[l][2] = Fragments[l + k * f_size][2];
+         if (k != candidate && bounds[k].lower <= rmsd + PRUNE_EPS){
+             Certified[i] = 0;
+             break;
          }
-         // Stored rmsd between the MD fragment and library fragments
-         rmsd[k] = wrmsd_kabsch(f_size, MD_fragment, fragment);
      }
+  }
+  free_workspace(Workspace);
+};
 
-     // Find the index of the lowest rmsd fragment
-     double min_rmsd = rmsd[0];
-     unsigned int min_index = 0;
-     for (m = 1; m < n_fragments; m++){
-         if (rmsd[m] < min_rmsd){
-             min_rmsd = rmsd[m];
-             min_index = m;
-         }
-     }
-
-     // Store the index of the lowest rmsd fragment
-
-     Encoding[i] = min_index;
+/*
+* Encodes a block of frames stored contiguously as (n_frames, n_residues, 3).
+* Encoding must hold n_frames * n_windows integers, one row per frame.
+*/
+void encode_frames(unsigned int n_frames, unsigned int n_residues, const fragment_library *Library,
+ float (*MDframes)[3], int *Encoding, int rmsd_method, unsigned long long *Skipped)
+{
+  unsigned int n_windows = n_residues - Library->f_size + 1;
+  kabsch_workspace *Workspace = alloc_workspace(rmsd_method);
+  unsigned int i;
+  for (i = 0; i < n_frames; i++){
+     encode_frame_windows(n_windows, Library, MDframes + i * n_residues, Encoding + i * n_windows, rmsd_method,
+                          Skipped, Workspace);
   }
+  free_workspace(Workspace);
 };
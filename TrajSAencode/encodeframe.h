@@ -12,8 +12,40 @@
 extern "C" {
 #endif
 
-void encode_frame(unsigned int n_windows, unsigned int n_fragments, unsigned int f_size, float (*MDframe)[3],
- float (*Fragments)[3], int *Encoding);
+/* RMSD engines available to the encoder */
+#define RMSD_GSL 0
+#define RMSD_QCP 1
+
+/*
+* Fragment library prepared once by the caller. Every fragment is centred at
+* the origin and its inner product (sum of squared norms) and internal distances are precomputed.
+*/
+typedef struct {
+  unsigned int n_fragments;
+  unsigned int f_size;
+  float (*centred)[3];   /* n_fragments * f_size centred coordinates */
+  double *inner;         /* inner product of every centred fragment */
+  double *distances;     /* n_fragments * f_size (f_size - 1) / 2 distances between atoms i < j */
+} fragment_library;
+
+/*
+* Skipped: NULL for the exhaustive search, otherwise the search is pruned with rmsd lower bounds,
+* giving the same result, and the number of rmsd evaluations avoided is added to it.
+*/
+void encode_frame(unsigned int n_windows, const fragment_library *Library, float (*MDframe)[3], int *Encoding,
+ int rmsd_method, unsigned long long *Skipped);
+
+void encode_frames(unsigned int n_frames, unsigned int n_residues, const fragment_library *Library,
+ float (*MDframes)[3], int *Encoding, int rmsd_method, unsigned long long *Skipped);
+
+void encode_windows(unsigned int n_windows, const fragment_library *Library, float (*Windows)[3], int *Encoding,
+ int rmsd_method, unsigned long long *Skipped, double *Second);
+
+/*
+* Certified[i] is set to 1 when Encoding[i] is certainly the fragment the search returns for window i.
+*/
+void certify_windows(unsigned int n_windows, const fragment_library *Library, float (*Windows)[3],
+ const int *Encoding, const double *Floor, int *Certified, int rmsd_method);
 
 
  #if defined(__cplusplus)
@@ -2,9 +2,23 @@ from cffi import FFI
 
 ffibuilder = FFI()
 
-ffibuilder.cdef("void encode_frame(unsigned int n_windows, unsigned int n_fragments, unsigned int f_size, float (*MDframe)[3], float (*Fragments)[3], int *Encoding);")
+ffibuilder.cdef("""
+#define RMSD_GSL 0
+#define RMSD_QCP 1
+typedef struct {
+  unsigned int n_fragments;
+  unsigned int f_size;
+  float (*centred)[3];
+  double *inner;
+  double *distances;
+} fragment_library;
+void encode_frame(unsigned int n_windows, const fragment_library *Library, float (*MDframe)[3], int *Encoding, int rmsd_method, unsigned long long *Skipped);
+void encode_frames(unsigned int n_frames, unsigned int n_residues, const fragment_library *Library, float (*MDframes)[3], int *Encoding, int rmsd_method, unsigned long long *Skipped);
+void encode_windows(unsigned int n_windows, const fragment_library *Library, float (*Windows)[3], int *Encoding, int rmsd_method, unsigned long long *Skipped, double *Second);
+void certify_windows(unsigned int n_windows, const fragment_library *Library, float (*Windows)[3], const int *Encoding, const double *Floor, int *Certified, int rmsd_method);
+""")
 
-ffibuilder.set_source("_encodeframe", """ #include "encodeframe.h" """, sources=["TrajSAencode/kabsch.c", "TrajSAencode/encodeframe.c"],
+ffibuilder.set_source("_encodeframe", """ #include "encodeframe.h" """, sources=["TrajSAencode/kabsch.c", "TrajSAencode/qcprmsd.c", "TrajSAencode/encodeframe.c"],
                       include_dirs=["./TrajSAencode"], libraries=["m", "gsl"])
 
 if __name__ == "__main__":
@@ -119,6 +119,62 @@ double wrmsd_kabsch(unsigned int size, float (*Xarray)[3], float (*Yarray)[3]) /
 	return rmsd;
 }
 
+/*____________________________________________________________________________*/
+/* Declared here as it is defined after its first use */
+static int kabsch_rotation(gsl_matrix *R, gsl_matrix *U, gsl_matrix *RTR, gsl_matrix *evec, gsl_vector *eval,
+  gsl_eigen_symmv_workspace *espace);
+
+/*____________________________________________________________________________*/
+/* Eigen workspace of kabsch_rmsd_centred, allocated once for many superpositions */
+kabsch_workspace *kabsch_workspace_alloc(void)
+{
+	return gsl_eigen_symmv_alloc(3);
+}
+
+void kabsch_workspace_free(kabsch_workspace *workspace)
+{
+	gsl_eigen_symmv_free(workspace);
+}
+
+/*____________________________________________________________________________*/
+/* RMSD of the Kabsch superposition of two fragments already centred at the origin, */
+/* with G1 and G2 the sums of squared norms of Xcentred and Ycentred. */
+/* The residuals follow from the rotation: sum_i |U x_i - y_i|^2 = G1 + G2 - 2 sum_jk U_jk R_jk, */
+/* so neither fragment is copied or centred again and only stack matrices are used. */
+double kabsch_rmsd_centred(unsigned int size, double (*Xcentred)[3], double G1, float (*Ycentred)[3], double G2,
+	kabsch_workspace *workspace)
+{
+	double r[9] = {0., 0., 0., 0., 0., 0., 0., 0., 0.};
+	double rtr[9], evec[9], eval[3], u[9];
+	gsl_matrix_view R = gsl_matrix_view_array(r, 3, 3);
+	gsl_matrix_view RTR = gsl_matrix_view_array(rtr, 3, 3);
+	gsl_matrix_view Evec = gsl_matrix_view_array(evec, 3, 3);
+	gsl_vector_view Eval = gsl_vector_view_array(eval, 3);
+	gsl_matrix_view U = gsl_matrix_view_array(u, 3, 3);
+	double overlap = 0.;
+	double varsum = 0.;
+	unsigned int i,j,k;
+
+	/* correlation matrix R, as in kabsch */
+	for (k = 0; k < size; ++ k) {
+		for (i = 0; i < 3; ++ i) {
+			for (j = 0; j < 3; ++ j) {
+				r[i * 3 + j] += Ycentred[k][i] * Xcentred[k][j];
+			}
+		}
+	}
+	kabsch_rotation(&R.matrix, &U.matrix, &RTR.matrix, &Evec.matrix, &Eval.vector, workspace);
+	for (i = 0; i < 9; ++ i) {
+		overlap += u[i] * r[i];
+	}
+	varsum = G1 + G2 - 2. * overlap;
+	/* rounding can make it slightly negative for identical fragments */
+	if (varsum < 0.) {
+		varsum = 0.;
+	}
+	return sqrt(varsum / size);
+}
+
 /*____________________________________________________________________________*/
 /* Vector cross product: gsl does not provide it */
 __inline__ static void gsl_vector_cross(
@@ -137,6 +193,69 @@ __inline__ static void gsl_vector_cross(
   gsl_vector_set(c,2,a0*b1-b0*a1);
 }
 
+/*____________________________________________________________________________*/
+/* Rotation U of Kabsch's method from the correlation matrix R of the centred points. */
+/* RTR, evec, eval and espace are 3 x 3 work matrices, vector and eigen workspace. */
+/* Returns 0 when the rotation is degenerate and U is set to the identity. */
+static int kabsch_rotation(
+  gsl_matrix *R,
+  gsl_matrix *U,
+  gsl_matrix *RTR,
+  gsl_matrix *evec,
+  gsl_vector *eval,
+  gsl_eigen_symmv_workspace *espace
+) {
+  int U_ok=1;
+  /** compute RTR = R_trans * R */
+  gsl_matrix_set_zero(RTR);
+  gsl_blas_dgemm(CblasTrans,CblasNoTrans,1.0,R,R,0.0,RTR);
+
+  /** compute orthonormal eigenvectors */
+  gsl_eigen_symmv(RTR,eval,evec,espace);  /* RTR will be modified! */
+  gsl_eigen_symmv_sort(eval,evec,GSL_EIGEN_SORT_VAL_DESC);
+  if(gsl_vector_get(eval,1)>NORM_EPS) {
+    /** compute ak's (as columns of evec) and bk's (as columns of RTR) */
+    double norm_b0,norm_b1,norm_b2;
+    gsl_vector_const_view a0=gsl_matrix_const_column(evec,0);
+    gsl_vector_const_view a1=gsl_matrix_const_column(evec,1);
+    gsl_vector_view a2=gsl_matrix_column(evec,2);
+    gsl_vector_view b0=gsl_matrix_column(RTR,0);
+    gsl_vector_view b1=gsl_matrix_column(RTR,1);
+    gsl_vector_view b2=gsl_matrix_column(RTR,2);
+    gsl_vector_cross(&a0.vector,&a1.vector,&a2.vector); /* a2 = a0 x a1 */
+    gsl_blas_dgemv(CblasNoTrans,1.0,R,&a0.vector,0.0,&b0.vector);
+    norm_b0=gsl_blas_dnrm2(&b0.vector);
+    gsl_blas_dgemv(CblasNoTrans,1.0,R,&a1.vector,0.0,&b1.vector);
+    norm_b1=gsl_blas_dnrm2(&b1.vector);
+    if(norm_b0>NORM_EPS&&norm_b1>NORM_EPS) {
+      gsl_vector_scale(&b0.vector,1.0/norm_b0);         /* b0 = ||R * a0|| */
+      gsl_vector_scale(&b1.vector,1.0/norm_b1);         /* b1 = ||R * a1|| */
+      gsl_vector_cross(&b0.vector,&b1.vector,&b2.vector);  /* b2 = b0 x b1 */
+
+      norm_b2=gsl_blas_dnrm2(&b2.vector);
+      if(norm_b2>NORM_EPS) {
+        /** we reach this point only if all bk different from 0 */
+        /** compute U = B * A_trans (use RTR as B and evec as A) */
+        gsl_matrix_set_zero(U); /* to avoid nan */
+        gsl_blas_dgemm(CblasNoTrans,CblasTrans,1.0,RTR,evec,0.0,U);
+      }
+      else {
+        U_ok=0;
+        gsl_matrix_set_identity(U);
+      }
+    }
+    else {
+      U_ok=0;
+      gsl_matrix_set_identity(U);
+    }
+  }
+  else {
+    U_ok=0;
+    gsl_matrix_set_identity(U);
+  }
+  return U_ok;
+}
+
 /*____________________________________________________________________________*/
 /*  Kabsch routine */
 int kabsch(
@@ -206,53 +325,7 @@ int kabsch(
       }
     }
 
-    /** compute RTR = R_trans * R */
-    gsl_matrix_set_zero(RTR);
-    gsl_blas_dgemm(CblasTrans,CblasNoTrans,1.0,R,R,0.0,RTR);
-
-    /** compute orthonormal eigenvectors */
-    gsl_eigen_symmv(RTR,eval,evec,espace);  /* RTR will be modified! */
-    gsl_eigen_symmv_sort(eval,evec,GSL_EIGEN_SORT_VAL_DESC);
-    if(gsl_vector_get(eval,1)>NORM_EPS) {
-      /** compute ak's (as columns of evec) and bk's (as columns of RTR) */
-      double norm_b0,norm_b1,norm_b2;
-      gsl_vector_const_view a0=gsl_matrix_const_column(evec,0);
-      gsl_vector_const_view a1=gsl_matrix_const_column(evec,1);
-      gsl_vector_view a2=gsl_matrix_column(evec,2);
-      gsl_vector_view b0=gsl_matrix_column(RTR,0);
-      gsl_vector_view b1=gsl_matrix_column(RTR,1);
-      gsl_vector_view b2=gsl_matrix_column(RTR,2);
-      gsl_vector_cross(&a0.vector,&a1.vector,&a2.vector); /* a2 = a0 x a1 */
-      gsl_blas_dgemv(CblasNoTrans,1.0,R,&a0.vector,0.0,&b0.vector);
-      norm_b0=gsl_blas_dnrm2(&b0.vector);
-      gsl_blas_dgemv(CblasNoTrans,1.0,R,&a1.vector,0.0,&b1.vector);
-      norm_b1=gsl_blas_dnrm2(&b1.vector);
-      if(norm_b0>NORM_EPS&&norm_b1>NORM_EPS) {
-        gsl_vector_scale(&b0.vector,1.0/norm_b0);         /* b0 = ||R * a0|| */
-        gsl_vector_scale(&b1.vector,1.0/norm_b1);         /* b1 = ||R * a1|| */
-        gsl_vector_cross(&b0.vector,&b1.vector,&b2.vector);  /* b2 = b0 x b1 */
-
-        norm_b2=gsl_blas_dnrm2(&b2.vector);
-        if(norm_b2>NORM_EPS) {
-          /** we reach this point only if all bk different from 0 */
-          /** compute U = B * A_trans (use RTR as B and evec as A) */
-          gsl_matrix_set_zero(U); /* to avoid nan */
-          gsl_blas_dgemm(CblasNoTrans,CblasTrans,1.0,RTR,evec,0.0,U);
-        }
-        else {
-          U_ok=0;
-          gsl_matrix_set_identity(U);
-        }
-      }
-      else {
-        U_ok=0;
-        gsl_matrix_set_identity(U);
-      }
-    }
-    else {
-      U_ok=0;
-      gsl_matrix_set_identity(U);
-    }
+    U_ok = kabsch_rotation(R, U, RTR, evec, eval, espace);
   }
 
   /** compute t = cy - U * cx */
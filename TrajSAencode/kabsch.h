@@ -36,6 +36,7 @@
 #include <math.h>
 #include <gsl/gsl_vector_double.h>
 #include <gsl/gsl_matrix_double.h>
+#include <gsl/gsl_eigen.h>
 
 #if defined(__cplusplus)
 extern "C" {
@@ -70,6 +71,31 @@ double wrmsd_kabsch
 	float (*Yarray)[3]
 );
 
+/*
+   Workspace of kabsch_rmsd_centred, allocate it once and reuse it for many superpositions.
+   A workspace must not be shared by threads running at the same time.
+*/
+typedef gsl_eigen_symmv_workspace kabsch_workspace;
+
+kabsch_workspace *kabsch_workspace_alloc(void);
+
+void kabsch_workspace_free(kabsch_workspace *workspace);
+
+/*
+   Same RMSD as wrmsd_kabsch for fragments already centred at the origin,
+   with G1 and G2 the sum of squared norms of Xcentred and Ycentred.
+   The arrays are not modified and nothing is allocated.
+*/
+double kabsch_rmsd_centred
+(
+	unsigned int size,
+	double (*Xcentred)[3],
+	double G1,
+	float (*Ycentred)[3],
+	double G2,
+	kabsch_workspace *workspace
+);
+
 int kabsch
 (
 	unsigned int size,
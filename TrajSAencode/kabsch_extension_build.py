@@ -2,9 +2,13 @@ from cffi import FFI
 
 ffibuilder = FFI()
 
-ffibuilder.cdef("double wrmsd_kabsch(unsigned int size,  float (*Xarray)[3], float (*Yarray)[3]);")
+ffibuilder.cdef("""
+double wrmsd_kabsch(unsigned int size,  float (*Xarray)[3], float (*Yarray)[3]);
+double qcp_rmsd(unsigned int size,  float (*Xarray)[3], float (*Yarray)[3]);
+""")
 
-ffibuilder.set_source("_kabsch", """ #include "kabsch.h" """, sources=["TrajSAencode/kabsch.c"],
+ffibuilder.set_source("_kabsch", """ #include "kabsch.h"
+ #include "qcprmsd.h" """, sources=["TrajSAencode/kabsch.c", "TrajSAencode/qcprmsd.c"],
                       include_dirs=["./TrajSAencode"], libraries=["m", "gsl"])
 
 if __name__ == "__main__":
@@ -0,0 +1,154 @@
+/*
+* Closed-form RMSD between two small fragments using the quaternion characteristic
+* polynomial (QCP) method of Theobald (2005), with the coefficients of Liu et al. (2010).
+* The largest eigenvalue of the 4x4 key matrix is found with Newton-Raphson on its
+* characteristic polynomial, so no rotation matrix or eigen solver is needed.
+*/
+
+#include <math.h>
+#include "qcprmsd.h"
+
+#define QCP_EVAL_PREC 1e-11
+#define QCP_MAX_ITER 50
+
+/*____________________________________________________________________________*/
+/* RMSD from the inner products G1, G2 and the correlation matrix S of two */
+/* centred fragments of 'size' points. */
+static double qcp_rmsd_inner(unsigned int size, double G1, double G2,
+	double Sxx, double Sxy, double Sxz,
+	double Syx, double Syy, double Syz,
+	double Szx, double Szy, double Szz)
+{
+	unsigned int i;
+	double E0 = (G1 + G2) * 0.5;
+	double mxEigenV, oldg, x2, a, b, delta;
+	double C[3];
+	double Sxx2 = Sxx * Sxx, Syy2 = Syy * Syy, Szz2 = Szz * Szz;
+	double Sxy2 = Sxy * Sxy, Syz2 = Syz * Syz, Sxz2 = Sxz * Sxz;
+	double Syx2 = Syx * Syx, Szy2 = Szy * Szy, Szx2 = Szx * Szx;
+
+	double SyzSzymSyySzz2 = 2.0 * (Syz * Szy - Syy * Szz);
+	double Sxx2Syy2Szz2Syz2Szy2 = Syy2 + Szz2 - Sxx2 + Syz2 + Szy2;
+
+	double SxzpSzx = Sxz + Szx;
+	double SyzpSzy = Syz + Szy;
+	double SxypSyx = Sxy + Syx;
+	double SyzmSzy = Syz - Szy;
+	double SxzmSzx = Sxz - Szx;
+	double SxymSyx = Sxy - Syx;
+	double SxxpSyy = Sxx + Syy;
+	double SxxmSyy = Sxx - Syy;
+	double Sxy2Sxz2Syx2Szx2 = Sxy2 + Sxz2 - Syx2 - Szx2;
+
+	/* coefficients of the characteristic polynomial x^4 + C2 x^2 + C1 x + C0 */
+	C[2] = -2.0 * (Sxx2 + Syy2 + Szz2 + Sxy2 + Syx2 + Sxz2 + Szx2 + Syz2 + Szy2);
+	C[1] = 8.0 * (Sxx * Syz * Szy + Syy * Szx * Sxz + Szz * Sxy * Syx
+			- Sxx * Syy * Szz - Syz * Szx * Sxy - Szy * Syx * Sxz);
+	C[0] = Sxy2Sxz2Syx2Szx2 * Sxy2Sxz2Syx2Szx2
+		+ (Sxx2Syy2Szz2Syz2Szy2 + SyzSzymSyySzz2) * (Sxx2Syy2Szz2Syz2Szy2 - SyzSzymSyySzz2)
+		+ (-(SxzpSzx) * (SyzmSzy) + (SxymSyx) * (SxxmSyy - Szz)) * (-(SxzmSzx) * (SyzpSzy) + (SxymSyx) * (SxxmSyy + Szz))
+		+ (-(SxzpSzx) * (SyzpSzy) - (SxypSyx) * (SxxpSyy - Szz)) * (-(SxzmSzx) * (SyzmSzy) - (SxypSyx) * (SxxpSyy + Szz))
+		+ (+(SxypSyx) * (SyzpSzy) + (SxzpSzx) * (SxxmSyy + Szz)) * (-(SxymSyx) * (SyzmSzy) + (SxzpSzx) * (SxxpSyy + Szz))
+		+ (+(SxypSyx) * (SyzmSzy) + (SxzmSzx) * (SxxmSyy - Szz)) * (-(SxymSyx) * (SyzpSzy) + (SxzmSzx) * (SxxpSyy - Szz));
+
+	/* both fragments collapse to a single point */
+	if (E0 <= 0.)
+		return 0.;
+
+	/* Newton-Raphson for the largest eigenvalue, starting from its upper bound E0 */
+	mxEigenV = E0;
+	for (i = 0; i < QCP_MAX_ITER; ++ i) {
+		oldg = mxEigenV;
+		x2 = mxEigenV * mxEigenV;
+		b = (x2 + C[2]) * mxEigenV;
+		a = b + C[1];
+		delta = (a * mxEigenV + C[0]) / (2.0 * x2 * mxEigenV + b + a);
+		mxEigenV -= delta;
+		if (fabs(mxEigenV - oldg) < fabs(QCP_EVAL_PREC * mxEigenV))
+			break;
+	}
+
+	return sqrt(fabs(2.0 * (E0 - mxEigenV) / size));
+}
+
+/*____________________________________________________________________________*/
+/* 'Xcentred' and 'Ycentred' are already centred at the origin and 'G1', 'G2' */
+/* are their inner products, so only the correlation matrix is computed here. */
+double qcp_rmsd_centred(unsigned int size, double (*Xcentred)[3], double G1, float (*Ycentred)[3], double G2)
+{
+	unsigned int i;
+	double x1, y1, z1, x2, y2, z2;
+	double Sxx = 0., Sxy = 0., Sxz = 0., Syx = 0., Syy = 0., Syz = 0., Szx = 0., Szy = 0., Szz = 0.;
+
+	for (i = 0; i < size; ++ i) {
+		x1 = Xcentred[i][0];
+		y1 = Xcentred[i][1];
+		z1 = Xcentred[i][2];
+		x2 = Ycentred[i][0];
+		y2 = Ycentred[i][1];
+		z2 = Ycentred[i][2];
+
+		Sxx += x1 * x2;
+		Sxy += x1 * y2;
+		Sxz += x1 * z2;
+		Syx += y1 * x2;
+		Syy += y1 * y2;
+		Syz += y1 * z2;
+		Szx += z1 * x2;
+		Szy += z1 * y2;
+		Szz += z1 * z2;
+	}
+
+	return qcp_rmsd_inner(size, G1, G2, Sxx, Sxy, Sxz, Syx, Syy, Syz, Szx, Szy, Szz);
+}
+
+/*____________________________________________________________________________*/
+/* 'Xarray' and 'Yarray' are coordinate arrays of 'size' (atoms,3) points. */
+double qcp_rmsd(unsigned int size, float (*Xarray)[3], float (*Yarray)[3])
+{
+	unsigned int i;
+	double cx[3] = {0., 0., 0.}; /* centroid of X */
+	double cy[3] = {0., 0., 0.}; /* centroid of Y */
+	double x1, y1, z1, x2, y2, z2;
+	double G1 = 0., G2 = 0.; /* inner products of X and Y */
+	double Sxx = 0., Sxy = 0., Sxz = 0., Syx = 0., Syy = 0., Syz = 0., Szx = 0., Szy = 0., Szz = 0.;
+
+	/* compute centroids */
+	for (i = 0; i < size; ++ i) {
+		cx[0] += Xarray[i][0];
+		cx[1] += Xarray[i][1];
+		cx[2] += Xarray[i][2];
+		cy[0] += Yarray[i][0];
+		cy[1] += Yarray[i][1];
+		cy[2] += Yarray[i][2];
+	}
+	for (i = 0; i < 3; ++ i) {
+		cx[i] /= size;
+		cy[i] /= size;
+	}
+
+	/* inner products and correlation matrix of the centred coordinates */
+	for (i = 0; i < size; ++ i) {
+		x1 = Xarray[i][0] - cx[0];
+		y1 = Xarray[i][1] - cx[1];
+		z1 = Xarray[i][2] - cx[2];
+		x2 = Yarray[i][0] - cy[0];
+		y2 = Yarray[i][1] - cy[1];
+		z2 = Yarray[i][2] - cy[2];
+
+		G1 += x1 * x1 + y1 * y1 + z1 * z1;
+		G2 += x2 * x2 + y2 * y2 + z2 * z2;
+
+		Sxx += x1 * x2;
+		Sxy += x1 * y2;
+		Sxz += x1 * z2;
+		Syx += y1 * x2;
+		Syy += y1 * y2;
+		Syz += y1 * z2;
+		Szx += z1 * x2;
+		Szy += z1 * y2;
+		Szz += z1 * z2;
+	}
+
+	return qcp_rmsd_inner(size, G1, G2, Sxx, Sxy, Sxz, Syx, Syy, Syz, Szx, Szy, Szz);
+}
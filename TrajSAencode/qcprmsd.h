@@ -0,0 +1,49 @@
+/*
+* Closed-form RMSD between two small fragments using the quaternion characteristic
+* polynomial (QCP) method. Only stack memory is used, so it is suited to the
+* thousands of tiny superpositions done for every encoded frame.
+*
+*   D. L. Theobald, Rapid calculation of RMSDs using a quaternion-based
+*   characteristic polynomial, Acta Cryst. (2005), A61, 478-480
+*
+*   P. Liu, D. K. Agrafiotis and D. L. Theobald, Fast determination of the
+*   optimal rotational matrix for macromolecular superpositions,
+*   J. Comput. Chem. (2010), 31, 1561-1563
+*/
+
+#ifndef QCPRMSD_H
+#define QCPRMSD_H
+
+#if defined(__cplusplus)
+extern "C" {
+#endif
+
+/*
+   Returns the RMSD of the optimal superposition of Xarray onto Yarray,
+   both of 'size' (atoms,3) points. The arrays are not modified.
+*/
+double qcp_rmsd
+(
+	unsigned int size,
+	float (*Xarray)[3],
+	float (*Yarray)[3]
+);
+
+/*
+   Same as qcp_rmsd for fragments already centred at the origin,
+   with G1 and G2 the sum of squared norms of Xcentred and Ycentred.
+*/
+double qcp_rmsd_centred
+(
+	unsigned int size,
+	double (*Xcentred)[3],
+	double G1,
+	float (*Ycentred)[3],
+	double G2
+);
+
+#if defined(__cplusplus)
+}
+#endif
+
+#endif
@@ -0,0 +1,209 @@
+# ===============================================================================
+# Trajencode
+# RunBenchmarks.py
+# Times the encoding, distance counting and clustering stages on synthetic data
+# ===============================================================================
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import time
+import tracemalloc
+import numpy as np
+from _kabsch.lib import wrmsd_kabsch, qcp_rmsd
+from cffi import FFI
+from TrajSAencode.SAEncoder import SAEncoder
+from TrajSAencode.SAlib import SADICT
+from TrajSAencode.TrajProcessor import TrajProcessor
+from TrajSAencode.TrajCluster import TrajCluster
+from benchmarks.SyntheticData import synthetic_trajectory, synthetic_strings, synthetic_fragment_pairs
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+STAGES = ["kabsch", "encode", "distances", "similarity"]
+
+
+def measure(function, repeat=3):
+    """
+    Times a function and measures the peak memory it allocates
+    :param function: function without arguments, run repeat + 1 times
+    :param repeat: number of timed runs, the fastest one is reported
+    :return: seconds of the fastest run and peak memory in bytes traced during an extra run
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    # Tracing slows down the allocations, so the memory is measured on a separate run
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def result(stage, variant, seconds, peak, **counts):
+    """
+    Builds the record of a benchmark, with the throughput of every count
+    :param counts: number of items processed by one run, e.g. frames=100
+    :return: dictionary
+    """
+    record = {"stage": stage, "variant": variant, "seconds": seconds, "peak_memory_bytes": peak}
+    for name, count in counts.items():
+        record[name] = count
+        record["%s_per_s" % name] = count / seconds if seconds > 0 else 0.0
+    return record
+
+
+def bench_kabsch(n_pairs, fragment_size, repeat=3, seed=0):
+    """
+    Times the RMSD functions on random fragment pairs, the way the substitution matrix is built
+    :return: list of records
+    """
+    ffi = FFI()
+    first, second = synthetic_fragment_pairs(n_pairs, fragment_size, seed=seed)
+    c_first = [ffi.cast("float(*)[3]", ffi.from_buffer(fragment)) for fragment in first]
+    c_second = [ffi.cast("float(*)[3]", ffi.from_buffer(fragment)) for fragment in second]
+    records = []
+    for variant, rmsd_function in [("gsl", wrmsd_kabsch), ("qcp", qcp_rmsd)]:
+        def run():
+            for fragment1, fragment2 in zip(c_first, c_second):
+                rmsd_function(fragment_size, fragment1, fragment2)
+        seconds, peak = measure(run, repeat)
+        records.append(result("kabsch", variant, seconds, peak, pairs=n_pairs))
+    return records
+
+
+def bench_encode(xyz, chunk_size, repeat=3):
+    """
+    Times SAEncoder.encode_frames over chunks of frames with both RMSD engines, with and without pruning
+    :return: list of records
+    """
+    n_frames, n_residues = xyz.shape[:2]
+    records = []
+    for rmsd_method in ["gsl", "qcp"]:
+        for prune in [False, True]:
+            encoder = SAEncoder(SADICT, rmsd_method=rmsd_method, prune=prune)
+            n_windows = n_residues - encoder.fragment_size + 1
+
+            def run():
+                for start in range(0, n_frames, chunk_size):
+                    encoder.encode_frames(xyz[start:start + chunk_size])
+            seconds, peak = measure(run, repeat)
+            variant = "%s%s" % (rmsd_method, "+prune" if prune else "")
+            records.append(result("encode", variant, seconds, peak, frames=n_frames,
+                                  windows=n_frames * n_windows))
+    return records
+
+
+def bench_distances(xyz, cutoff, chunk_size, repeat=3):
+    """
+    Times the contact counting frame by frame, by blocks of frames and with the grid method
+    :return: list of records
+    """
+    n_frames, n_residues = xyz.shape[:2]
+    name = ">bench.synthetic.chain1|1"
+    residue_pairs = n_frames * n_residues * (n_residues - 1) // 2
+    records = []
+
+    def run_frames(method):
+        processor = TrajProcessor(SADICT, cutoff, method=method)
+        for frame in xyz:
+            processor.compute_distances(frame, name)
+
+    def run_blocks():
+        processor = TrajProcessor(SADICT, cutoff)
+        for start in range(0, n_frames, chunk_size):
+            processor.compute_distances_block(xyz[start:start + chunk_size], name)
+
+    for variant, run in [("dense-frame", lambda: run_frames("dense")), ("dense-block", run_blocks),
+                         ("grid-frame", lambda: run_frames("grid"))]:
+        seconds, peak = measure(run, repeat)
+        records.append(result("distances", variant, seconds, peak, frames=n_frames, pairs=residue_pairs))
+    return records
+
+
+def bench_similarity(strings, block_size, repeat=3):
+    """
+    Times TrajCluster.compute_similarity on the full distance matrix between SA strings
+    :return: list of records
+    """
+    cluster = TrajCluster(SADICT, 4, 1, 1.0)
+    cluster.sa_traj = strings
+    n_strings = len(strings)
+
+    def run():
+        cluster.init_sim_mat()
+        # Hide the progress report of the distance matrix
+        with contextlib.redirect_stdout(io.StringIO()):
+            cluster.compute_similarity(block_size=block_size)
+    seconds, peak = measure(run, repeat)
+    return [result("similarity", "dense", seconds, peak, pairs=n_strings * (n_strings - 1) // 2)]
+
+
+def system_info():
+    """
+    Description of the machine and the versions used, stored with the results
+    """
+    return {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "processor": platform.processor(), "cpu_count": os.cpu_count(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks of TrajSAencode on synthetic data")
+    parser.add_argument('--stages', type=str, nargs='+', required=False, default=STAGES, choices=STAGES, help="Stages to time")
+    parser.add_argument('--frames', type=int, required=False, default=200, help="Frames of the synthetic trajectory")
+    parser.add_argument('--residues', type=int, required=False, default=300, help="Residues of the synthetic trajectory")
+    parser.add_argument('--chunk', type=int, required=False, default=50, help="Frames encoded or counted at once")
+    parser.add_argument('--cutoff', type=float, required=False, default=1.0, help="Contact cutoff in nm")
+    parser.add_argument('--pairs', type=int, required=False, default=20000, help="Fragment pairs of the RMSD benchmark")
+    parser.add_argument('--strings', type=int, required=False, default=2000, help="Number of SA strings to cluster")
+    parser.add_argument('--length', type=int, required=False, default=0, help="Length of the SA strings, 0 to match the residues")
+    parser.add_argument('--block', type=int, required=False, default=256, help="Block size of the distance matrix")
+    parser.add_argument('--repeat', type=int, required=False, default=3, help="Timed runs of every benchmark, the fastest is reported")
+    parser.add_argument('--seed', type=int, required=False, default=0, help="Seed of the synthetic data")
+    parser.add_argument('--output', type=str, required=False, default="benchmark_results.json", help="JSON file with the results")
+    return parser.parse_args()
+
+
+def main(args):
+    parameters = vars(args).copy()
+    records = []
+    if "kabsch" in args.stages:
+        records += bench_kabsch(args.pairs, 4, args.repeat, seed=args.seed)
+    if "encode" in args.stages or "distances" in args.stages:
+        xyz = synthetic_trajectory(args.frames, args.residues, seed=args.seed)
+        if "encode" in args.stages:
+            records += bench_encode(xyz, args.chunk, args.repeat)
+        if "distances" in args.stages:
+            records += bench_distances(xyz, args.cutoff, args.chunk, args.repeat)
+    if "similarity" in args.stages:
+        length = args.length if args.length > 0 else args.residues - 3
+        strings = synthetic_strings(args.strings, length, sorted(SADICT.keys()), seed=args.seed)
+        records += bench_similarity(strings, args.block, args.repeat)
+
+    for record in records:
+        rates = ", ".join("%.4g %s" % (value, key.replace("_per_s", "/s")) for key, value in record.items()
+                          if key.endswith("_per_s"))
+        print("%-10s %-12s %9.4f s  %s  peak %.1f MB" % (record["stage"], record["variant"], record["seconds"],
+                                                        rates, record["peak_memory_bytes"] / 2 ** 20))
+
+    # Kilobytes on Linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None
+    with open(args.output, "w") as out:
+        json.dump({"system": system_info(), "parameters": parameters, "max_rss_kb": max_rss, "results": records},
+                  out, indent=1)
+    print("Results saved to %s" % args.output)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
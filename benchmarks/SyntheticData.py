@@ -0,0 +1,74 @@
+# ===============================================================================
+# Trajencode
+# SyntheticData.py
+# Synthetic CA trajectories and SA strings, so the benchmarks need no input files
+# ===============================================================================
+
+import numpy as np
+
+# Distance between consecutive C alphas, in nm
+CA_DISTANCE = 0.38
+
+
+def synthetic_chain(n_residues, rng):
+    """
+    Random walk of C alphas with a fixed distance between consecutive residues
+    :param n_residues: number of residues
+    :param rng: np.random.Generator
+    :return: np.ndarray of shape (number of residues, 3), in nm
+    """
+    steps = rng.normal(size=(n_residues, 3))
+    steps *= CA_DISTANCE / np.linalg.norm(steps, axis=1, keepdims=True)
+    steps[0] = 0.0
+    return np.cumsum(steps, axis=0)
+
+
+def synthetic_trajectory(n_frames, n_residues, noise=0.05, drift=0.002, seed=0):
+    """
+    Trajectory of a single chain fluctuating around a random conformation that slowly drifts
+    :param n_frames: number of frames
+    :param n_residues: number of residues
+    :param noise: standard deviation of the thermal fluctuations, in nm
+    :param drift: standard deviation of the change of the reference conformation between frames, in nm
+    :param seed: seed of the random generator
+    :return: np.ndarray of float32, shape = (number of frames, number of residues, 3)
+    """
+    rng = np.random.default_rng(seed)
+    reference = synthetic_chain(n_residues, rng)
+    drifts = np.cumsum(rng.normal(scale=drift, size=(n_frames, n_residues, 3)), axis=0)
+    fluctuations = rng.normal(scale=noise, size=(n_frames, n_residues, 3))
+    return (reference + drifts + fluctuations).astype(np.float32)
+
+
+def synthetic_strings(n_strings, length, keys, n_states=5, mutation=0.1, seed=0):
+    """
+    SA strings drawn around a few conformational states, so they form clusters like real encodings
+    :param n_strings: number of strings
+    :param length: length of every string
+    :param keys: letters of the alphabet
+    :param n_states: number of states the strings are generated from
+    :param mutation: probability of replacing every letter by a random one
+    :param seed: seed of the random generator
+    :return: list of strings
+    """
+    rng = np.random.default_rng(seed)
+    letters = np.array(list(keys))
+    states = rng.integers(len(letters), size=(n_states, length))
+    codes = states[rng.integers(n_states, size=n_strings)]
+    mutated = rng.random(codes.shape) < mutation
+    codes[mutated] = rng.integers(len(letters), size=int(mutated.sum()))
+    return ["".join(row) for row in letters[codes]]
+
+
+def synthetic_fragment_pairs(n_pairs, fragment_size, seed=0):
+    """
+    Pairs of random fragments to time the RMSD functions
+    :param n_pairs: number of pairs
+    :param fragment_size: number of atoms of every fragment
+    :param seed: seed of the random generator
+    :return: two np.ndarray of float32, shape = (number of pairs, fragment size, 3)
+    """
+    rng = np.random.default_rng(seed)
+    first = np.array([synthetic_chain(fragment_size, rng) for _ in range(n_pairs)], dtype=np.float32)
+    second = np.array([synthetic_chain(fragment_size, rng) for _ in range(n_pairs)], dtype=np.float32)
+    return first, second
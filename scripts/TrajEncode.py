@@ -2,6 +2,11 @@ from TrajSAencode.TrajLoader import TrajLoader
 from TrajSAencode.SAEncoder import SAEncoder
 from TrajSAencode.SAlib import SADICT
 from TrajSAencode.TrajProcessor import TrajProcessor
+from TrajSAencode.TrajScheduler import TrajScheduler, process_file, format_cache_stats, format_search_stats, \
+    stream_clustering, check_output_names
+from TrajSAencode.WindowCache import WindowCache, CACHE_MODES
+from TrajSAencode.Profiler import StageProfiler
+from TrajSAencode.Checkpoint import INTERVAL
 import argparse
 
 
@@ -18,22 +23,75 @@ def parse_args():
     parser.add_argument('--split', type=bool, required=False, default=True, help="whether or not to split chains")
     parser.add_argument('--chunk', type=int, required=False, default=1, help="Number of frames to load at once into memory")
     parser.add_argument('--start', type=int, required=False, default=0, help="Starting number for the output numbering")
+    parser.add_argument('--prefetch', type=int, required=False, default=0, help="Number of chunks read ahead on a background thread while encoding, 0 to disable")
     parser.add_argument('--skip', type=int, required=False, default=0, help="Frames to skip")
     parser.add_argument('--stride', type=int, required=False, default=1, help="stride the trajectory")
     parser.add_argument('--mode', type=str, required=False, default="all", help="Way to process the trajectory: Options: encode, distance, all")
     parser.add_argument('--cutoff', type=float, required=False, default=10.0, help="cutoff to use to pick which atoms to account when computing distances")
+    parser.add_argument('--contact-method', type=str, required=False, default="dense", choices=["dense", "grid"], help="How to count contacts: dense distance matrix or grid neighbour list for large systems")
+    parser.add_argument('--binary', action="store_true", help="Save the distance counts as compact .npz files instead of text")
+    parser.add_argument('--format', type=str, required=False, default="sasta", choices=["sasta", "sab", "both"], help="Encoding output: sasta text files, sab binary files or both")
+    parser.add_argument('--buffer', type=int, required=False, default=2 ** 20, help="Size in bytes of the write buffer of the encoding output files")
+    parser.add_argument('--resume', action="store_true", help="Continue interrupted trajectories from their checkpoint and skip the ones already encoded")
+    parser.add_argument('--checkpoint-interval', type=float, required=False, default=None, help="Seconds between checkpoints of the outputs, 0 to only record finished trajectories. Without it checkpoints are only written with --resume, every %d s" % INTERVAL)
+    parser.add_argument('--cache-size', type=int, required=False, default=0, help="Number of encoded windows kept in an LRU cache, 0 to disable the cache")
+    parser.add_argument('--cache-mode', type=str, required=False, default="strict", choices=CACHE_MODES, help="Cache key: strict (rounded centred coordinates, cached fragments certified with RMSD lower bounds, same output as the full search), geometry (rounded centred coordinates) or distance (rounded internal CA distances)")
+    parser.add_argument('--cache-resolution', type=float, required=False, default=0.01, help="Rounding in nm of the cache keys")
+    parser.add_argument('--prune', action="store_true", help="Skip library fragments ruled out by RMSD lower bounds, same output as the exhaustive search")
+    parser.add_argument('--cluster', type=float, required=False, default=None, help="Cluster the frames of every chain while encoding, joining a cluster when the average sub_matrix distance to its members is below this threshold")
+    parser.add_argument('--cluster-max', type=int, required=False, default=256, help="Largest number of clusters of every chain, bounds the memory of the clustering")
+    parser.add_argument('--cluster-merge-interval', type=int, required=False, default=0, help="Frames between merges of close clusters, 0 to never merge")
+    parser.add_argument('--cluster-merge-threshold', type=float, required=False, default=None, help="Largest average linkage distance of merged clusters, the cluster threshold by default")
+    parser.add_argument('--profile', type=str, required=False, default=None, help="Time every stage of the pipeline and save a JSON summary to this file")
+    parser.add_argument('--stats-interval', type=float, required=False, default=0.0, help="Seconds between JSON stats lines written to stderr, 0 to disable them")
+    parser.add_argument('--workers', type=int, required=False, default=1, help="Number of threads encoding chunks in parallel")
+    parser.add_argument('--file-workers', type=int, required=False, default=1, help="Number of processes handling input files in parallel, largest files first")
+    parser.add_argument('--rmsd', type=str, required=False, default="gsl", choices=["gsl", "qcp"], help="RMSD engine used for the encoding: gsl (Kabsch) or qcp (closed-form quaternion)")
     arg = parser.parse_args()
     return arg
 
 
+def save_profile(profiler, args):
+    """
+    Writes the final summary of the instrumentation, to a JSON file and/or as a last stats line
+    """
+    if profiler is None:
+        return
+    if args.profile is not None:
+        profiler.save(args.profile)
+    if args.stats_interval > 0:
+        profiler.report()
+
+
 def main(args):
     pdbs = args.pdb
     cutoff = args.cutoff / 10
     trajectories = args.traj
+    if args.mode not in ["all", "encode", "distance"]:
+        print("Mode not found")
+        exit(1)
+    # The checkpoint manifests are only written when asked for, or when resuming so the run can be resumed again
+    checkpoint_interval = args.checkpoint_interval
+    if checkpoint_interval is None and args.resume:
+        checkpoint_interval = INTERVAL
+    # Instrumentation is only created when asked for, otherwise every stage uses a profiler doing nothing
+    profiler = None
+    if args.profile is not None or args.stats_interval > 0:
+        profiler = StageProfiler(args.stats_interval)
     if args.mode in ["all", "encode"]:
-        sa_encoder = SAEncoder(SADICT)
+        cache = None
+        if args.cache_size > 0:
+            cache = WindowCache(args.cache_size, mode=args.cache_mode, resolution=args.cache_resolution)
+        sa_encoder = SAEncoder(SADICT, rmsd_method=args.rmsd, output_format=args.format,
+                               buffer_size=args.buffer, cache=cache, prune=args.prune, profiler=profiler)
+    cluster = None
+    clustering = None
+    if args.cluster is not None and args.mode in ["all", "encode"]:
+        cluster = {"threshold": args.cluster, "max_clusters": args.cluster_max,
+                   "merge_interval": args.cluster_merge_interval, "merge_threshold": args.cluster_merge_threshold}
+        clustering = stream_clustering(sa_encoder, **cluster)
     if args.mode in ["all", "distance"]:
-        traj_pros = TrajProcessor(SADICT, cutoff)
+        traj_pros = TrajProcessor(SADICT, cutoff, method=args.contact_method)
     # Some checks
     if len(pdbs) == 0:
         raise InputError("PDB file not found")
@@ -50,10 +108,36 @@ def main(args):
     if not pdb.split(".")[-1] in ["pdb", "gro"]:
         raise InputError("PDB files must end with .pdb or .gro")
 
+    # Every trajectory writes its outputs when it is complete, they must not share their names
+    try:
+        check_output_names(trajectories, pdb if len(pdbs) == 1 else None)
+    except ValueError as error:
+        raise InputError(str(error))
+
     if len(pdbs) == 1:
         print("Topology extracted from: %s" % pdbs[0])
     print("Processing files: %s" % ", ".join(trajectories))
 
+    if args.file_workers > 1:
+        # Hand every input file to a pool of processes, each file writes its own outputs
+        topology = pdb if len(pdbs) == 1 and trajectories != pdbs else None
+        scheduler = TrajScheduler(trajectories, topology=topology, n_workers=args.file_workers, mode=args.mode,
+                                  cutoff=cutoff, rmsd_method=args.rmsd, n_threads=args.workers,
+                                  contact_method=args.contact_method, binary=args.binary,
+                                  output_format=args.format, buffer_size=args.buffer, resume=args.resume,
+                                  checkpoint_interval=checkpoint_interval, cache_size=args.cache_size,
+                                  cache_mode=args.cache_mode, cache_resolution=args.cache_resolution, prune=args.prune,
+                                  profile=args.profile is not None, stats_interval=args.stats_interval, cluster=cluster,
+                                  split_chains=args.split, chunk_size=args.chunk, start_f=args.start,
+                                  skip=args.skip, stride=args.stride, prefetch=args.prefetch)
+        scheduler.run()
+        save_profile(scheduler.profiler, args)
+        print("\nEncoding Finished")
+        return
+
+    # The topology is parsed only once when all the trajectories share it
+    shared_topology = TrajLoader.load_topology(pdb) if len(pdbs) == 1 else None
+
     # Iterate over the trajectories to encode
     for traj in trajectories:
         print("Processing file: %s\n" % traj)
@@ -62,26 +146,21 @@ def main(args):
             pdb = traj
         # Process trajectory frame by frame
         traj_loader = TrajLoader(pdb, traj, split_chains=args.split, chunk_size=args.chunk, start_f=args.start,
-                                 skip=args.skip, stride=args.stride)
-
-        nframes = 0
-        for frame, name in traj_loader.frames():
-            if args.mode in ["all", "encode"]:
-                sa_encoder.encode_protein(frame, name)
-            if args.mode in ["all", "distance"]:
-                traj_pros.compute_distances(frame, name)
-            else:
-                print("Mode not found")
-                exit(1)
-            nframes += args.chunk
-            print("Processed Frames: %s" % nframes, end="\r")
-
-    if args.mode in ["all", "encode"]:
-        sa_encoder.close_output()
-    if args.mode in ["all", "distance"]:
-        traj_pros.convert_to_fragments()
-        traj_pros.save_output()
+                                 skip=args.skip, stride=args.stride, shared_topology=shared_topology,
+                                 profiler=profiler, prefetch=args.prefetch)
+        # The outputs of every trajectory are written as soon as it is complete
+        nframes = process_file(traj_loader, sa_encoder if args.mode in ["all", "encode"] else None,
+                               traj_pros if args.mode in ["all", "distance"] else None, n_workers=args.workers,
+                               binary=args.binary, resume=args.resume, checkpoint_interval=checkpoint_interval,
+                               profiler=profiler, clustering=clustering)
+        if nframes is None:
+            print("Skipped %s: already encoded" % traj)
 
+    if args.mode in ["all", "encode"] and sa_encoder.cache is not None:
+        print("\nWindow cache: %s" % format_cache_stats(sa_encoder.cache.stats()))
+    if args.mode in ["all", "encode"] and args.prune:
+        print("\nPruned search: %s" % format_search_stats(sa_encoder.search_stats()))
+    save_profile(profiler, args)
     print("\nEncoding Finished")
 
 
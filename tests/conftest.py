@@ -0,0 +1,48 @@
+# ===============================================================================
+# Trajencode
+# conftest.py
+# Small trajectory written to disk once per test session
+# ===============================================================================
+
+import mdtraj as md
+import numpy as np
+import pytest
+from benchmarks.SyntheticData import synthetic_trajectory
+
+# Two chains of C alphas, long enough for many windows and short enough to keep the tests fast
+N_CHAINS = 2
+N_RESIDUES = 24
+N_FRAMES = 30
+
+
+def ca_topology(n_chains, n_residues):
+    """
+    Topology made only of C alphas
+    :param n_chains: number of chains
+    :param n_residues: number of residues of every chain
+    :return: md.Topology
+    """
+    topology = md.Topology()
+    for _ in range(n_chains):
+        chain = topology.add_chain()
+        for number in range(n_residues):
+            residue = topology.add_residue("ALA", chain, resSeq=number + 1)
+            topology.add_atom("CA", md.element.carbon, residue)
+    return topology
+
+
+@pytest.fixture(scope="session")
+def trajectory_files(tmp_path_factory):
+    """
+    Writes a topology and a trajectory of two chains
+    :return: (pdb file, xtc file), absolute paths
+    """
+    folder = tmp_path_factory.mktemp("data")
+    chains = [synthetic_trajectory(N_FRAMES, N_RESIDUES, noise=0.03, seed=seed) for seed in range(N_CHAINS)]
+    # Keep the second chain away from the first one
+    chains[1] += np.float32(3.0)
+    traj = md.Trajectory(np.concatenate(chains, axis=1), ca_topology(N_CHAINS, N_RESIDUES))
+    pdb, xtc = str(folder / "top.pdb"), str(folder / "traj.xtc")
+    traj[0].save_pdb(pdb)
+    traj.save_xtc(xtc)
+    return pdb, xtc
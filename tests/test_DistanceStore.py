@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from scipy.spatial.distance import squareform
+from benchmarks.SyntheticData import synthetic_strings
+from TrajSAencode import DistanceStore
+from TrajSAencode.DistanceStore import CondensedDistances
+from TrajSAencode.SAMetric import distance_matrix, encode_strings, sub_matrix_array, substitution_matrix, \
+    RMSD_FUNCTIONS
+from TrajSAencode.SAlib import SADICT
+
+KEYS = sorted(SADICT.keys())
+SUB_ARRAY = sub_matrix_array(substitution_matrix(SADICT, 4, RMSD_FUNCTIONS["qcp"]), KEYS)
+BLOCK_DISTANCES = DistanceStore.block_distances
+
+
+class Crash(Exception):
+    pass
+
+
+def frames(n_frames=70, seed=0):
+    return encode_strings(synthetic_strings(n_frames, 25, KEYS, seed=seed), KEYS)
+
+
+def count_blocks(monkeypatch, crash_after=None):
+    """
+    Counts the blocks of rows computed by the store, failing after crash_after of them
+    """
+    computed = []
+
+    def counted(*args):
+        if crash_after is not None and len(computed) == crash_after:
+            raise Crash()
+        computed.append(args[0].shape[0])
+        return BLOCK_DISTANCES(*args)
+    monkeypatch.setattr(DistanceStore, "block_distances", counted)
+    return computed
+
+
+def test_condensed_matches_dense_matrix():
+    codes = frames()
+    store = CondensedDistances(len(codes), block_size=16)
+    store.fill(codes, SUB_ARRAY, n_workers=2)
+    dense = distance_matrix(codes, SUB_ARRAY)
+    np.testing.assert_array_equal(store.data, squareform(dense, checks=False).astype(np.float32))
+    assert store.is_complete() and store.distance(9, 4) == np.float32(dense[4, 9])
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_resume_computes_only_missing_blocks(tmp_path, monkeypatch, n_workers):
+    codes = frames()
+    path = str(tmp_path / "distances.mm")
+    clean = CondensedDistances(len(codes), block_size=16)
+    clean.fill(codes, SUB_ARRAY)
+
+    count_blocks(monkeypatch, crash_after=2)
+    with pytest.raises(Crash):
+        CondensedDistances(len(codes), path=path, block_size=16).fill(codes, SUB_ARRAY)
+    store = CondensedDistances(len(codes), path=path, block_size=16)
+    assert store.done == {0, 16}
+    computed = count_blocks(monkeypatch)
+    store.fill(codes, SUB_ARRAY, n_workers=n_workers)
+    assert len(computed) == 3 and store.is_complete()
+    np.testing.assert_array_equal(store.data, clean.data)
+    # A complete matrix is reused as it is, other frames start again
+    CondensedDistances(len(codes), path=path, block_size=16).fill(codes, SUB_ARRAY)
+    assert len(computed) == 3
+    CondensedDistances(len(codes), path=path, block_size=16).fill(frames(seed=1), SUB_ARRAY)
+    assert len(computed) == 8
@@ -0,0 +1,61 @@
+import threading
+import pytest
+from TrajSAencode.Prefetcher import Prefetcher
+from TrajSAencode.TrajLoader import TrajLoader
+
+
+class ReadError(Exception):
+    pass
+
+
+def counted(n_items, read, fail_at=None):
+    """
+    Items 0 to n_items - 1, recording the ones read and failing at fail_at
+    """
+    for item in range(n_items):
+        if item == fail_at:
+            raise ReadError()
+        read.append(item)
+        yield item
+
+
+@pytest.mark.parametrize("depth", [1, 3, 50])
+def test_items_keep_their_order(depth):
+    read = []
+    assert list(Prefetcher(counted(20, read), depth)) == list(range(20))
+    assert list(Prefetcher([], depth)) == []
+
+
+def test_reader_errors_reach_the_consumer():
+    read = []
+    received = []
+    with pytest.raises(ReadError):
+        for item in Prefetcher(counted(20, read, fail_at=5), 2):
+            received.append(item)
+    # Items read before the error are all delivered first
+    assert received == list(range(5))
+
+
+def test_early_stop_releases_the_reader():
+    read = []
+    threads = threading.active_count()
+    for item in Prefetcher(counted(1000, read), 2):
+        if item == 3:
+            break
+    # The reader is joined as soon as the consumer stops, after reading at most the queue and one more item
+    assert threading.active_count() == threads
+    assert len(read) <= 4 + 2 + 1
+
+
+def test_depth_must_be_positive():
+    with pytest.raises(ValueError):
+        Prefetcher([], 0)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7])
+def test_prefetched_chunks_match_direct_reading(trajectory_files, chunk_size):
+    direct = list(TrajLoader(*trajectory_files, split_chains=True, chunk_size=chunk_size).chunks())
+    prefetched = list(TrajLoader(*trajectory_files, split_chains=True, chunk_size=chunk_size, prefetch=2).chunks())
+    assert [names for _, names in prefetched] == [names for _, names in direct]
+    for (block, _), (expected, _) in zip(prefetched, direct):
+        assert (block == expected).all()
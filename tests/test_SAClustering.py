@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from TrajSAencode.SAClustering import leader_clustering, clara
+from TrajSAencode.SAMetric import block_distances, decode_strings, sub_matrix_array, substitution_matrix, \
+    RMSD_FUNCTIONS
+from TrajSAencode.SAlib import SADICT
+from TrajSAencode.TrajCluster import TrajCluster
+
+KEYS = sorted(SADICT.keys())
+SUB_ARRAY = sub_matrix_array(substitution_matrix(SADICT, 4, RMSD_FUNCTIONS["qcp"]), KEYS)
+N_STATES = 4
+
+
+def known_clusters(n_frames=300, length=40, mutation=0.1, seed=0):
+    """
+    Frames mutated from a few random states, with the state of every frame
+    """
+    rng = np.random.default_rng(seed)
+    states = rng.integers(len(KEYS), size=(N_STATES, length))
+    truth = rng.integers(N_STATES, size=n_frames)
+    codes = states[truth]
+    mutated = rng.random(codes.shape) < mutation
+    codes[mutated] = rng.integers(len(KEYS), size=int(mutated.sum()))
+    return codes.astype(np.uint8), truth
+
+
+def threshold_between(codes, truth):
+    """
+    Distance above every distance inside a state and below every distance between states
+    """
+    dis = block_distances(codes, codes, SUB_ARRAY)
+    same = truth[:, np.newaxis] == truth[np.newaxis, :]
+    assert dis[same].max() < dis[~same].min()
+    return (dis[same].max() + dis[~same].min()) / 2
+
+
+def assert_same_partition(labels, truth):
+    pairs = set(zip(labels.tolist(), truth.tolist()))
+    assert len(pairs) == len(set(labels.tolist())) == len(set(truth.tolist()))
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 1024])
+def test_leader_recovers_known_clusters(block_size):
+    codes, truth = known_clusters()
+    labels, leaders = leader_clustering(codes, SUB_ARRAY, threshold_between(codes, truth), block_size=block_size)
+    assert_same_partition(labels, truth)
+    # Leaders are the first frame of every cluster and labels follow their order
+    assert leaders == sorted(int(np.flatnonzero(truth == state)[0]) for state in range(N_STATES))
+    np.testing.assert_array_equal(labels[leaders], np.arange(N_STATES))
+
+
+def test_clara_recovers_known_clusters():
+    codes, truth = known_clusters()
+    labels, medoids = clara(codes, SUB_ARRAY, N_STATES, seed=1)
+    assert_same_partition(labels, truth)
+    np.testing.assert_array_equal(labels[medoids], np.arange(N_STATES))
+
+
+@pytest.mark.parametrize("max_dist,nclusters", [(True, None), (None, N_STATES)])
+def test_cluster_frames_avoids_the_matrix_above_the_limit(max_dist, nclusters):
+    codes, truth = known_clusters()
+    cluster = TrajCluster(SADICT, 4, nclusters, threshold_between(codes, truth) if max_dist else None)
+    cluster.sa_traj = decode_strings(codes, KEYS)
+    cluster.cluster_frames(max_frames=len(codes) - 1)
+    assert cluster.condensed is None
+    assert_same_partition(cluster.clustering.labels_, truth)
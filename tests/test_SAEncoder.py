@@ -0,0 +1,153 @@
+import numpy as np
+import pytest
+from cffi import FFI
+from _encodeframe.lib import encode_frame, RMSD_GSL
+from _kabsch.lib import wrmsd_kabsch
+from benchmarks.SyntheticData import synthetic_trajectory
+from TrajSAencode.RMSDCheck import check_rmsd_methods, RMSD_TOLERANCE
+from TrajSAencode.SAEncoder import SAEncoder
+from TrajSAencode.SAlib import SADICT
+from TrajSAencode.WindowCache import WindowCache
+
+
+def frame_by_frame(encoder, xyz):
+    """
+    Encodes every frame with its own call to encode_frame, as the encoder did before the batched kernel
+    """
+    ffi = encoder.ffi
+    codes = np.zeros((xyz.shape[0], xyz.shape[1] - encoder.fragment_size + 1), dtype=np.int32)
+    for frame in range(xyz.shape[0]):
+        coordinates = np.ascontiguousarray(xyz[frame], dtype=np.float32)
+        encode_frame(codes.shape[1], encoder.library.c_library, ffi.cast("float(*)[3]", coordinates.ctypes.data),
+                     ffi.cast("int *", codes[frame].ctypes.data), RMSD_GSL, ffi.NULL)
+    return codes
+
+
+def test_encode_frames_matches_frame_by_frame():
+    xyz = synthetic_trajectory(12, 40)
+    encoder = SAEncoder(SADICT)
+    expected = frame_by_frame(encoder, xyz)
+    np.testing.assert_array_equal(encoder.encode_frames(xyz), expected)
+    # Blocks of any size, and single frames given as 2D arrays, give the same codes
+    for size in [1, 5, 12]:
+        blocks = [encoder.encode_frames(xyz[start:start + size]) for start in range(0, len(xyz), size)]
+        np.testing.assert_array_equal(np.concatenate(blocks), expected)
+    np.testing.assert_array_equal(encoder.encode_frames(xyz[3]), expected[3:4])
+
+
+def kabsch_scan(encoder, xyz):
+    """
+    Encodes every window with wrmsd_kabsch against each library fragment, which centres both of them per call
+    """
+    ffi = FFI()
+    size = encoder.fragment_size
+    fragments = encoder.library.centred.reshape(encoder.library.n_fragments, size, 3)
+    codes = np.zeros((xyz.shape[0], xyz.shape[1] - size + 1), dtype=np.int32)
+    for frame in range(codes.shape[0]):
+        for i in range(codes.shape[1]):
+            window = np.ascontiguousarray(xyz[frame, i:i + size], dtype=np.float32)
+            c_window = ffi.cast("float(*)[3]", ffi.from_buffer(window))
+            rmsds = [wrmsd_kabsch(size, c_window, ffi.cast("float(*)[3]", ffi.from_buffer(fragment)))
+                     for fragment in fragments]
+            codes[frame, i] = np.argmin(rmsds)
+    return codes
+
+
+@pytest.mark.parametrize("prune", [False, True])
+def test_gsl_engine_matches_kabsch_scan(prune):
+    xyz = synthetic_trajectory(5, 30)
+    encoder = SAEncoder(SADICT, rmsd_method="gsl", prune=prune)
+    np.testing.assert_array_equal(encoder.encode_frames(xyz), kabsch_scan(encoder, xyz))
+
+
+def perturbed_library(copies, noise=0.3, seed=0):
+    """
+    Library with several perturbed copies of every SADICT fragment, in Angstroms like SADICT
+    """
+    rng = np.random.default_rng(seed)
+    return {"%s%d" % (key, i): (np.array(value) + rng.normal(scale=noise, size=len(value))).tolist()
+            for i in range(copies) for key, value in SADICT.items()}
+
+
+@pytest.mark.parametrize("rmsd_method", ["gsl", "qcp"])
+@pytest.mark.parametrize("sa_dict", [SADICT, perturbed_library(8)], ids=["SADICT", "perturbed"])
+def test_pruned_search_matches_exhaustive(sa_dict, rmsd_method):
+    xyz = synthetic_trajectory(20, 60)
+    exhaustive = SAEncoder(sa_dict, rmsd_method=rmsd_method).encode_frames(xyz)
+    pruned_encoder = SAEncoder(sa_dict, rmsd_method=rmsd_method, prune=True)
+    np.testing.assert_array_equal(pruned_encoder.encode_frames(xyz), exhaustive)
+    assert pruned_encoder.search_stats()["skipped"] > 0
+
+
+def test_rmsd_methods_agree():
+    assert check_rmsd_methods(SADICT) <= RMSD_TOLERANCE
+
+
+def test_rmsd_methods_encode_alike():
+    xyz = synthetic_trajectory(20, 60)
+    np.testing.assert_array_equal(SAEncoder(SADICT, rmsd_method="qcp").encode_frames(xyz),
+                                  SAEncoder(SADICT, rmsd_method="gsl").encode_frames(xyz))
+
+
+def map_encoding(encoder, encoding, names):
+    """
+    Text written by the original encoder, one string concatenation per window and four writes per frame
+    """
+    text = {}
+    for codes, name in zip(encoding, names):
+        encoded_string = ""
+        for code in codes:
+            encoded_string += encoder.sa_code_map[code]
+        key = "%s.sasta" % name.split(">")[1].split("|")[0]
+        text[key] = text.get(key, "") + name + "\n" + encoded_string + "\n"
+    return text
+
+
+@pytest.mark.parametrize("buffer_size", [16, 2 ** 20])
+def test_lut_output_matches_map_encoding(tmp_path, monkeypatch, buffer_size):
+    monkeypatch.chdir(tmp_path)
+    encoder = SAEncoder(SADICT, buffer_size=buffer_size)
+    encoding = np.random.default_rng(0).integers(encoder.library.n_fragments, size=(9, 20)).astype(np.int32)
+    names = [">top.traj.chain%s|%s" % (chain, frame) for chain, frame in
+             [(1, 1), (1, 2), (1, 3), (2, 1), (2, 2), (1, 4), (1, 5), (2, 3), (2, 4)]]
+    expected = map_encoding(encoder, encoding, names)
+    encoder.write_encoding(encoding[:4], names[:4])
+    encoder.write_encoding(encoding[4:], names[4:])
+    encoder.close_output()
+    assert sorted(expected) == ["top.traj.chain1.sasta", "top.traj.chain2.sasta"]
+    for key, text in expected.items():
+        with open(key, "r") as inn:
+            assert inn.read() == text
+
+
+@pytest.mark.parametrize("prune", [False, True])
+@pytest.mark.parametrize("resolution", [0.01, 0.1, 1.0])
+def test_strict_cache_matches_search(resolution, prune):
+    # Repeated frames with small fluctuations, so windows share their keys
+    rng = np.random.default_rng(0)
+    frames = synthetic_trajectory(10, 40)
+    xyz = np.concatenate([frames + rng.normal(scale=0.005, size=frames.shape) for _ in range(3)]).astype(np.float32)
+    expected = SAEncoder(SADICT).encode_frames(xyz)
+    encoder = SAEncoder(SADICT, prune=prune, cache=WindowCache(1000, mode="strict", resolution=resolution))
+    encoding = np.concatenate([encoder.encode_frames(xyz[start:start + 7]) for start in range(0, len(xyz), 7)])
+    np.testing.assert_array_equal(encoding, expected)
+    # Cached fragments were looked up, used when certified and searched again otherwise
+    assert encoder.cache.stats()["hits"] + encoder.cache.stats()["rejected"] > 0
+
+
+def test_certification_rejects_other_fragments():
+    encoder = SAEncoder(SADICT)
+    xyz = synthetic_trajectory(5, 40)
+    windows = np.moveaxis(np.lib.stride_tricks.sliding_window_view(xyz, encoder.fragment_size, axis=1), -1, 2)
+    windows = windows.reshape(-1, encoder.fragment_size, 3)
+    codes, second = encoder.encode_windows(windows, return_second=True)
+    others = (codes + 1) % encoder.library.n_fragments
+    assert not encoder.certify_windows(windows, others).any()
+    assert not encoder.certify_windows(windows, others, second).any()
+    assert encoder.certify_windows(windows, codes, second).all()
+
+
+def test_chain_shorter_than_fragment():
+    encoder = SAEncoder(SADICT)
+    xyz = synthetic_trajectory(3, encoder.fragment_size - 1)
+    assert encoder.encode_frames(xyz).shape == (3, 0)
@@ -0,0 +1,70 @@
+import numpy as np
+from TrajSAencode.SAEncoder import SAEncoder
+from TrajSAencode.SAFormat import SABinaryWriter, SABinaryReader, HEADER_SIZE
+from TrajSAencode.SAlib import SADICT
+from TrajSAencode.TrajLoader import TrajLoader
+from TrajSAencode.TrajScheduler import process_file
+
+ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXY"
+
+
+def random_codes(n_frames, n_windows, seed=0):
+    return np.random.default_rng(seed).integers(len(ALPHABET), size=(n_frames, n_windows), dtype=np.uint8)
+
+
+def test_write_read_round_trip(tmp_path):
+    codes = random_codes(12, 9)
+    path = str(tmp_path / "chain.sab")
+    writer = SABinaryWriter(path, ALPHABET)
+    writer.write(codes[:5], range(1, 6))
+    writer.write(codes[5:], range(6, 13))
+    writer.close()
+    reader = SABinaryReader(path)
+    assert len(reader) == 12 and reader.alphabet == ALPHABET
+    np.testing.assert_array_equal(reader.codes, codes)
+    np.testing.assert_array_equal(reader.frame_index, np.arange(1, 13))
+    np.testing.assert_array_equal(reader.frame_range(3, 4), codes[2:4])
+    assert reader.strings(0, 1) == ["".join(ALPHABET[code] for code in codes[0])]
+
+
+def test_empty_file(tmp_path):
+    path = str(tmp_path / "empty.sab")
+    SABinaryWriter(path, ALPHABET).close()
+    reader = SABinaryReader(path)
+    assert len(reader) == 0 and reader.strings() == []
+
+
+def test_resume_matches_clean_write(tmp_path):
+    codes = random_codes(10, 7)
+    clean = str(tmp_path / "clean.sab")
+    writer = SABinaryWriter(clean, ALPHABET)
+    writer.write(codes, range(10))
+    writer.close()
+    # Interrupted run: the frames written after the last flush are lost and the file is never closed
+    resumed = str(tmp_path / "resumed.sab")
+    writer = SABinaryWriter(resumed, ALPHABET)
+    writer.write(codes[:4], range(4))
+    offset = writer.flush()
+    frame_numbers = list(writer.frame_numbers)
+    writer.write(codes[4:6], range(4, 6))
+    writer.handler.close()
+    assert offset == HEADER_SIZE + 4 * 7
+    writer = SABinaryWriter(resumed, ALPHABET, resume=(offset, frame_numbers))
+    writer.write(codes[4:], range(4, 10))
+    writer.close()
+    with open(clean, "rb") as first, open(resumed, "rb") as second:
+        assert first.read() == second.read()
+
+
+def test_binary_matches_sasta(trajectory_files, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    loader = TrajLoader(*trajectory_files, split_chains=True, chunk_size=7)
+    process_file(loader, SAEncoder(SADICT, output_format="both"), verbose=False)
+    for chain in [1, 2]:
+        with open("top.traj.chain%s.sasta" % chain, "r") as inn:
+            lines = inn.read().splitlines()
+        reader = SABinaryReader("top.traj.chain%s.sab" % chain)
+        assert reader.strings() == lines[1::2]
+        assert [">top.traj.chain%s|%s" % (chain, frame) for frame in reader.frame_index] == lines[0::2]
+        # Random access to a range of frames
+        assert reader.strings(5, 9) == lines[11:19:2]
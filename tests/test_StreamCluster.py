@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from benchmarks.SyntheticData import synthetic_strings
+from TrajSAencode.SAMetric import block_distances, encode_strings, sub_matrix_array, substitution_matrix, \
+    RMSD_FUNCTIONS
+from TrajSAencode.SAlib import SADICT
+from TrajSAencode.StreamCluster import OnlineClusters
+
+KEYS = sorted(SADICT.keys())
+SUB_ARRAY = sub_matrix_array(substitution_matrix(SADICT, 4, RMSD_FUNCTIONS["qcp"]), KEYS)
+
+
+def frames(n_frames=150, seed=0):
+    return encode_strings(synthetic_strings(n_frames, 30, KEYS, n_states=6, mutation=0.3, seed=seed), KEYS)
+
+
+def add_in_blocks(clusters, codes, block):
+    return np.concatenate([clusters.add(codes[start:start + block]) for start in range(0, len(codes), block)])
+
+
+@pytest.mark.parametrize("threshold,max_clusters", [(22.0, 100), (20.0, 4)])
+def test_online_clusters_match_member_average(threshold, max_clusters):
+    codes = frames()
+    labels = add_in_blocks(OnlineClusters(SUB_ARRAY, threshold, max_clusters=max_clusters), codes, 13)
+    # Every frame joins the cluster with the lowest average distance to its members, or a new one
+    members = []
+    expected = []
+    for i, frame in enumerate(codes):
+        averages = [block_distances(frame[np.newaxis], codes[clust], SUB_ARRAY).mean() for clust in members]
+        best = int(np.argmin(averages)) if averages else -1
+        if (best < 0 or averages[best] > threshold) and len(members) < max_clusters:
+            members.append([])
+            best = len(members) - 1
+        members[best].append(i)
+        expected.append(best)
+    np.testing.assert_array_equal(labels, expected)
+
+
+@pytest.mark.parametrize("merge_interval", [0, 1, 7, 50])
+def test_labels_do_not_depend_on_block_size(merge_interval):
+    codes = frames(200, seed=1)
+    results = []
+    for block in [1, 7, 64, 500]:
+        clusters = OnlineClusters(SUB_ARRAY, 20.0, max_clusters=16, merge_interval=merge_interval,
+                                  merge_threshold=26.0)
+        raw = add_in_blocks(clusters, codes, block)
+        results.append((clusters.labels()[raw], clusters.summary(KEYS)))
+    for labels, summary in results[1:]:
+        np.testing.assert_array_equal(labels, results[0][0])
+        assert summary == results[0][1]
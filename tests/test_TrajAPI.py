@@ -0,0 +1,42 @@
+import os
+import runpy
+import sys
+import mdtraj as md
+import numpy as np
+from TrajSAencode.TrajAPI import TrajEncoder
+from TrajSAencode.TrajProcessor import TrajProcessor
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "TrajEncode.py")
+
+
+def read_sasta(path):
+    with open(path, "r") as inn:
+        lines = inn.read().splitlines()
+    return lines[0::2], lines[1::2]
+
+
+def test_encoder_matches_cli_files(trajectory_files, tmp_path, monkeypatch):
+    pdb, xtc = trajectory_files
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, "argv", ["TrajEncode.py", "--pdb", pdb, "--traj", xtc, "--cutoff", "10", "--chunk", "5"])
+    runpy.run_path(SCRIPT, run_name="__main__")
+    written = sorted(os.listdir(tmp_path))
+
+    encoder = TrajEncoder(cutoff=1.0)
+    chains = encoder.encode_trajectory(md.load(xtc, top=pdb))
+    # Nothing else is written by the in memory encoder
+    assert sorted(os.listdir(tmp_path)) == written
+    assert len(chains) == 2
+    for number, chain in enumerate(chains, start=1):
+        names, strings = read_sasta("top.traj.chain%s.sasta" % number)
+        assert chain.strings() == strings
+        assert chain.frames == len(names)
+        counts, frames = TrajProcessor.load_output("top.traj.chain%s_distances.out" % number)
+        np.testing.assert_array_equal(chain.contacts, counts)
+        assert chain.frames == frames
+
+
+def test_encoder_short_chain():
+    encoder = TrajEncoder(cutoff=1.0)
+    chain = encoder.encode_chain(np.zeros((3, encoder.fragment_size - 1, 3), dtype=np.float32))
+    assert chain.codes.shape == (3, 0) and chain.contacts.shape == (0, 0) and chain.strings() == ["", "", ""]
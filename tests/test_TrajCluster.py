@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from benchmarks.SyntheticData import synthetic_strings
+from TrajSAencode.SAFormat import SABinaryWriter, SABinaryReader
+from TrajSAencode.SAMetric import encode_strings
+from TrajSAencode.SAlib import SADICT
+from TrajSAencode.TrajCluster import TrajCluster
+
+LENGTH = 30
+
+
+def new_cluster(strings=()):
+    cluster = TrajCluster(SADICT, 4, 3, 1.0)
+    cluster.sa_traj = list(strings)
+    return cluster
+
+
+def write_sasta(path, strings):
+    with open(path, "w") as out:
+        for string in strings:
+            out.write(">CLUST\n%s\n" % string)
+    return str(path)
+
+
+def read_members(cluster, path):
+    if path.endswith(".sab"):
+        return SABinaryReader(path).strings()
+    return cluster.read_clust_file(path)
+
+
+def pairwise_scan(cluster):
+    """
+    Distance matrix of the double loop over compare_frames that compute_similarity replaced
+    """
+    frames = cluster.sa_traj
+    matrix = np.zeros((len(frames), len(frames)))
+    for i, frame1 in enumerate(frames):
+        for j in range(i, len(frames)):
+            matrix[i][j] = matrix[j][i] = cluster.compare_frames(frame1, frames[j])
+    return matrix
+
+
+@pytest.mark.parametrize("block_size,n_workers", [(256, 1), (7, 1), (7, 3)])
+def test_compute_similarity_matches_pairwise_scan(block_size, n_workers):
+    cluster = new_cluster(synthetic_strings(40, LENGTH, sorted(SADICT.keys())))
+    cluster.init_sim_mat()
+    cluster.compute_similarity(block_size=block_size, n_workers=n_workers)
+    # Same additions in the same order, so the distances are identical to the last bit
+    np.testing.assert_array_equal(cluster.dis_matrix, pairwise_scan(cluster))
+
+
+def member_scan(cluster, frames, members):
+    """
+    Cluster of every frame with the lowest average distance to the members, as expand_clusters used to compute it
+    """
+    labels = []
+    for frame in frames:
+        averages = [sum(cluster.compare_frames(frame, member) for member in clust) / len(clust) if clust else np.inf
+                    for clust in members]
+        labels.append(int(np.argmin(averages)))
+    return labels
+
+
+def test_expand_clusters_matches_member_scan(tmp_path):
+    keys = sorted(SADICT.keys())
+    strings = synthetic_strings(140, LENGTH, keys, n_states=4, mutation=0.4, seed=3)
+    members = [strings[0:15], [], strings[15:20], strings[20:60]]
+    frames = strings[60:]
+    files = [write_sasta(tmp_path / "clust0.sasta", members[0]), write_sasta(tmp_path / "clust1.sasta", members[1]),
+             write_sasta(tmp_path / "clust2.sasta", members[2]), str(tmp_path / "clust3.sab")]
+    writer = SABinaryWriter(files[3], "".join(keys))
+    writer.write(encode_strings(members[3], keys), range(len(members[3])))
+    writer.close()
+
+    cluster = new_cluster(frames)
+    labels = member_scan(cluster, frames, members)
+    assert len(set(labels)) > 1
+    cluster.expand_clusters(files, block_size=7)
+    for number, path in enumerate(files):
+        added = [frame for frame, label in zip(frames, labels) if label == number]
+        assert read_members(cluster, path) == members[number] + added
+
+
+def test_cluster_profiles_rejects_different_lengths(tmp_path):
+    keys = sorted(SADICT.keys())
+    files = [write_sasta(tmp_path / "clust0.sasta", synthetic_strings(3, LENGTH, keys)),
+             write_sasta(tmp_path / "clust1.sasta", synthetic_strings(3, LENGTH - 1, keys))]
+    with pytest.raises(ValueError):
+        new_cluster().cluster_profiles(files)
+    with pytest.raises(ValueError):
+        new_cluster().cluster_profiles([write_sasta(tmp_path / "empty.sasta", [])])
@@ -0,0 +1,44 @@
+import mdtraj as md
+import numpy as np
+import pytest
+from TrajSAencode.TrajLoader import TrajLoader
+
+
+def atom_slice_frames(loader):
+    """
+    Frames of every chain cut with atom_slice from the chunks, as the loader did before the chain selectors
+    """
+    frames = []
+    n_frames = 0
+    top = md.load(loader.topology_file)
+    for chunk in md.iterload(loader.mdtrajectory, chunk=loader.chunk_size, top=top, atom_indices=loader.ca_indexes):
+        for i, chain in enumerate(loader.chains):
+            for j, frame in enumerate(chunk.atom_slice(chain)):
+                frames.append((frame.xyz[0], loader.generate_name(i + 1, n_frames + j + 1)))
+        n_frames += chunk.n_frames
+    return frames
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7])
+def test_chain_selectors_match_atom_slice(trajectory_files, chunk_size):
+    loader = TrajLoader(*trajectory_files, split_chains=True, chunk_size=chunk_size)
+    expected = atom_slice_frames(loader)
+    frames = list(loader.frames())
+    assert len(frames) == len(expected)
+    for (xyz, name), (expected_xyz, expected_name) in zip(frames, expected):
+        np.testing.assert_array_equal(xyz, expected_xyz)
+        assert name == expected_name
+    # Chunks hold the same frames grouped by chain
+    blocks = [(frame, name) for block, names in loader.chunks() for frame, name in zip(block, names)]
+    assert sorted(name for _, name in blocks) == sorted(name for _, name in expected)
+    by_name = {name: xyz for xyz, name in expected}
+    for xyz, name in blocks:
+        np.testing.assert_array_equal(xyz, by_name[name])
+
+
+def test_chain_selector_of_scattered_atoms(trajectory_files):
+    traj = md.load(trajectory_files[1], top=trajectory_files[0])
+    for chain in [[3, 4, 5, 6], [2, 4, 9, 30]]:
+        selector = TrajLoader.chain_selector(chain)
+        assert isinstance(selector, slice) == (chain == [3, 4, 5, 6])
+        np.testing.assert_array_equal(traj.xyz[:, selector], traj.atom_slice(chain).xyz)
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+from benchmarks.SyntheticData import synthetic_trajectory
+from TrajSAencode.SAlib import SADICT
+from TrajSAencode.TrajProcessor import ContactAccumulator, TrajProcessor, sliding_max
+
+CUTOFF = 1.0
+
+
+def per_atom_counts(xyz, cutoff):
+    """
+    Contact counts of the original loop over the atoms of every frame
+    """
+    counts = np.zeros((xyz.shape[1], xyz.shape[1]))
+    for frame in xyz:
+        for i, atom in enumerate(frame):
+            ones = np.ones(len(frame))
+            distances = np.linalg.norm(frame - atom, axis=1)
+            ones[distances > cutoff] = 0.0
+            counts[i] += ones
+    return counts
+
+
+@pytest.mark.parametrize("method,max_block_bytes", [("dense", 2 ** 26), ("dense", 1), ("grid", 2 ** 26)])
+def test_contacts_match_per_atom_loop(method, max_block_bytes):
+    xyz = synthetic_trajectory(15, 50)
+    accumulator = ContactAccumulator(xyz.shape[1], CUTOFF, method=method, max_block_bytes=max_block_bytes)
+    # Blocks of frames and single frames add up the same way
+    accumulator.add(xyz[:10])
+    for frame in xyz[10:]:
+        accumulator.add(frame)
+    np.testing.assert_array_equal(accumulator.counts, per_atom_counts(xyz, CUTOFF))
+    assert accumulator.frames == len(xyz)
+
+
+def test_unknown_contact_method():
+    with pytest.raises(ValueError):
+        ContactAccumulator(10, CUTOFF, method="sparse")
+
+
+def brute_force_max(counts, size):
+    n_windows = counts.shape[0] - size + 1
+    return np.array([[counts[i:i + size, j:j + size].max() for j in range(n_windows)] for i in range(n_windows)])
+
+
+@pytest.mark.parametrize("n_residues", [4, 5, 11])
+def test_sliding_max(n_residues):
+    counts = np.random.default_rng(n_residues).integers(100, size=(n_residues, n_residues))
+    np.testing.assert_array_equal(sliding_max(counts, 4), brute_force_max(counts, 4))
+
+
+@pytest.mark.parametrize("n_residues", [0, 1, 3])
+def test_sliding_max_short_chain(n_residues):
+    counts = np.ones((n_residues, n_residues), dtype=np.int64)
+    windows = sliding_max(counts, 4)
+    assert windows.shape == (0, 0) and windows.dtype == counts.dtype
+
+
+def element_output(counts, frames, fragment_size):
+    """
+    Text of the original writer, one write per element, for the fragment counts of brute_force_max
+    """
+    lines = []
+    for row, values in enumerate(brute_force_max(counts, fragment_size)):
+        lines.append("%s:[ %s]\n" % (row, "".join("%s " % value for value in values)))
+    return "".join(lines) + "frames : %s\n" % frames
+
+
+def test_outputs_match_element_writer(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    xyz = synthetic_trajectory(8, 30)
+    name = ">top.traj.chain1|1"
+    for binary in [False, True]:
+        traj_pros = TrajProcessor(SADICT, CUTOFF)
+        traj_pros.compute_distances_block(xyz, name)
+        traj_pros.convert_to_fragments()
+        traj_pros.save_output(binary=binary)
+    with open("top.traj.chain1_distances.out", "r") as inn:
+        assert inn.read() == element_output(per_atom_counts(xyz, CUTOFF), len(xyz), traj_pros.fragment_size)
+    text, frames = TrajProcessor.load_output("top.traj.chain1_distances.out")
+    counts, binary_frames = TrajProcessor.load_output("top.traj.chain1_distances.npz")
+    np.testing.assert_array_equal(counts, text)
+    assert frames == binary_frames == len(xyz)
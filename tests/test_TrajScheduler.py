@@ -0,0 +1,106 @@
+import filecmp
+import os
+import numpy as np
+import pytest
+from TrajSAencode.SAEncoder import SAEncoder
+from TrajSAencode.SAFormat import SABinaryReader
+from TrajSAencode.SAlib import SADICT
+from TrajSAencode.TrajLoader import TrajLoader
+from TrajSAencode.TrajProcessor import TrajProcessor
+from TrajSAencode.TrajScheduler import process_file, check_output_names, TrajScheduler
+
+
+@pytest.mark.parametrize("output_format", ["sasta", "both"])
+def test_chunk_size_does_not_change_outputs(trajectory_files, tmp_path, monkeypatch, output_format):
+    folders = []
+    for chunk in [1, 4, 30]:
+        folder = tmp_path / ("chunk%s" % chunk)
+        folder.mkdir()
+        monkeypatch.chdir(folder)
+        loader = TrajLoader(*trajectory_files, split_chains=True, chunk_size=chunk)
+        process_file(loader, SAEncoder(SADICT, output_format=output_format), verbose=False)
+        folders.append(folder)
+    outputs = sorted(os.listdir(folders[0]))
+    assert len(outputs) == (2 if output_format == "sasta" else 4)
+    for folder in folders[1:]:
+        assert sorted(os.listdir(folder)) == outputs
+        for name in outputs:
+            assert filecmp.cmp(str(folders[0] / name), str(folder / name), shallow=False), name
+
+
+class Crash(Exception):
+    pass
+
+
+def lose_buffers(sa_encoder):
+    """
+    Points the output files of an interrupted run to /dev/null, so what they still buffer is lost as in a crash
+    """
+    handlers = list(sa_encoder.output_file.values()) + [writer.handler for writer in sa_encoder.binary_file.values()]
+    null = os.open(os.devnull, os.O_WRONLY)
+    for handler in handlers:
+        os.dup2(null, handler.fileno())
+    os.close(null)
+
+
+def run(trajectory_files, chunk, stride, output_format, resume=False, crash_after=None):
+    """
+    Encodes the test trajectory in the current directory, optionally failing after crash_after blocks
+    :return: value of process_file, "crashed" when it failed
+    """
+    loader = TrajLoader(*trajectory_files, split_chains=True, chunk_size=chunk, stride=stride)
+    if crash_after is not None:
+        blocks = loader.chunks if chunk > 1 else loader.frames
+
+        def broken():
+            for i, block in enumerate(blocks()):
+                if i == crash_after:
+                    raise Crash()
+                yield block
+        if chunk > 1:
+            loader.chunks = broken
+        else:
+            loader.frames = broken
+    sa_encoder = SAEncoder(SADICT, output_format=output_format)
+    try:
+        return process_file(loader, sa_encoder, TrajProcessor(SADICT, 1.0), resume=resume,
+                            checkpoint_interval=1e-9, verbose=False)
+    except Crash:
+        lose_buffers(sa_encoder)
+        return "crashed"
+
+
+@pytest.mark.parametrize("chunk,stride", [(1, 1), (7, 1), (7, 2), (1, 3)])
+@pytest.mark.parametrize("output_format", ["sasta", "both"])
+def test_resume_matches_clean_run(trajectory_files, tmp_path, monkeypatch, chunk, stride, output_format):
+    clean, resumed = tmp_path / "clean", tmp_path / "resumed"
+    clean.mkdir()
+    resumed.mkdir()
+    monkeypatch.chdir(clean)
+    n_frames = run(trajectory_files, chunk, stride, output_format)
+    monkeypatch.chdir(resumed)
+    assert run(trajectory_files, chunk, stride, output_format, crash_after=3) == "crashed"
+    assert run(trajectory_files, chunk, stride, output_format, resume=True) < n_frames
+    # A complete trajectory is skipped
+    assert run(trajectory_files, chunk, stride, output_format, resume=True) is None
+    outputs = sorted(name for name in os.listdir(clean) if not name.endswith(".json"))
+    assert outputs == sorted(name for name in os.listdir(resumed) if not name.endswith(".json"))
+    for name in outputs:
+        if name.endswith(".sab"):
+            first, second = SABinaryReader(str(clean / name)), SABinaryReader(str(resumed / name))
+            np.testing.assert_array_equal(first.codes, second.codes)
+            np.testing.assert_array_equal(first.frame_index, second.frame_index)
+        else:
+            assert filecmp.cmp(str(clean / name), str(resumed / name), shallow=False), name
+
+
+def test_inputs_sharing_output_names_are_rejected():
+    check_output_names(["run1/md.xtc", "run2/other.xtc"], "top.pdb")
+    check_output_names(["run1/a.pdb", "run2/b.pdb"])
+    for files in [["run1/md.xtc", "run2/md.xtc"], ["md.xtc", "md.dcd"]]:
+        with pytest.raises(ValueError):
+            check_output_names(files, "top.pdb")
+        with pytest.raises(ValueError):
+            TrajScheduler(files, topology="top.pdb", n_workers=2)
+    with pytest.raises(ValueError):
+        check_output_names(["run1/a.pdb", "run2/a.pdb"])